@@ -1,15 +1,30 @@
-"""Entry point for the chatbot application."""
-import os
+"""Entry point for the chatbot application.
 
-import dotenv
-import openai
+Only the command line parser is imported at startup: the `openai` package
+and the HTTP stack are imported in the background while the first prompt is
+typed, or by the first request.
+"""
 import typer
 
 from wrapgpt import cli
 
-dotenv.load_dotenv()
+app = typer.Typer()
 
-openai.api_key = os.getenv("OPENIA_API_KEY")
+
+@app.callback()
+def load_environment() -> None:
+    """Chat with the OpenAI models from the terminal."""
+    import dotenv
+
+    dotenv.load_dotenv()
+
+
+app.command("chat")(cli.run)
+app.command("batch")(cli.batch)
+app.command("bench")(cli.bench)
+app.command("cache-eval")(cli.cache_eval)
+app.command("replay")(cli.replay)
+app.command("usage")(cli.usage_report)
 
 if __name__ == "__main__":
-    typer.run(cli.run)
+    app()
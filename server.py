@@ -0,0 +1,106 @@
+"""Entry point for the multi-session server."""
+import asyncio
+from pathlib import Path
+from typing import Optional
+
+import dotenv
+import typer
+from aiohttp import web
+from rich import print
+from rich.table import Table
+
+from wrapgpt.backend import BackendKind, FakeBackend, open_backend
+from wrapgpt.cache import ResponseCache
+from wrapgpt.loadgen import TraceRecorder
+from wrapgpt.metrics import open_metrics
+from wrapgpt.scheduler import Scheduler
+from wrapgpt.server import build_app, load_test
+from wrapgpt.store import open_store
+
+dotenv.load_dotenv()
+
+app = typer.Typer()
+
+
+@app.command()
+def serve(
+    host: str = "127.0.0.1",
+    port: int = 8080,
+    backend: BackendKind = BackendKind.OPENAI,
+    recording: Optional[Path] = None,
+    store: Optional[Path] = None,
+    cache_path: Optional[Path] = None,
+    model: str = "gpt-3.5-turbo",
+    concurrency: int = 64,
+    max_pending: int = 256,
+    max_sessions: int = 10_000,
+    idle_timeout: float = 600.0,
+    requests_per_minute: Optional[float] = None,
+    tokens_per_minute: Optional[float] = None,
+    metrics_port: Optional[int] = None,
+    packed: bool = False,
+    spill_bytes: Optional[int] = None,
+    coalesce: bool = True,
+    trace: Optional[Path] = None,
+    usage_path: Optional[Path] = None,
+):
+    """Serve conversations over HTTP and WebSocket."""
+    conversation_store = open_store(store) if store else None
+    response_cache = ResponseCache(path=cache_path) if cache_path else None
+    metrics = open_metrics(metrics_port, usage_directory=usage_path)
+    application = build_app(
+        open_backend(backend, recording),
+        conversation_store,
+        response_cache,
+        Scheduler(requests_per_minute, tokens_per_minute, coalesce=coalesce),
+        model,
+        concurrency,
+        max_pending,
+        max_sessions,
+        idle_timeout,
+        listeners=[metrics.add_call] if metrics else None,
+        packed=packed,
+        spill_bytes=spill_bytes,
+        trace=TraceRecorder(trace) if trace else None,
+    )
+    try:
+        web.run_app(application, host=host, port=port)
+    finally:
+        if conversation_store:
+            conversation_store.close()
+        if response_cache is not None:
+            response_cache.close()
+        if metrics:
+            metrics.close()
+
+
+@app.command()
+def loadtest(
+    sessions: int = 100,
+    turns: int = 5,
+    stream: bool = False,
+    latency: float = 0.0,
+    concurrency: int = 64,
+    max_pending: int = 100_000,
+):
+    """Load test the server in process against a fake backend."""
+    application = build_app(
+        FakeBackend(latency=latency),
+        scheduler=Scheduler(coalesce=True),
+        concurrency=concurrency,
+        max_pending=max_pending,
+    )
+    result = asyncio.run(load_test(application, sessions, turns, stream))
+    table = Table(title="Load test")
+    table.add_column("Metric", style="cyan")
+    table.add_column("Value", style="cyan")
+    table.add_row("Sessions", str(sessions))
+    table.add_row("Turns/s", f"{result['turns_per_second']:.1f}")
+    table.add_row("Latency p50", f"{result['p50'] * 1e3:.1f}ms")
+    table.add_row("Latency p99", f"{result['p99'] * 1e3:.1f}ms")
+    table.add_row("Failures", str(result["failures"]))
+    print(table)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,94 @@
+"""Local fake of the chat completions API, to test against.
+
+It also accepts OTLP traces, posted to any path ending in /traces.
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeServer:
+    """Serves chat completions, failing the first requests on demand.
+
+    Attributes:
+        failures (list[tuple[int, dict]]): Status and headers of the next
+            failed responses, in order.
+        requests (list[dict]): Bodies of the requests received.
+    """
+
+    def __init__(self):
+        self.failures: list[tuple[int, dict]] = []
+        self.requests: list[dict] = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers["Content-Length"])
+                body = json.loads(self.rfile.read(length))
+                server.requests.append(body)
+                if self.path.endswith("/traces"):
+                    self.respond(200, {})
+                    return
+                if server.failures:
+                    status, headers = server.failures.pop(0)
+                    self.respond(
+                        status, {"error": {"message": "Failed"}}, headers
+                    )
+                    return
+                content = body["messages"][-1]["content"]
+                self.respond(
+                    200,
+                    {
+                        "id": "chatcmpl-fake",
+                        "object": "chat.completion",
+                        "choices": [
+                            {
+                                "index": 0,
+                                "message": {
+                                    "role": "assistant",
+                                    "content": content[::-1],
+                                },
+                                "finish_reason": "stop",
+                            }
+                        ],
+                        "usage": {
+                            "prompt_tokens": 10,
+                            "completion_tokens": 5,
+                            "total_tokens": 15,
+                        },
+                    },
+                )
+
+            def respond(self, status, body, headers=None):
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, args=(0.01,), daemon=True
+        )
+
+    @property
+    def url(self) -> str:
+        """Return the base URL of the API."""
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1"
+
+    def __enter__(self) -> "FakeServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,150 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from assertpy import assert_that
+
+from wrapgpt import backend, benchmark
+from wrapgpt.conversation import Conversation
+from wrapgpt.message import Message
+from wrapgpt.scheduler import Scheduler
+
+REQUEST = {
+    "model": "gpt-3.5-turbo",
+    "messages": [{"role": "user", "content": "Say this is a test"}],
+}
+
+
+async def collect(deltas) -> list[str]:
+    return [delta async for delta in await deltas]
+
+
+class TestBackend(unittest.TestCase):
+    def test_backends_implement_every_method(self):
+        class Incomplete(backend.Backend):
+            def complete(self, **request) -> Message:
+                return Message("assistant", "")
+
+        assert_that(backend.Backend).raises(TypeError).when_called_with()
+        assert_that(Incomplete).raises(TypeError).when_called_with()
+
+
+class TestFakeBackend(unittest.TestCase):
+    def test_complete_echoes_with_usage(self):
+        fake = backend.FakeBackend(prompt_tokens=10, completion_tokens=5)
+        reply = fake.complete(**REQUEST)
+        assert_that(reply.content).is_equal_to("Say this is a test")
+        assert_that(reply.cost.prompt_tokens).is_equal_to(10)
+        assert_that(reply.cost.completion_tokens).is_equal_to(5)
+        assert_that(fake.requests).is_equal_to(1)
+
+    def test_stream_splits_words(self):
+        fake = backend.FakeBackend()
+        assert_that(list(fake.stream(**REQUEST))).is_equal_to(
+            ["Say", " this", " is", " a", " test"]
+        )
+        assert_that(asyncio.run(collect(fake.astream(**REQUEST)))).is_length(5)
+
+    def test_latency(self):
+        fake = backend.FakeBackend(latency=0.05)
+        start = time.perf_counter()
+        asyncio.run(fake.acomplete(**REQUEST))
+        assert_that(time.perf_counter() - start).is_greater_than(0.04)
+
+    def test_errors_and_latency_spread(self):
+        fake = backend.FakeBackend(
+            latency=0.001, latency_sigma=1.0, error_rate=0.5, seed=3
+        )
+        for _ in range(20):
+            try:
+                fake.complete(**REQUEST)
+            except Exception as error:
+                assert_that(type(error).__name__).is_equal_to(
+                    "ServiceUnavailableError"
+                )
+        assert_that(fake.failures + fake.requests).is_equal_to(20)
+        assert_that(fake.failures).is_between(1, 19)
+        assert_that(fake.usage.completion_tokens).is_equal_to(
+            5 * fake.requests
+        )
+        latencies = {fake._latency() for _ in range(10)}
+        assert_that(latencies).is_length(10)
+
+    def test_conversation_uses_backend(self):
+        fake = backend.FakeBackend(reply=lambda messages: "Hi!")
+        conversation = Conversation(scheduler=Scheduler(), backend=fake)
+        reply = conversation.send(Message("user", "Hello"))
+        assert_that(reply.content).is_equal_to("Hi!")
+        assert_that(conversation.messages).is_length(2)
+        assert_that(conversation.cost.prompt_tokens).is_positive()
+
+
+class TestOpenAIBackend(unittest.TestCase):
+    def test_conversations_use_the_key_of_the_environment(self):
+        with mock.patch.dict(os.environ, {"OPENIA_API_KEY": "key"}):
+            conversation = Conversation()
+        assert_that(conversation.backend).is_instance_of(backend.OpenAIBackend)
+        assert_that(conversation.backend.api_key).is_equal_to("key")
+
+
+class TestRecordReplay(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name) / "recording.jsonl"
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_replay_serves_recorded_replies(self):
+        recorder = backend.RecordingBackend(
+            backend.FakeBackend(reply=lambda messages: "It is a test"),
+            self.path,
+        )
+        recorded = recorder.complete(**REQUEST, request_timeout=5)
+        replay = backend.ReplayBackend(self.path)
+        replayed = replay.complete(**REQUEST)
+        assert_that(replayed.content).is_equal_to(recorded.content)
+        assert_that(replayed.cost).is_equal_to(recorded.cost)
+        assert_that(list(replay.stream(**REQUEST))).is_equal_to(
+            ["It", " is", " a", " test"]
+        )
+
+    def test_records_streamed_replies(self):
+        fake = backend.FakeBackend()
+        recorder = backend.RecordingBackend(fake, self.path)
+        asyncio.run(collect(recorder.astream(**REQUEST)))
+        list(recorder.stream(**REQUEST))
+        replay = backend.ReplayBackend(self.path)
+        reply = replay.complete(**REQUEST)
+        assert_that(reply.content).is_equal_to("Say this is a test")
+        assert_that(reply.cost).is_equal_to(fake.complete(**REQUEST).cost)
+        assert_that(reply.cost.prompt_tokens).is_positive()
+
+    def test_replay_rejects_unrecorded_requests(self):
+        self.path.touch()
+        replay = backend.ReplayBackend(self.path)
+        assert_that(replay.complete).raises(LookupError).when_called_with(
+            **REQUEST
+        )
+
+    def test_open_backend_needs_recording(self):
+        assert_that(backend.open_backend).raises(ValueError).when_called_with(
+            backend.BackendKind.REPLAY
+        )
+        assert_that(
+            backend.open_backend(backend.BackendKind.FAKE)
+        ).is_instance_of(backend.FakeBackend)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_measures_every_scenario(self):
+        results = benchmark.run_benchmarks((0, 10), turns=3)
+        assert_that(results).is_length(4)
+        for result in results:
+            assert_that(result.turns).is_equal_to(3)
+            assert_that(result.throughput).is_positive()
+            assert_that(result.peak_memory).is_positive()
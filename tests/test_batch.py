@@ -0,0 +1,121 @@
+import asyncio
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from assertpy import assert_that
+from openai.openai_object import OpenAIObject
+
+from wrapgpt import batch
+
+
+async def fake_completion(**request):
+    await asyncio.sleep(0.01)
+    content = request["messages"][-1]["content"]
+    if content == "fail":
+        raise RuntimeError("Service unavailable")
+    return OpenAIObject.construct_from(
+        {
+            "choices": [
+                {"message": {"role": "assistant", "content": content[::-1]}},
+            ],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 5},
+        }
+    )
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.input_path = Path(self.directory.name) / "input.jsonl"
+        self.output_path = Path(self.directory.name) / "output.jsonl"
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_jobs(self, jobs: list[dict]) -> None:
+        with open(self.input_path, "w", encoding="utf-8") as file:
+            for job in jobs:
+                file.write(json.dumps(job) + "\n")
+
+    def read_results(self) -> dict:
+        with open(self.output_path, encoding="utf-8") as file:
+            return {result["id"]: result for result in map(json.loads, file)}
+
+    def run_batch(self) -> batch.BatchReport:
+        with mock.patch(
+            "openai.ChatCompletion.acreate", side_effect=fake_completion
+        ):
+            return asyncio.run(
+                batch.run_batch(self.input_path, self.output_path, workers=4)
+            )
+
+    def test_percentile(self):
+        values = [float(value) for value in range(1, 101)]
+        assert_that(batch.percentile(values, 50)).is_equal_to(51.0)
+        assert_that(batch.percentile(values, 99)).is_equal_to(99.0)
+        assert_that(batch.percentile([], 99)).is_equal_to(0.0)
+
+    def test_run_scripts_and_conversations(self):
+        self.write_jobs(
+            [
+                {"id": "script", "prompts": ["abc", "def"]},
+                {
+                    "id": "conversation",
+                    "context": "Reverse the text",
+                    "messages": [{"role": "user", "content": "xyz"}],
+                },
+                {"id": "error", "prompts": ["fail"]},
+            ]
+        )
+        report = self.run_batch()
+        results = self.read_results()
+        assert_that(results["script"]["replies"]).is_equal_to(["cba", "fed"])
+        assert_that(results["conversation"]["replies"]).is_equal_to(["zyx"])
+        assert_that(results["error"]["error"]).contains("unavailable")
+        assert_that(report.conversations).is_equal_to(3)
+        assert_that(report.errors).is_equal_to(1)
+        assert_that(report.requests).is_equal_to(3)
+        assert_that(report.prompt_tokens).is_equal_to(30)
+        assert_that(report.latency(99)).is_greater_than(0)
+
+    def test_resume_from_checkpoint(self):
+        self.write_jobs(
+            [{"id": str(index), "prompts": ["abc"]} for index in range(3)]
+        )
+        self.run_batch()
+        self.write_jobs(
+            [{"id": str(index), "prompts": ["abc"]} for index in range(5)]
+        )
+        report = self.run_batch()
+        assert_that(report.skipped).is_equal_to(3)
+        assert_that(report.conversations).is_equal_to(2)
+        assert_that(self.read_results()).is_length(5)
+
+    def test_resume_retries_failed_conversations(self):
+        self.write_jobs([{"id": "flaky", "prompts": ["abc"]}])
+        outage = mock.patch(
+            "openai.ChatCompletion.acreate",
+            side_effect=RuntimeError("Service unavailable"),
+        )
+        with outage:
+            asyncio.run(batch.run_batch(self.input_path, self.output_path))
+        assert_that(self.read_results()["flaky"]["error"]).is_not_none()
+        report = self.run_batch()
+        assert_that(report.skipped).is_zero()
+        assert_that(report.conversations).is_equal_to(1)
+        with open(self.output_path, encoding="utf-8") as file:
+            results = [json.loads(line) for line in file]
+        assert_that(results).is_length(1)
+        assert_that(results[0]["error"]).is_none()
+        assert_that(results[0]["replies"]).is_equal_to(["cba"])
+        assert_that(self.run_batch().skipped).is_equal_to(1)
+
+    def test_workers_run_concurrently(self):
+        self.write_jobs(
+            [{"id": str(index), "prompts": ["abc"]} for index in range(40)]
+        )
+        report = self.run_batch()
+        assert_that(report.elapsed).is_less_than(40 * 0.01 / 2)
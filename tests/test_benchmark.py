@@ -0,0 +1,45 @@
+import time
+import unittest
+
+from assertpy import assert_that
+
+from wrapgpt import conversation
+
+TURNS = 200
+
+
+def build_conversation(size: int) -> conversation.Conversation:
+    new_conversation = conversation.Conversation()
+    new_conversation.context = conversation.Message(
+        role="system", content="You are a programmer"
+    )
+    for index in range(size):
+        new_conversation.add_message(
+            conversation.Message(role="user", content=f"Message {index}")
+        )
+    new_conversation.dict
+    return new_conversation
+
+
+def time_per_turn(size: int) -> float:
+    """Time adding a message and serializing the conversation."""
+    new_conversation = build_conversation(size)
+    messages = [
+        conversation.Message(role="user", content=f"Turn {index}")
+        for index in range(TURNS)
+    ]
+    start = time.perf_counter()
+    for message in messages:
+        new_conversation.add_message(message)
+        new_conversation.dict
+    return (time.perf_counter() - start) / TURNS
+
+
+class TestSerializationBenchmark(unittest.TestCase):
+    def test_serialization_cost_stays_flat_as_history_grows(self):
+        small = min(time_per_turn(100) for _ in range(5))
+        large = min(time_per_turn(10_000) for _ in range(5))
+        assert_that(large).described_as(
+            f"per-turn serialization: {small * 1e6:.2f}us at 100 messages, "
+            f"{large * 1e6:.2f}us at 10k messages"
+        ).is_less_than(small * 5)
@@ -0,0 +1,109 @@
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from assertpy import assert_that
+from openai.openai_object import OpenAIObject
+
+from wrapgpt import cache, conversation, cost
+
+REQUEST = {
+    "model": "gpt-3.5-turbo",
+    "messages": [{"role": "user", "content": "Hello"}],
+}
+
+
+class TestCache(unittest.TestCase):
+    def test_request_key_is_stable(self):
+        assert_that(cache.request_key(**REQUEST)).is_equal_to(
+            cache.request_key(
+                messages=REQUEST["messages"], model="gpt-3.5-turbo"
+            )
+        )
+        assert_that(cache.request_key(**REQUEST)).is_not_equal_to(
+            cache.request_key(**REQUEST, max_tokens=10)
+        )
+
+    def test_cache_hit_keeps_original_cost(self):
+        response_cache = cache.ResponseCache()
+        response_cache.put(
+            "key", conversation.Message("assistant", "Hi", cost.Cost(10, 20))
+        )
+        cached = response_cache.get("key")
+        assert_that(cached.content).is_equal_to("Hi")
+        assert_that(cached.cost).is_equal_to(cost.Cost(10, 20))
+        assert_that(cached.cached).is_true()
+        assert_that(response_cache.get("other")).is_none()
+
+    def test_least_recently_used_entry_is_evicted(self):
+        response_cache = cache.ResponseCache(max_size=2)
+        for key in ["a", "b"]:
+            response_cache.put(key, conversation.Message("assistant", key))
+        response_cache.get("a")
+        response_cache.put("c", conversation.Message("assistant", "c"))
+        assert_that(len(response_cache)).is_equal_to(2)
+        assert_that(response_cache.get("b")).is_none()
+        assert_that(response_cache.get("a")).is_not_none()
+
+    def test_expired_entry_is_not_returned(self):
+        response_cache = cache.ResponseCache(ttl=60)
+        response_cache.put("key", conversation.Message("assistant", "Hi"))
+        with mock.patch("time.time", return_value=time.time() + 61):
+            assert_that(response_cache.get("key")).is_none()
+
+    def test_disk_tier_survives_restarts(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "cache.db"
+            response_cache = cache.ResponseCache(path=path, max_disk_size=1)
+            response_cache.put("a", conversation.Message("assistant", "a"))
+            response_cache.put("b", conversation.Message("assistant", "b"))
+            response_cache.close()
+            response_cache = cache.ResponseCache(path=path)
+            assert_that(response_cache.get("a")).is_none()
+            assert_that(response_cache.get("b").content).is_equal_to("b")
+            response_cache.close()
+
+    def test_disk_tier_is_trimmed_in_batches(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "cache.db"
+            response_cache = cache.ResponseCache(
+                max_size=1, path=path, max_disk_size=10
+            )
+            statements = []
+            response_cache._connection.set_trace_callback(statements.append)
+            for key in range(12):
+                response_cache.put(
+                    str(key), conversation.Message("assistant", str(key))
+                )
+            trims = [s for s in statements if s.startswith("DELETE")]
+            assert_that(trims).is_length(1)
+            assert_that(response_cache.get("0")).is_none()
+            assert_that(response_cache.get("2").content).is_equal_to("2")
+            response_cache.close()
+
+    @mock.patch("openai.ChatCompletion.create")
+    def test_conversation_serves_identical_requests_from_cache(self, create):
+        create.return_value = OpenAIObject.construct_from(
+            {
+                "choices": [
+                    {"message": {"role": "assistant", "content": "Hi"}},
+                ],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 20},
+            }
+        )
+        response_cache = cache.ResponseCache()
+        for _ in range(2):
+            new_conversation = conversation.Conversation(cache=response_cache)
+            new_conversation.send(conversation.Message("user", "Hello"))
+        create.assert_called_once()
+        assert_that(new_conversation.last.cached).is_true()
+        assert_that(new_conversation.last.cost.total).is_equal_to(30)
+        assert_that(new_conversation.cost.total).is_equal_to(0)
+        streamed_conversation = conversation.Conversation(cache=response_cache)
+        deltas = streamed_conversation.stream(
+            conversation.Message("user", "Hello")
+        )
+        assert_that(list(deltas)).is_equal_to(["Hi"])
+        create.assert_called_once()
@@ -0,0 +1,166 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from assertpy import assert_that
+from rich.console import Console
+
+from wrapgpt import _prompt, cli
+from wrapgpt._prompt import SUGGESTION_REQUEST, SuggestionMode
+from wrapgpt.backend import FakeBackend
+from wrapgpt.compaction import Compactor
+from wrapgpt.conversation import Conversation
+from wrapgpt.engine import Engine
+from wrapgpt.interactions import SessionInteractions
+from wrapgpt.message import Message
+from wrapgpt.scheduler import Scheduler
+
+
+class Exit(Exception):
+    pass
+
+
+def fail(messages: list[dict]) -> str:
+    raise LookupError("The request was not recorded.")
+
+
+def fail_suggestions(messages: list[dict]) -> str:
+    if messages[-1]["content"] == SUGGESTION_REQUEST.content:
+        fail(messages)
+    return messages[-1]["content"]
+
+
+class TestChat(unittest.TestCase):
+    def chat(
+        self,
+        suggestions: SuggestionMode,
+        prompts: list,
+        backend: FakeBackend = None,
+    ) -> None:
+        self.backend = backend or FakeBackend()
+        self.conversation = Conversation(
+            scheduler=Scheduler(), backend=self.backend
+        )
+        self.conversation.add_message(Message("user", "Hello"))
+        self.conversation.add_message(Message("assistant", "Hi"))
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        with mock.patch.object(
+            cli, "__read_prompt", side_effect=[*prompts, Exit()]
+        ), mock.patch.object(cli, "print") as self.printed:
+            with self.assertRaises(Exit):
+                getattr(cli, "__chat")(
+                    self.conversation,
+                    SessionInteractions(),
+                    Engine(),
+                    loop,
+                    suggestions,
+                )
+
+    def test_suggest_makes_no_request_when_suggestions_are_off(self):
+        self.chat(SuggestionMode.OFF, ["suggest"])
+        assert_that(self.backend.requests).is_zero()
+
+    def test_suggest_on_request(self):
+        self.chat(SuggestionMode.LAZY, ["suggest"])
+        assert_that(self.backend.requests).is_equal_to(1)
+
+    def test_failed_answer_is_reported_and_its_prompt_dropped(self):
+        self.chat(
+            SuggestionMode.BACKGROUND,
+            ["Hello again", "suggest"],
+            FakeBackend(reply=fail),
+        )
+        assert_that(self.conversation.dict).is_equal_to(
+            [
+                {"role": "user", "content": "Hello"},
+                {"role": "assistant", "content": "Hi"},
+            ]
+        )
+        self.printed.assert_called_with(
+            "[red][!][/red]LookupError: The request was not recorded."
+        )
+        assert_that(self.printed.call_count).is_equal_to(2)
+
+    def test_failed_suggestion_is_no_suggestion(self):
+        backend = FakeBackend(reply=fail_suggestions)
+        self.chat(SuggestionMode.BACKGROUND, ["Hello again"], backend)
+        assert_that(self.conversation.last.content).is_equal_to("Hello again")
+        self.printed.assert_not_called()
+
+    def test_background_suggestion_follows_up_on_the_prompt(self):
+        requests = []
+
+        def reply(messages: list[dict]) -> str:
+            if messages[-1]["content"] == SUGGESTION_REQUEST.content:
+                requests.append(messages)
+                return "Suggested"
+            return "Answer"
+
+        self.chat(
+            SuggestionMode.BACKGROUND, ["Hello again"], FakeBackend(reply)
+        )
+        assert_that(requests).is_length(1)
+        assert_that(requests[0][-2]).is_equal_to(
+            {"role": "user", "content": "Hello again"}
+        )
+        assert_that(self.conversation.last.content).is_equal_to("Answer")
+
+    def test_cheap_suggestion_keeps_the_context(self):
+        conversation = Conversation()
+        conversation.context = Message("system", "Answer in French")
+        for index in range(4):
+            conversation.add_message(Message("user", f"Message {index}"))
+        request = getattr(_prompt, "__suggestion_request")(
+            conversation, SuggestionMode.CHEAP
+        )
+        assert_that([m["content"] for m in request["messages"]]).is_equal_to(
+            [
+                "Answer in French",
+                "Message 2",
+                "Message 3",
+                SUGGESTION_REQUEST.content,
+            ]
+        )
+
+    def test_suggest_command_is_hidden_when_suggestions_are_off(self):
+        build = getattr(cli, "__build_commands_table")
+        console = Console(width=120)
+        for mode, shown in (
+            (SuggestionMode.OFF, False),
+            (SuggestionMode.LAZY, True),
+        ):
+            with console.capture() as capture:
+                console.print(build(mode))
+            assert_that("suggest" in capture.get()).is_equal_to(shown)
+
+
+class TestCompaction(unittest.IsolatedAsyncioTestCase):
+    async def test_failed_compactions_are_kept_and_reported(self):
+        conversation = Conversation(
+            scheduler=Scheduler(),
+            backend=FakeBackend(),
+            compactor=Compactor(threshold=1, keep=1),
+        )
+        release = asyncio.Event()
+
+        async def compact():
+            await release.wait()
+            raise RuntimeError("Boom")
+
+        compactions = getattr(cli, "__compactions")
+        with mock.patch.object(
+            conversation, "acompact", side_effect=compact
+        ), mock.patch.object(cli, "print") as printed:
+            async with Engine() as engine:
+                await getattr(cli, "__stream_gpt")(
+                    "Hello", conversation, engine, SuggestionMode.OFF
+                )
+                assert_that(compactions).is_length(1)
+                release.set()
+                await asyncio.gather(*compactions, return_exceptions=True)
+                await asyncio.sleep(0)
+        assert_that(compactions).is_empty()
+        printed.assert_called_once_with(
+            "[red][!][/red]Compaction failed: Boom"
+        )
@@ -0,0 +1,92 @@
+import asyncio
+import unittest
+
+from assertpy import assert_that
+
+from wrapgpt.backend import FakeBackend
+from wrapgpt.compaction import SUMMARY_PREFIX, Compactor
+from wrapgpt.conversation import Conversation
+from wrapgpt.cost import Cost
+from wrapgpt.interactions import SessionInteractions
+from wrapgpt.message import Message
+from wrapgpt.scheduler import Scheduler
+
+ANSWER = "This is a long and detailed answer about the question. " * 20
+
+
+def reply(messages: list[dict]) -> str:
+    if messages[-1]["content"].startswith("Summarize"):
+        return "The user asked many questions."
+    return ANSWER
+
+
+class TestCompaction(unittest.TestCase):
+    def setUp(self):
+        self.backend = FakeBackend(reply=reply, completion_tokens=10)
+        self.session = SessionInteractions()
+        self.conversation = Conversation(
+            scheduler=Scheduler(),
+            backend=self.backend,
+            compactor=Compactor(threshold=1000, keep=2),
+        )
+        self.conversation.listeners.append(self.session.add_call)
+
+    def test_threshold(self):
+        self.conversation.add_message(Message("user", "Hello"))
+        assert_that(self.conversation.compact()).is_none()
+        assert_that(self.backend.requests).is_equal_to(0)
+
+    def test_long_sessions_are_compacted(self):
+        uncompacted = Conversation(
+            scheduler=Scheduler(), backend=FakeBackend(reply=reply)
+        )
+        for index in range(50):
+            question = Message("user", f"Question {index}")
+            uncompacted.send(Message(question.role, question.content))
+            self.conversation.send(question)
+            self.conversation.compact()
+        assert_that(self.conversation.summary.content).starts_with(
+            SUMMARY_PREFIX
+        )
+        assert_that(len(self.conversation.messages)).is_less_than(10)
+        assert_that(self.conversation.dict[0]).is_equal_to(
+            self.conversation.summary.dict
+        )
+        assert_that(self.conversation.tokens * 10).is_less_than(
+            uncompacted.tokens
+        )
+        assert_that(self.conversation.compaction_cost.total).is_equal_to(
+            self.session.session.compaction_tokens
+        )
+
+    def test_summaries_are_cached(self):
+        messages = [Message("user", ANSWER) for _ in range(5)]
+        for message in messages:
+            self.conversation.add_message(message)
+        self.conversation.compact()
+        del self.conversation.messages
+        for message in messages:
+            self.conversation.add_message(message)
+        summary = self.conversation.compact()
+        assert_that(summary.cached).is_true()
+        assert_that(self.backend.requests).is_equal_to(1)
+        assert_that(self.conversation.compaction_cost.total).is_positive()
+        assert_that(self.session.session.cache_hits).is_equal_to(1)
+
+    def test_summary_is_discarded_after_reset(self):
+        for _ in range(5):
+            self.conversation.add_message(Message("user", ANSWER))
+
+        async def compact_and_reset():
+            compaction = asyncio.ensure_future(self.conversation.acompact())
+            await asyncio.sleep(0)
+            assert_that(self.conversation.compact()).is_none()
+            del self.conversation.messages
+            self.conversation.add_message(Message("user", "Hello"))
+            await compaction
+
+        self.backend.latency = 0.01
+        asyncio.run(compact_and_reset())
+        assert_that(self.conversation.summary).is_none()
+        assert_that(self.conversation.messages).is_length(1)
+        assert_that(self.conversation.compaction_cost).is_equal_to(Cost())
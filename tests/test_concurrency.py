@@ -0,0 +1,138 @@
+import asyncio
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from assertpy import assert_that
+
+from wrapgpt import conversation, cost
+from wrapgpt.backend import FakeBackend
+from wrapgpt.interactions import SessionInteractions
+from wrapgpt.scheduler import Scheduler
+from wrapgpt.turns import TurnOrder
+
+THREADS = 16
+TURNS_PER_THREAD = 25
+
+
+class TestTurnOrder(unittest.TestCase):
+    def test_turns_run_in_arrival_order(self):
+        order = TurnOrder()
+        started = []
+        finished = []
+        gate = threading.Event()
+
+        def turn(index):
+            with order.turn():
+                if index == 0:
+                    gate.wait()
+                finished.append(index)
+
+        threads = []
+        for index in range(5):
+            thread = threading.Thread(target=turn, args=(index,))
+            thread.start()
+            threads.append(thread)
+            started.append(index)
+            while order._next <= index:
+                time.sleep(0.001)
+        gate.set()
+        for thread in threads:
+            thread.join()
+        assert_that(finished).is_equal_to(started)
+
+    def test_cancelled_task_gives_up_its_turn(self):
+        order = TurnOrder()
+
+        async def main():
+            finished = []
+
+            async def turn(index, hold=0.0):
+                async with order.aturn():
+                    await asyncio.sleep(hold)
+                    finished.append(index)
+
+            first = asyncio.ensure_future(turn(0, 0.05))
+            second = asyncio.ensure_future(turn(1))
+            third = asyncio.ensure_future(turn(2))
+            await asyncio.sleep(0.01)
+            second.cancel()
+            await asyncio.gather(first, third)
+            return finished
+
+        assert_that(asyncio.run(main())).is_equal_to([0, 2])
+
+
+class TestThreadSafeConversation(unittest.TestCase):
+    def build_conversation(self) -> conversation.Conversation:
+        self.statistics = SessionInteractions()
+        return conversation.Conversation(
+            backend=FakeBackend(),
+            scheduler=Scheduler(),
+            listeners=[self.statistics.add_call],
+            thread_safe=True,
+        )
+
+    def test_many_threads_keep_turns_whole(self):
+        shared = self.build_conversation()
+
+        def talk(thread):
+            for turn in range(TURNS_PER_THREAD):
+                content = f"Thread {thread} turn {turn}"
+                if turn % 2:
+                    reply = shared.send(conversation.Message("user", content))
+                else:
+                    reply = "".join(
+                        shared.stream(conversation.Message("user", content))
+                    )
+                assert_that(str(reply)).is_equal_to(content)
+                shared.add_suggestion_cost(cost.Cost(1, 1))
+
+        with ThreadPoolExecutor(THREADS) as executor:
+            list(executor.map(talk, range(THREADS)))
+
+        messages = shared.messages
+        turns = THREADS * TURNS_PER_THREAD
+        assert_that(messages).is_length(2 * turns)
+        for question, answer in zip(messages[::2], messages[1::2]):
+            assert_that(question.role).is_equal_to("user")
+            assert_that(answer.role).is_equal_to("assistant")
+            assert_that(answer.content).is_equal_to(question.content)
+        for thread in range(THREADS):
+            asked = [
+                int(m.content.split()[-1])
+                for m in messages[::2]
+                if m.content.startswith(f"Thread {thread} ")
+            ]
+            assert_that(asked).is_equal_to(list(range(TURNS_PER_THREAD)))
+        spent = sum((m.cost for m in messages), cost.Cost())
+        suggested = cost.Cost(turns, turns)
+        assert_that(shared.suggestion_cost).is_equal_to(suggested)
+        assert_that(shared.cost).is_equal_to(spent + suggested)
+        assert_that(self.statistics.session.calls).is_equal_to(turns)
+        assert_that(shared.dict).is_length(2 * turns)
+
+    def test_handed_out_payload_is_not_changed(self):
+        shared = self.build_conversation()
+        shared.send(conversation.Message("user", "Hello"))
+        payload = shared.dict
+        shared.send(conversation.Message("user", "Again"))
+        assert_that(payload).is_length(2)
+        assert_that(shared.dict).is_length(4)
+
+    def test_asynchronous_turns_share_the_order(self):
+        shared = self.build_conversation()
+
+        async def main():
+            await asyncio.gather(
+                *(
+                    shared.asend(conversation.Message("user", f"Q{index}"))
+                    for index in range(10)
+                )
+            )
+
+        asyncio.run(main())
+        contents = [message.content for message in shared.messages]
+        expected = [f"Q{index}" for index in range(10) for _ in range(2)]
+        assert_that(contents).is_equal_to(expected)
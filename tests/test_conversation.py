@@ -1,6 +1,9 @@
+import asyncio
 import unittest
+from unittest import mock
 
 from assertpy import assert_that, fail
+from openai.openai_object import OpenAIObject
 
 from wrapgpt import conversation, cost
 
@@ -46,6 +49,25 @@ class TestConversation(unittest.TestCase):
         del new_conversation.messages
         assert_that(new_conversation.messages).is_empty()
 
+    def test_pop_the_last_message(self):
+        for packed in (False, True):
+            new_conversation = conversation.Conversation(packed=packed)
+            new_conversation.add_message(
+                conversation.Message("assistant", "Hi", cost.Cost(10, 20))
+            )
+            new_conversation.dict
+            new_conversation.add_message(
+                conversation.Message("user", "Hello", cost.Cost(3, 0))
+            )
+            popped = new_conversation.pop_message()
+            assert_that(popped.content).is_equal_to("Hello")
+            assert_that(new_conversation.dict).is_equal_to(
+                [{"role": "assistant", "content": "Hi"}]
+            )
+            assert_that(new_conversation.cost).is_equal_to(cost.Cost(10, 20))
+        new_conversation.pop_message()
+        assert_that(new_conversation.pop_message).raises(IndexError)
+
     def test_set_context_to_conversation(self):
         new_conversation = conversation.Conversation()
         new_conversation.context = conversation.Message(
@@ -114,3 +136,109 @@ class TestConversation(unittest.TestCase):
                 },
             ]
         )
+
+    @mock.patch("openai.ChatCompletion.create")
+    def test_send_message_adds_reply_to_conversation(self, create):
+        create.return_value = OpenAIObject.construct_from(
+            {
+                "choices": [
+                    {
+                        "message": {
+                            "role": "assistant",
+                            "content": "How can I help you?",
+                        },
+                    },
+                ],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 20},
+            }
+        )
+        new_conversation = conversation.Conversation()
+        reply = new_conversation.send(
+            conversation.Message(role="user", content="Hello")
+        )
+        assert_that(reply.content).is_equal_to("How can I help you?")
+        assert_that(new_conversation.messages).is_length(2)
+        assert_that(new_conversation.last).is_same_as(reply)
+        assert_that(new_conversation.cost.total).is_equal_to(30)
+
+    @mock.patch("openai.ChatCompletion.create")
+    def test_stream_message_yields_deltas(self, create):
+        create.return_value = iter(
+            OpenAIObject.construct_from({"choices": [{"delta": delta}]})
+            for delta in [
+                {"role": "assistant"},
+                {"content": "How can"},
+                {"content": " I help"},
+                {"content": " you?"},
+                {},
+            ]
+        )
+        new_conversation = conversation.Conversation()
+        deltas = new_conversation.stream(
+            conversation.Message(role="user", content="Hello")
+        )
+        assert_that(new_conversation.messages).is_empty()
+        assert_that(list(deltas)).is_equal_to(["How can", " I help", " you?"])
+        assert_that(create.call_args.kwargs["stream"]).is_true()
+        assert_that(new_conversation.messages).is_length(2)
+        assert_that(new_conversation.last.role).is_equal_to("assistant")
+        assert_that(new_conversation.last.content).is_equal_to(
+            "How can I help you?"
+        )
+        assert_that(new_conversation.cost.completion_tokens).is_equal_to(3)
+
+    @mock.patch("openai.ChatCompletion.acreate")
+    def test_astream_message_yields_deltas(self, acreate):
+        async def chunks():
+            for delta in [{"role": "assistant"}, {"content": "Hi"}, {}]:
+                yield OpenAIObject.construct_from(
+                    {"choices": [{"delta": delta}]}
+                )
+
+        acreate.return_value = chunks()
+        new_conversation = conversation.Conversation()
+
+        async def collect():
+            return [
+                delta
+                async for delta in new_conversation.astream(
+                    conversation.Message(role="user", content="Hello")
+                )
+            ]
+
+        assert_that(asyncio.run(collect())).is_equal_to(["Hi"])
+        assert_that(new_conversation.messages).is_length(2)
+        assert_that(new_conversation.last.content).is_equal_to("Hi")
+
+    def test_add_suggestion_cost_to_conversation(self):
+        new_conversation = conversation.Conversation()
+        new_conversation.add_cost(cost.Cost(10, 20))
+        new_conversation.add_suggestion_cost(cost.Cost(5, 1))
+        assert_that(new_conversation.cost.total).is_equal_to(36)
+        assert_that(new_conversation.suggestion_cost.total).is_equal_to(6)
+
+    def test_conversation_dict_follows_history_changes(self):
+        new_conversation = conversation.Conversation()
+        new_conversation.add_message(
+            conversation.Message(role="user", content="Hello")
+        )
+        assert_that(new_conversation.dict).is_length(1)
+        new_conversation.context = conversation.Message(
+            role="system", content="You are a programmer"
+        )
+        new_conversation.add_message(
+            conversation.Message(role="assistant", content="Hi")
+        )
+        assert_that(new_conversation.dict).is_equal_to(
+            [
+                {"role": "system", "content": "You are a programmer"},
+                {"role": "user", "content": "Hello"},
+                {"role": "assistant", "content": "Hi"},
+            ]
+        )
+        del new_conversation.messages
+        assert_that(new_conversation.dict).is_equal_to(
+            [{"role": "system", "content": "You are a programmer"}]
+        )
+        del new_conversation.context
+        assert_that(new_conversation.dict).is_empty()
@@ -27,6 +27,13 @@ class TestCost(unittest.TestCase):
         new_cost = cost.Cost(prompt_tokens=10, completion_tokens=20)
         assert_that(new_cost.total).is_equal_to(30)
 
+    def test_cost_subtraction(self):
+        cost1 = cost.Cost(prompt_tokens=30, completion_tokens=50)
+        cost2 = cost.Cost(prompt_tokens=20, completion_tokens=30)
+        assert_that(cost1 - cost2).is_equal_to(
+            cost.Cost(prompt_tokens=10, completion_tokens=20)
+        )
+
     def test_cost_addition(self):
         cost1 = cost.Cost(prompt_tokens=10, completion_tokens=20)
         cost2 = cost.Cost(prompt_tokens=20, completion_tokens=30)
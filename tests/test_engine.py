@@ -0,0 +1,48 @@
+import asyncio
+import unittest
+
+from assertpy import assert_that, fail
+
+from wrapgpt import engine
+
+
+class TestEngine(unittest.TestCase):
+    def test_engine_with_invalid_concurrency(self):
+        try:
+            engine.Engine(concurrency=0)
+            fail("Should have raised an exception")
+        except ValueError as e:
+            assert_that(str(e)).contains("at least 1")
+
+    def test_gather_keeps_order_and_concurrency_limit(self):
+        in_flight = 0
+        max_in_flight = 0
+
+        async def request(value):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return value
+
+        async def run():
+            async with engine.Engine(concurrency=3) as new_engine:
+                return await new_engine.gather(
+                    request(value) for value in range(10)
+                )
+
+        assert_that(asyncio.run(run())).is_equal_to(list(range(10)))
+        assert_that(max_in_flight).is_equal_to(3)
+
+    def test_stream_yields_all_items(self):
+        async def request():
+            for value in range(3):
+                await asyncio.sleep(0)
+                yield value
+
+        async def run():
+            async with engine.Engine() as new_engine:
+                return [value async for value in new_engine.stream(request())]
+
+        assert_that(asyncio.run(run())).is_equal_to([0, 1, 2])
@@ -0,0 +1,212 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from assertpy import assert_that
+
+from wrapgpt import conversation, flight
+from wrapgpt.backend import FakeBackend
+from wrapgpt.interactions import Interaction
+from wrapgpt.scheduler import Scheduler
+
+
+def run_together(functions: list) -> list:
+    results = [None] * len(functions)
+
+    def run(index):
+        results[index] = functions[index]()
+
+    threads = [
+        threading.Thread(target=run, args=(index,))
+        for index in range(len(functions))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_identical_calls_share_one_result(self):
+        flights = flight.SingleFlight()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.1)
+            return "result"
+
+        results = run_together([lambda: flights.call("key", slow)] * 4)
+        assert_that(calls).is_length(1)
+        assert_that([result for result, _ in results]).is_equal_to(
+            ["result"] * 4
+        )
+        assert_that([shared for _, shared in results].count(True)).is_equal_to(
+            3
+        )
+        assert_that(flights.shared).is_equal_to(3)
+
+    def test_later_calls_are_made_again(self):
+        flights = flight.SingleFlight()
+        calls = []
+        for _ in range(2):
+            flights.call("key", lambda: calls.append(1))
+        assert_that(calls).is_length(2)
+        assert_that(flights.shared).is_zero()
+
+    def test_error_reaches_every_caller(self):
+        flights = flight.SingleFlight()
+
+        def failing():
+            time.sleep(0.1)
+            raise ValueError("Upstream failed")
+
+        def call():
+            try:
+                flights.call("key", failing)
+            except ValueError as error:
+                return str(error)
+
+        results = run_together([call] * 3)
+        assert_that(results).is_equal_to(["Upstream failed"] * 3)
+
+    def test_stream_is_replayed_to_every_caller(self):
+        flights = flight.SingleFlight()
+
+        def stream():
+            for delta in "abc":
+                time.sleep(0.02)
+                yield delta
+
+        started = []
+
+        def counted():
+            started.append(1)
+            return stream()
+
+        def call():
+            deltas, _ = flights.call("key", counted)
+            return "".join(deltas)
+
+        results = run_together([call] * 3)
+        assert_that(results).is_equal_to(["abc"] * 3)
+        assert_that(started).is_length(1)
+
+    def test_asynchronous_calls_share_one_result(self):
+        flights = flight.SingleFlight()
+        calls = []
+
+        async def slow():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "result"
+
+        async def main():
+            return await asyncio.gather(
+                *(flights.acall("key", slow) for _ in range(4))
+            )
+
+        results = asyncio.run(main())
+        assert_that(calls).is_length(1)
+        assert_that(sorted(shared for _, shared in results)).is_equal_to(
+            [False, True, True, True]
+        )
+
+    def test_cancelled_caller_does_not_cancel_the_call(self):
+        flights = flight.SingleFlight()
+
+        async def slow():
+            await asyncio.sleep(0.05)
+            return "result"
+
+        async def main():
+            first = asyncio.ensure_future(flights.acall("key", slow))
+            second = asyncio.ensure_future(flights.acall("key", slow))
+            await asyncio.sleep(0.01)
+            first.cancel()
+            return await second
+
+        assert_that(asyncio.run(main())).is_equal_to(("result", True))
+
+    def test_asynchronous_stream_is_replayed_to_every_caller(self):
+        flights = flight.SingleFlight()
+
+        async def stream():
+            for delta in "abc":
+                await asyncio.sleep(0.01)
+                yield delta
+
+        async def start():
+            return stream()
+
+        async def call():
+            deltas, _ = await flights.acall("key", start)
+            return "".join([delta async for delta in deltas])
+
+        async def main():
+            return await asyncio.gather(*(call() for _ in range(3)))
+
+        assert_that(asyncio.run(main())).is_equal_to(["abc"] * 3)
+
+
+class TestCoalescedConversations(unittest.TestCase):
+    def build_conversations(self, count: int, backend: FakeBackend):
+        interaction = Interaction()
+        scheduler = Scheduler(coalesce=True)
+        conversations = [
+            conversation.Conversation(
+                backend=backend,
+                scheduler=scheduler,
+                listeners=[interaction.add_call],
+            )
+            for _ in range(count)
+        ]
+        return conversations, interaction
+
+    def test_identical_questions_make_one_request(self):
+        backend = FakeBackend(latency=0.1)
+        conversations, interaction = self.build_conversations(3, backend)
+        prompt = conversation.Message("user", "Hello")
+        run_together([lambda c=c: c.send(prompt) for c in conversations])
+        assert_that(backend.requests).is_equal_to(1)
+        replies = [c.last for c in conversations]
+        assert_that({reply.content for reply in replies}).is_length(1)
+        assert_that(
+            [reply.cached for reply in replies].count(True)
+        ).is_equal_to(2)
+        assert_that(interaction.shared_calls).is_equal_to(2)
+        assert_that(interaction.tokens).is_equal_to(replies[0].cost.total)
+
+    def test_identical_streams_make_one_request(self):
+        backend = FakeBackend(latency=0.05, token_interval=0.01)
+        conversations, interaction = self.build_conversations(3, backend)
+        prompt = conversation.Message("user", "Hello there")
+
+        async def main():
+            async def ask(new_conversation):
+                return "".join(
+                    [delta async for delta in new_conversation.astream(prompt)]
+                )
+
+            return await asyncio.gather(*(ask(c) for c in conversations))
+
+        replies = asyncio.run(main())
+        assert_that(backend.requests).is_equal_to(1)
+        assert_that(set(replies)).is_length(1)
+        assert_that(interaction.shared_calls).is_equal_to(2)
+
+    def test_different_questions_are_not_coalesced(self):
+        backend = FakeBackend(latency=0.05)
+        conversations, interaction = self.build_conversations(2, backend)
+        run_together(
+            [
+                lambda c=c, i=i: c.send(
+                    conversation.Message("user", f"Question {i}")
+                )
+                for i, c in enumerate(conversations)
+            ]
+        )
+        assert_that(backend.requests).is_equal_to(2)
+        assert_that(interaction.shared_calls).is_zero()
@@ -0,0 +1,118 @@
+import gc
+import tracemalloc
+import unittest
+
+from assertpy import assert_that
+
+from wrapgpt import conversation, cost, history, window
+from wrapgpt.backend import FakeBackend
+from wrapgpt.compaction import Compactor
+from wrapgpt.scheduler import Scheduler
+
+
+def build_messages(count: int) -> list[conversation.Message]:
+    return [
+        conversation.Message(
+            "user" if index % 2 == 0 else "assistant",
+            f"Message {index} – ünïcode",
+            cost.Cost(index, 2 * index),
+            cached=index % 3 == 0,
+        )
+        for index in range(count)
+    ]
+
+
+def as_tuples(messages) -> list[tuple]:
+    return [(m.role, m.content, m.cost, m.cached, m.tokens) for m in messages]
+
+
+class TestPackedHistory(unittest.TestCase):
+    def test_views_match_messages(self):
+        messages = build_messages(6)
+        packed = history.PackedHistory(messages)
+        assert_that(packed).is_length(6)
+        assert_that(as_tuples(packed)).is_equal_to(as_tuples(messages))
+        assert_that(packed[-1].dict).is_equal_to(messages[-1].dict)
+        assert_that(packed.total_tokens).is_equal_to(
+            sum(m.tokens for m in messages)
+        )
+
+    def test_slices_are_packed(self):
+        messages = build_messages(6)
+        packed = history.PackedHistory(messages)
+        assert_that(packed[2:]).is_instance_of(history.PackedHistory)
+        assert_that(as_tuples(packed[2:5])).is_equal_to(
+            as_tuples(messages[2:5])
+        )
+        assert_that(as_tuples(packed[::2])).is_equal_to(
+            as_tuples(messages[::2])
+        )
+        assert_that(packed[4:2]).is_empty()
+
+    def test_spilled_contents_are_read_back(self):
+        messages = build_messages(50)
+        packed = history.PackedHistory(spill_bytes=64)
+        packed.extend(messages)
+        assert_that(packed._spilled).is_positive()
+        assert_that(packed.nbytes).is_less_than(
+            history.PackedHistory(messages).nbytes
+        )
+        assert_that(as_tuples(packed)).is_equal_to(as_tuples(messages))
+        assert_that(as_tuples(packed[10:40])).is_equal_to(
+            as_tuples(messages[10:40])
+        )
+        packed.close()
+
+    def test_new_roles_are_interned(self):
+        packed = history.PackedHistory([conversation.Message("tool", "x")])
+        assert_that(packed[0].role).is_equal_to("tool")
+        assert_that(history.ROLES).contains("tool")
+
+    def test_takes_less_memory_than_a_list(self):
+        build_messages(1)[0].tokens
+        tracemalloc.start()
+        listed = build_messages(2000)
+        for message in listed:
+            message.tokens
+        list_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        tracemalloc.start()
+        packed = history.PackedHistory(build_messages(2000))
+        gc.collect()
+        packed_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        assert_that(packed).is_length(len(listed))
+        assert_that(packed_memory).is_less_than(list_memory // 3)
+
+
+class TestPackedConversation(unittest.TestCase):
+    def build_conversation(self, **options) -> conversation.Conversation:
+        return conversation.Conversation(
+            backend=FakeBackend(), scheduler=Scheduler(), **options
+        )
+
+    def test_same_requests_as_a_list(self):
+        for options in ({}, {"window": window.DropOldestTurns(max_tokens=60)}):
+            listed = self.build_conversation(**options)
+            packed = self.build_conversation(packed=True, **options)
+            for turn in range(5):
+                prompt = conversation.Message("user", f"Question {turn}")
+                listed.send(prompt)
+                packed.send(prompt)
+            assert_that(packed.messages).is_instance_of(history.PackedHistory)
+            assert_that(packed.dict).is_equal_to(listed.dict)
+            assert_that(packed.tokens).is_equal_to(listed.tokens)
+            assert_that(packed.cost).is_equal_to(listed.cost)
+
+    def test_reset_and_compaction_keep_history_packed(self):
+        packed = self.build_conversation(
+            packed=True, compactor=Compactor(threshold=10, keep=2)
+        )
+        for turn in range(3):
+            packed.send(conversation.Message("user", f"Question {turn}"))
+        assert_that(packed.compact()).is_not_none()
+        assert_that(packed.messages).is_instance_of(history.PackedHistory)
+        assert_that(packed.messages).is_length(2)
+        del packed.messages
+        assert_that(packed.messages).is_instance_of(history.PackedHistory)
+        assert_that(packed.messages).is_empty()
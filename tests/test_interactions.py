@@ -0,0 +1,94 @@
+import unittest
+
+import openai
+from assertpy import assert_that
+
+from wrapgpt import _prompt, interactions
+from wrapgpt.backend import FakeBackend
+from wrapgpt.cache import ResponseCache
+from wrapgpt.conversation import Conversation
+from wrapgpt.message import Message
+from wrapgpt.scheduler import Scheduler
+
+
+class FlakyBackend(FakeBackend):
+    """Fails the first request with a rate limit error."""
+
+    def complete(self, **request) -> Message:
+        if not self.requests:
+            self.requests += 1
+            raise openai.error.RateLimitError("Rate limit reached")
+        return super().complete(**request)
+
+
+class TestSessionInteractions(unittest.TestCase):
+    def test_add_call_updates_session_and_current(self):
+        session = interactions.SessionInteractions()
+        session.add_call(interactions.Call("gpt-3.5-turbo", 10, 5, 1.0, 0.5))
+        session.add_call(
+            interactions.Call("gpt-3.5-turbo", 10, 5, 0.0, 0.0, cached=True)
+        )
+        session.add_call(
+            interactions.Call(
+                "gpt-3.5-turbo", 3, 1, 1.0, 1.0, retries=2, suggestion=True
+            ),
+        )
+        session.finish_interaction()
+        session.add_call(interactions.Call("gpt-3.5-turbo", 1, 1, 2.0, 2.0))
+        assert_that(session.last.prompt_tokens).is_equal_to(10)
+        assert_that(session.last.completion_tokens).is_equal_to(5)
+        assert_that(session.last.cache_hits).is_equal_to(1)
+        assert_that(session.last.calls).is_equal_to(3)
+        assert_that(session.session.prompt_tokens).is_equal_to(11)
+        assert_that(session.session.completion_tokens).is_equal_to(6)
+        assert_that(session.session.retries).is_equal_to(2)
+        assert_that(session.session.average_latency).is_equal_to(1.0)
+        assert_that(session.current.prompt_tokens).is_equal_to(1)
+        assert_that(session.calls).is_length(4)
+
+    def test_suggestions_count_as_suggestion_tokens(self):
+        interaction = interactions.Interaction()
+        interaction.add_call(
+            interactions.Call("gpt-3.5-turbo", 3, 1, suggestion=True)
+        )
+        assert_that(interaction.suggestion_tokens).is_equal_to(4)
+        assert_that(interaction.prompt_tokens).is_equal_to(0)
+
+
+class TestConversationCalls(unittest.TestCase):
+    def setUp(self):
+        self.session = interactions.SessionInteractions()
+        self.conversation = Conversation(
+            scheduler=Scheduler(base_delay=0),
+            backend=FakeBackend(prompt_tokens=10, completion_tokens=5),
+        )
+        self.conversation.listeners.append(self.session.add_call)
+
+    def test_every_request_is_recorded_once(self):
+        self.conversation.send(Message("user", "Hello"))
+        "".join(self.conversation.stream(Message("user", "How are you?")))
+        suggest = getattr(_prompt, "__suggest_next_prompt")
+        suggest(self.conversation, _prompt.SuggestionMode.LAZY)
+        calls = list(self.session.calls)
+        assert_that(calls).is_length(3)
+        assert_that(calls[0].model).is_equal_to("gpt-3.5-turbo")
+        assert_that(calls[1].time_to_first_token).is_less_than_or_equal_to(
+            calls[1].latency
+        )
+        assert_that(calls[2].suggestion).is_true()
+        assert_that(self.session.current.prompt_tokens).is_equal_to(
+            calls[0].prompt_tokens + calls[1].prompt_tokens
+        )
+        assert_that(self.session.current.suggestion_tokens).is_equal_to(15)
+
+    def test_retries_and_cache_hits(self):
+        self.conversation.backend = FlakyBackend(prompt_tokens=10)
+        self.conversation.cache = ResponseCache()
+        self.conversation.send(Message("user", "Hello"))
+        del self.conversation.messages
+        self.conversation.send(Message("user", "Hello"))
+        first, second = self.session.calls
+        assert_that(first.retries).is_equal_to(1)
+        assert_that(second.cached).is_true()
+        assert_that(self.session.session.cache_hits).is_equal_to(1)
+        assert_that(self.session.session.prompt_tokens).is_equal_to(10)
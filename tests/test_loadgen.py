@@ -0,0 +1,98 @@
+import asyncio
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from assertpy import assert_that
+
+from wrapgpt import loadgen
+from wrapgpt.backend import FakeBackend
+from wrapgpt.scheduler import Scheduler
+
+
+def build_trace(sessions: int, turns: int, gap: float) -> list[loadgen.Turn]:
+    trace = [
+        loadgen.Turn(f"s{session}", turn * gap, f"Turn {turn}", turn % 2 == 1)
+        for session in range(sessions)
+        for turn in range(turns)
+    ]
+    trace.sort(key=lambda turn: turn.at)
+    return trace
+
+
+class TestTrace(unittest.TestCase):
+    def test_recorded_turns_are_read_in_order(self):
+        times = iter([10.0, 12.5, 11.0])
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "trace.jsonl"
+            recorder = loadgen.TraceRecorder(path, clock=lambda: next(times))
+            recorder.record("a", "Hello", stream=True)
+            recorder.record("b", "Hi")
+            trace = loadgen.read_trace(path)
+        assert_that(trace).is_equal_to(
+            [
+                loadgen.Turn("b", 1.0, "Hi"),
+                loadgen.Turn("a", 2.5, "Hello", True),
+            ]
+        )
+
+
+class TestReplay(unittest.TestCase):
+    def test_turns_keep_their_recorded_times(self):
+        trace = build_trace(sessions=3, turns=3, gap=0.1)
+        report = asyncio.run(loadgen.replay(trace, speedup=2.0))
+        assert_that(report.sessions).is_equal_to(3)
+        assert_that(report.turns).is_equal_to(9)
+        assert_that(report.latencies).is_length(9)
+        assert_that(report.elapsed).is_between(0.1, 0.2)
+        assert_that(report.token_error).is_zero()
+
+    def test_errors_are_retried_and_reported(self):
+        backend = FakeBackend(error_rate=0.3, seed=7)
+        report = asyncio.run(
+            loadgen.replay(
+                build_trace(sessions=5, turns=4, gap=0.0),
+                backend,
+                scheduler=Scheduler(max_retries=1, base_delay=0.001),
+            )
+        )
+        assert_that(report.retries).is_positive()
+        assert_that(report.failures + len(report.latencies)).is_equal_to(20)
+        assert_that(report.token_error).is_zero()
+
+    def test_token_accounting_error_is_measured(self):
+        backend = FakeBackend(completion_tokens=100)
+        trace = [loadgen.Turn("a", 0.0, "Hello there", stream=True)]
+        report = asyncio.run(loadgen.replay(trace, backend))
+        assert_that(report.backend_usage.completion_tokens).is_equal_to(100)
+        assert_that(report.token_error).is_close_to(0.98, 0.001)
+
+    def test_report_is_json(self):
+        report = asyncio.run(
+            loadgen.replay(build_trace(2, 2, 0.0), memory=True)
+        ).as_dict()
+        assert_that(json.loads(json.dumps(report))).is_equal_to(report)
+        assert_that(sum(report["latency"]["counts"])).is_equal_to(4)
+        assert_that(report["memory_per_session"]).is_positive()
+
+
+class TestRegressions(unittest.TestCase):
+    def setUp(self):
+        self.baseline = loadgen.LoadReport(
+            turns=2, elapsed=1.0, latencies=[0.1, 0.2]
+        ).as_dict()
+
+    def test_no_regression_within_the_tolerance(self):
+        report = loadgen.LoadReport(
+            turns=2, elapsed=1.05, latencies=[0.105, 0.21]
+        ).as_dict()
+        assert_that(loadgen.regressions(report, self.baseline)).is_empty()
+
+    def test_slower_run_regresses(self):
+        report = loadgen.LoadReport(
+            turns=2, elapsed=2.0, latencies=[0.1, 0.4], failures=1
+        ).as_dict()
+        found = loadgen.regressions(report, self.baseline)
+        assert_that(found).is_length(3)
+        assert_that(found[0]).starts_with("turns_per_second")
@@ -0,0 +1,152 @@
+import json
+import tempfile
+import unittest
+import urllib.request
+from pathlib import Path
+
+from assertpy import assert_that
+
+from fake_server import FakeServer
+from wrapgpt import metrics
+from wrapgpt.backend import FakeBackend
+from wrapgpt.conversation import Conversation
+from wrapgpt.interactions import Call
+from wrapgpt.message import Message
+from wrapgpt.scheduler import Scheduler
+from wrapgpt.window import LastTurns
+
+
+class FailingBackend(FakeBackend):
+    def complete(self, **request) -> Message:
+        raise RuntimeError("Backend is down")
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = metrics.Metrics()
+        self.conversation = Conversation(
+            window=LastTurns(1),
+            scheduler=Scheduler(),
+            backend=FakeBackend(prompt_tokens=10, completion_tokens=5),
+        )
+        self.conversation.listeners.append(self.metrics.add_call)
+
+    def test_conversation_requests_are_measured(self):
+        self.conversation.send(Message("user", "Hello"))
+        self.conversation.send(Message("user", "How are you?"))
+        labels = dict(model="gpt-3.5-turbo", kind="chat")
+        assert_that(
+            self.metrics.counter("wrapgpt_requests_total", **labels)
+        ).is_equal_to(2)
+        assert_that(
+            self.metrics.counter("wrapgpt_prompt_tokens_total", **labels)
+        ).is_equal_to(20)
+        assert_that(
+            self.metrics.counter("wrapgpt_truncations_total", **labels)
+        ).is_equal_to(1)
+        assert_that(
+            self.metrics.counter("wrapgpt_truncated_messages_total", **labels)
+        ).is_equal_to(2)
+
+    def test_errors_are_measured(self):
+        self.conversation.backend = FailingBackend()
+        assert_that(self.conversation.send).raises(
+            RuntimeError
+        ).when_called_with(Message("user", "Hello"))
+        assert_that(
+            self.metrics.counter(
+                "wrapgpt_errors_total",
+                model="gpt-3.5-turbo",
+                kind="chat",
+                error="RuntimeError",
+            )
+        ).is_equal_to(1)
+
+    def test_render_prometheus_text(self):
+        self.metrics.add_call(Call("gpt-4", 10, 5, latency=0.2))
+        text = self.metrics.render()
+        assert_that(text).contains(
+            'wrapgpt_requests_total{model="gpt-4",kind="chat"} 1'
+        )
+        bucket = 'wrapgpt_request_seconds_bucket{model="gpt-4",kind="chat"'
+        assert_that(text).contains(f'{bucket},le="0.1"}} 0')
+        assert_that(text).contains(f'{bucket},le="0.25"}} 1')
+        assert_that(text).contains(
+            'wrapgpt_request_seconds_count{model="gpt-4",kind="chat"} 1'
+        )
+
+    def test_render_help_and_type_once_per_metric(self):
+        self.metrics.add_call(Call("gpt-4", 10, 5, latency=0.2))
+        self.metrics.add_call(Call("gpt-3.5-turbo", 10, 5, latency=0.2))
+        lines = self.metrics.render().splitlines()
+        assert_that(lines[:2]).is_equal_to(
+            [
+                "# HELP wrapgpt_completion_tokens_total"
+                " Completion tokens of the replies.",
+                "# TYPE wrapgpt_completion_tokens_total counter",
+            ]
+        )
+        assert_that(lines).contains(
+            "# TYPE wrapgpt_requests_total counter",
+            "# TYPE wrapgpt_request_seconds histogram",
+        )
+        types = [
+            tuple(line.split()[2:]) for line in lines if line[:6] == "# TYPE"
+        ]
+        assert_that(types).does_not_contain_duplicates()
+        samples = {
+            line.split("{")[0] for line in lines if not line.startswith("#")
+        }
+        expected = set()
+        for name, kind in types:
+            if kind == "histogram":
+                expected.update(
+                    f"{name}_{s}" for s in ("bucket", "sum", "count")
+                )
+            else:
+                expected.add(name)
+        assert_that(samples).is_equal_to(expected)
+
+
+class TestSinks(unittest.TestCase):
+    def test_jsonl_sink(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "calls.jsonl"
+            sink = metrics.JSONLSink(path)
+            metrics.Metrics([sink]).add_call(Call("gpt-4", 10, 5, cached=True))
+            sink.close()
+            (record,) = map(json.loads, path.read_text().splitlines())
+        assert_that(record).contains_entry(
+            {"model": "gpt-4"}, {"cached": True}
+        )
+
+    def test_otlp_sink(self):
+        with FakeServer() as server:
+            sink = metrics.OTLPSink(f"{server.url}/traces", flush_interval=60)
+            metrics.Metrics([sink]).add_call(
+                Call("gpt-4", 10, 5, latency=0.2, error="Timeout")
+            )
+            sink.close()
+        (payload,) = server.requests
+        (span,) = payload["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        assert_that(span["name"]).is_equal_to("chat")
+        assert_that(span["status"]).is_equal_to(
+            {"code": 2, "message": "Timeout"}
+        )
+
+    def test_prometheus_sink(self):
+        registry = metrics.Metrics()
+        sink = metrics.PrometheusSink(registry, port=0)
+        registry.sinks.append(sink)
+        try:
+            registry.add_call(Call("gpt-4", 10, 5))
+            host, port = sink.address
+            url = f"http://{host}:{port}/metrics"
+            with urllib.request.urlopen(url) as response:
+                text = response.read().decode("utf-8")
+        finally:
+            registry.close()
+        assert_that(text).contains("wrapgpt_requests_total")
+
+    def test_disabled_without_sinks(self):
+        assert_that(metrics.open_metrics()).is_none()
@@ -0,0 +1,108 @@
+import unittest
+
+from assertpy import assert_that
+
+from wrapgpt import conversation, prefix, window
+from wrapgpt.tokens import TOKENS_PER_REPLY
+
+
+def build_messages(count: int) -> list[conversation.Message]:
+    return [
+        conversation.Message(
+            "user" if index % 2 == 0 else "assistant", f"Message {index}"
+        )
+        for index in range(count)
+    ]
+
+
+class TestPrefix(unittest.TestCase):
+    def test_digest_does_not_depend_on_the_prefix(self):
+        messages = build_messages(5)
+        payload = [message.dict for message in messages]
+        whole = prefix.Prefix().extend(messages)
+        for size in range(len(messages) + 1):
+            start = prefix.Prefix().extend(messages[:size])
+            assert_that(start.digest(payload)).is_equal_to(whole.hash)
+        assert_that(whole.size).is_equal_to(5)
+        assert_that(whole.tokens).is_equal_to(
+            sum(message.tokens for message in messages)
+        )
+
+    def test_key_changes_with_the_messages(self):
+        messages = build_messages(3)
+        start = prefix.Prefix().extend(messages[:1])
+        request = dict(model="gpt-4", messages=[m.dict for m in messages])
+        other = dict(request, messages=request["messages"][:2])
+        assert_that(start.key(request)).is_not_equal_to(start.key(other))
+        assert_that(start.key(request)).is_not_equal_to(
+            start.key(dict(request, model="gpt-3.5-turbo"))
+        )
+
+
+class TestConversationPrefix(unittest.TestCase):
+    def test_prefix_grows_with_the_history(self):
+        new_conversation = conversation.Conversation()
+        new_conversation.context = conversation.Message("system", "Be brief")
+        messages = build_messages(4)
+        for message in messages:
+            new_conversation.add_message(message)
+        expected = prefix.Prefix().extend(
+            [new_conversation.context, *messages]
+        )
+        assert_that(new_conversation.prefix).is_equal_to(expected)
+        new_conversation.add_message(conversation.Message("user", "More"))
+        assert_that(new_conversation.prefix.size).is_equal_to(6)
+        assert_that(new_conversation.tokens).is_equal_to(
+            TOKENS_PER_REPLY + new_conversation.prefix.tokens
+        )
+
+    def test_prefix_is_rebuilt_when_its_start_changes(self):
+        new_conversation = conversation.Conversation()
+        for message in build_messages(2):
+            new_conversation.add_message(message)
+        before = new_conversation.prefix
+        new_conversation.context = conversation.Message("system", "Be brief")
+        assert_that(new_conversation.prefix.hash).is_not_equal_to(before.hash)
+        assert_that(new_conversation.prefix.size).is_equal_to(3)
+        del new_conversation.messages
+        assert_that(new_conversation.prefix.size).is_equal_to(1)
+
+    def test_window_keeps_only_the_context_in_the_prefix(self):
+        windowed = conversation.Conversation(
+            window=window.DropOldestTurns(max_tokens=1000)
+        )
+        whole = conversation.Conversation()
+        for new_conversation in (windowed, whole):
+            new_conversation.context = conversation.Message("system", "Hi")
+            for message in build_messages(4):
+                new_conversation.add_message(message)
+        assert_that(windowed.prefix.size).is_equal_to(1)
+        assert_that(windowed.dict).is_equal_to(whole.dict)
+        request = dict(model="gpt-4", messages=windowed.dict)
+        assert_that(windowed.prefix.key(request)).is_equal_to(
+            whole.prefix.key(request)
+        )
+        assert_that(windowed.tokens).is_equal_to(whole.tokens)
+
+    def test_turn_window_without_budget_counts_the_messages_sent(self):
+        conversations = {
+            turns: conversation.Conversation(
+                window=window.LastTurns(turns=turns)
+            )
+            for turns in (1, 2)
+        }
+        for new_conversation in conversations.values():
+            for message in build_messages(100):
+                new_conversation.add_message(message)
+        sent = conversations[1].dict
+        assert_that(sent).is_length(2)
+        assert_that(conversations[1].tokens).is_equal_to(
+            TOKENS_PER_REPLY + sum(m.tokens for m in build_messages(100)[-2:])
+        )
+        keys = {
+            turns: new_conversation.prefix.key(
+                dict(model="gpt-4", messages=new_conversation.dict)
+            )
+            for turns, new_conversation in conversations.items()
+        }
+        assert_that(keys[1]).is_not_equal_to(keys[2])
@@ -0,0 +1,172 @@
+import asyncio
+import time
+import unittest
+
+from assertpy import assert_that
+
+from wrapgpt import conversation, racing
+from wrapgpt.backend import FakeBackend
+from wrapgpt.interactions import Interaction
+from wrapgpt.scheduler import Scheduler
+
+
+def fail(messages: list[dict]) -> str:
+    raise ValueError("Backend down")
+
+
+class TestLatencyTracker(unittest.TestCase):
+    def test_default_until_enough_samples(self):
+        tracker = racing.LatencyTracker(min_samples=3, default=2.0)
+        tracker.add(0.1)
+        tracker.add(0.2)
+        assert_that(tracker.deadline()).is_equal_to(2.0)
+
+    def test_percentile_of_the_window(self):
+        tracker = racing.LatencyTracker(0.95, window=100, min_samples=1)
+        for millisecond in range(200):
+            tracker.add(millisecond / 1000)
+        assert_that(tracker.deadline()).is_equal_to(0.194)
+
+
+class TestRacer(unittest.TestCase):
+    def setUp(self):
+        self.slow = FakeBackend(latency=0.3)
+        self.fast = FakeBackend()
+        self.interaction = Interaction()
+
+    def build_conversation(self, racer, backend=None):
+        return conversation.Conversation(
+            backend=backend or self.slow,
+            scheduler=Scheduler(),
+            racer=racer,
+            listeners=[self.interaction.add_call],
+        )
+
+    def test_fastest_route_wins(self):
+        racer = racing.Racer([racing.Route(self.fast, "gpt-4")])
+        new_conversation = self.build_conversation(racer)
+        prompt = conversation.Message("user", "Hello")
+        start = time.perf_counter()
+        reply = new_conversation.send(prompt)
+        assert_that(time.perf_counter() - start).is_less_than(0.25)
+        assert_that(reply.content).is_equal_to("Hello")
+        tokens = new_conversation.messages[0].tokens
+        lost = new_conversation.lost_cost
+        assert_that(lost.prompt_tokens).is_greater_than(tokens)
+        assert_that(new_conversation.cost).is_equal_to(
+            prompt.cost + reply.cost + lost
+        )
+        assert_that(self.interaction.lost_tokens).is_equal_to(lost.total)
+
+    def test_losers_still_running_are_billed_at_the_next_request(self):
+        racer = racing.Racer([racing.Route(self.fast, "gpt-4")])
+        new_conversation = self.build_conversation(racer)
+        new_conversation.send(conversation.Message("user", "Hello"))
+        estimate = new_conversation.lost_cost
+        assert_that(estimate.completion_tokens).is_zero()
+        time.sleep(0.5)
+        assert_that(new_conversation.lost_cost).is_equal_to(estimate)
+        usage = self.slow.usage
+        new_conversation.racer = None
+        new_conversation.send(conversation.Message("user", "Bye"))
+        lost = new_conversation.lost_cost
+        assert_that(lost.completion_tokens).is_equal_to(
+            usage.completion_tokens
+        )
+        assert_that(lost.prompt_tokens).is_equal_to(
+            max(estimate.prompt_tokens, usage.prompt_tokens)
+        )
+
+    def test_winning_model_is_recorded(self):
+        calls = []
+        racer = racing.Racer([racing.Route(self.fast, "gpt-4")])
+        new_conversation = self.build_conversation(racer)
+        new_conversation.listeners.append(calls.append)
+        new_conversation.send(conversation.Message("user", "Hello"))
+        assert_that(calls[0].model).is_equal_to("gpt-4")
+        assert_that(calls[0].raced).is_equal_to(2)
+        assert_that(calls[0].lost_usage).contains_only("gpt-3.5-turbo")
+        assert_that(calls[0].lost_usage["gpt-3.5-turbo"].total).is_equal_to(
+            calls[0].lost_tokens
+        )
+
+    def test_failed_route_loses(self):
+        racer = racing.Racer([racing.Route(FakeBackend(reply=fail))])
+        new_conversation = self.build_conversation(racer)
+        reply = new_conversation.send(conversation.Message("user", "Hello"))
+        assert_that(reply.content).is_equal_to("Hello")
+        assert_that(new_conversation.lost_cost.total).is_zero()
+
+    def test_error_when_every_route_fails(self):
+        racer = racing.Racer([racing.Route(FakeBackend(reply=fail))])
+        new_conversation = self.build_conversation(
+            racer, FakeBackend(reply=fail)
+        )
+        with self.assertRaises(ValueError):
+            new_conversation.send(conversation.Message("user", "Hello"))
+        assert_that(self.interaction.errors).is_equal_to(1)
+
+    def test_streams_race_to_the_first_token(self):
+        racer = racing.Racer([racing.Route(self.fast)])
+        new_conversation = self.build_conversation(racer)
+        prompt = conversation.Message("user", "Hello there")
+        deltas = list(new_conversation.stream(prompt))
+        assert_that("".join(deltas)).is_equal_to("Hello there")
+        assert_that(new_conversation.last.content).is_equal_to("Hello there")
+        assert_that(new_conversation.lost_cost.total).is_positive()
+
+    def test_hedge_waits_for_the_deadline(self):
+        racer = racing.Racer(
+            [racing.Route(self.fast)], hedge=True, default_deadline=0.1
+        )
+        new_conversation = self.build_conversation(racer, FakeBackend())
+        new_conversation.send(conversation.Message("user", "Hello"))
+        assert_that(self.fast.requests).is_zero()
+        assert_that(new_conversation.lost_cost.total).is_zero()
+
+    def test_hedge_duplicates_slow_requests(self):
+        racer = racing.Racer(
+            [racing.Route(self.fast)], hedge=True, default_deadline=0.05
+        )
+        new_conversation = self.build_conversation(racer)
+        start = time.perf_counter()
+        new_conversation.send(conversation.Message("user", "Hello"))
+        assert_that(time.perf_counter() - start).is_less_than(0.25)
+        assert_that(self.fast.requests).is_equal_to(1)
+
+    def test_asynchronous_race(self):
+        racer = racing.Racer([racing.Route(self.fast, "gpt-4")])
+        new_conversation = self.build_conversation(racer)
+
+        async def main():
+            reply = await new_conversation.asend(
+                conversation.Message("user", "Hello")
+            )
+            deltas = [
+                delta
+                async for delta in new_conversation.astream(
+                    conversation.Message("user", "Hello there")
+                )
+            ]
+            return reply, deltas
+
+        start = time.perf_counter()
+        reply, deltas = asyncio.run(main())
+        assert_that(time.perf_counter() - start).is_less_than(0.25)
+        assert_that(reply.content).is_equal_to("Hello")
+        assert_that("".join(deltas)).is_equal_to("Hello there")
+        assert_that(self.slow.requests).is_zero()
+        assert_that(new_conversation.lost_cost.total).is_positive()
+
+    def test_asynchronous_hedge_falls_back_on_failure(self):
+        racer = racing.Racer(
+            [racing.Route(self.fast)], hedge=True, default_deadline=10
+        )
+        new_conversation = self.build_conversation(
+            racer, FakeBackend(reply=fail)
+        )
+        reply = asyncio.run(
+            new_conversation.asend(conversation.Message("user", "Hello"))
+        )
+        assert_that(reply.content).is_equal_to("Hello")
+        assert_that(self.fast.requests).is_equal_to(1)
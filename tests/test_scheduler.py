@@ -0,0 +1,136 @@
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+import openai
+from assertpy import assert_that, fail
+
+from fake_server import FakeServer
+from wrapgpt import conversation, scheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_burst_then_pace(self):
+        clock = FakeClock()
+        bucket = scheduler.TokenBucket(60, clock)
+        assert_that(bucket.reserve(60)).is_equal_to(0)
+        assert_that(bucket.reserve(1)).is_close_to(1, 1e-9)
+        assert_that(bucket.reserve(1)).is_close_to(2, 1e-9)
+        clock.now = 10
+        assert_that(bucket.reserve(1)).is_equal_to(0)
+
+    def test_invalid_rate(self):
+        try:
+            scheduler.TokenBucket(0)
+            fail("Should have raised an exception")
+        except ValueError as e:
+            assert_that(str(e)).contains("must be positive")
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer().__enter__()
+        patcher = mock.patch.multiple(
+            openai, api_base=self.server.url, api_key="test"
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.server.__exit__)
+
+    def send(self, request_scheduler: scheduler.Scheduler) -> str:
+        new_conversation = conversation.Conversation(
+            scheduler=request_scheduler
+        )
+        reply = new_conversation.send(conversation.Message("user", "Hello"))
+        return reply.content
+
+    def test_honors_retry_after(self):
+        self.server.failures = [(429, {"Retry-After": "0.2"})]
+        request_scheduler = scheduler.Scheduler(base_delay=0)
+        start = time.monotonic()
+        assert_that(self.send(request_scheduler)).is_equal_to("olleH")
+        assert_that(time.monotonic() - start).is_greater_than_or_equal_to(0.2)
+        assert_that(request_scheduler.retries).is_equal_to(1)
+        assert_that(self.server.requests).is_length(2)
+
+    def test_retries_server_errors_with_backoff(self):
+        self.server.failures = [(500, {}), (503, {})]
+        request_scheduler = scheduler.Scheduler(base_delay=0.01)
+        assert_that(self.send(request_scheduler)).is_equal_to("olleH")
+        assert_that(request_scheduler.retries).is_equal_to(2)
+
+    def test_gives_up_after_max_retries(self):
+        self.server.failures = [(503, {})] * 3
+        request_scheduler = scheduler.Scheduler(max_retries=2, base_delay=0)
+        try:
+            self.send(request_scheduler)
+            fail("Should have raised an exception")
+        except openai.error.ServiceUnavailableError:
+            pass
+        assert_that(self.server.requests).is_length(3)
+
+    def test_does_not_retry_invalid_requests(self):
+        self.server.failures = [(400, {})]
+        request_scheduler = scheduler.Scheduler(base_delay=0)
+        try:
+            self.send(request_scheduler)
+            fail("Should have raised an exception")
+        except openai.error.InvalidRequestError:
+            pass
+        assert_that(request_scheduler.retries).is_equal_to(0)
+
+    def test_paces_requests_per_minute(self):
+        request_scheduler = scheduler.Scheduler(requests_per_minute=600)
+        request_scheduler._requests.reserve(600)
+        start = time.monotonic()
+        self.send(request_scheduler)
+        assert_that(time.monotonic() - start).is_greater_than_or_equal_to(0.1)
+
+    def test_every_attempt_takes_from_the_limits(self):
+        for asynchronous in (False, True):
+            self.server.failures = [(503, {}), (502, {})]
+            request_scheduler = scheduler.Scheduler(
+                requests_per_minute=6000,
+                tokens_per_minute=600_000,
+                base_delay=0,
+            )
+            buckets = (request_scheduler._requests, request_scheduler._tokens)
+            with mock.patch.object(
+                buckets[0], "reserve", wraps=buckets[0].reserve
+            ) as requests, mock.patch.object(
+                buckets[1], "reserve", wraps=buckets[1].reserve
+            ) as tokens:
+                new_conversation = conversation.Conversation(
+                    scheduler=request_scheduler
+                )
+                message = conversation.Message("user", "Hello")
+                if asynchronous:
+                    asyncio.run(new_conversation.asend(message))
+                else:
+                    new_conversation.send(message)
+            assert_that(requests.call_count).is_equal_to(3)
+            assert_that(tokens.call_count).is_equal_to(3)
+
+    def test_retries_asynchronous_requests(self):
+        self.server.failures = [(429, {"Retry-After": "0"}), (502, {})]
+        request_scheduler = scheduler.Scheduler(base_delay=0)
+        new_conversation = conversation.Conversation(
+            scheduler=request_scheduler
+        )
+
+        async def send():
+            return await new_conversation.asend(
+                conversation.Message("user", "Hello")
+            )
+
+        assert_that(asyncio.run(send()).content).is_equal_to("olleH")
+        assert_that(request_scheduler.retries).is_equal_to(2)
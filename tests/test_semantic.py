@@ -0,0 +1,113 @@
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from assertpy import assert_that
+
+from wrapgpt import conversation, cost, semantic
+from wrapgpt.backend import FakeBackend
+from wrapgpt.scheduler import Scheduler
+
+PAIRS = [
+    (
+        "How do I reverse a list in Python?",
+        "how can I reverse a python list",
+        True,
+    ),
+    (
+        "How do I reverse a list in Python?",
+        "How do I sort a list in Python?",
+        False,
+    ),
+    ("What is the capital of France?", "what's the capital of france", True),
+    ("What is the capital of France?", "What is the capital of Spain?", False),
+    ("Write a haiku about autumn", "write a haiku about autumn please", True),
+    ("Write a haiku about autumn", "Write a haiku about spring", False),
+    ("What is 2 + 2?", "What is 2 + 3?", False),
+]
+
+
+def ask(question: str, context: str = "", model: str = "gpt-3.5-turbo"):
+    messages = [{"role": "system", "content": context}] if context else []
+    messages.append({"role": "user", "content": question})
+    return dict(model=model, messages=messages)
+
+
+class TestSemanticCache(unittest.TestCase):
+    def test_embeddings_are_unit_vectors(self):
+        vector = semantic.embed("Reverse a list")
+        assert_that(semantic.similarity(vector, vector)).is_close_to(1, 1e-9)
+        assert_that(semantic.embed("how is it")).is_empty()
+
+    def test_paraphrase_hits_and_other_question_misses(self):
+        cache = semantic.SemanticCache()
+        reply = conversation.Message("assistant", "Paris", cost.Cost(10, 2))
+        cache.put(ask("What is the capital of France?"), reply)
+        hit = cache.get(ask("what's the capital of france"))
+        assert_that(hit.content).is_equal_to("Paris")
+        assert_that(hit.cost).is_equal_to(cost.Cost(10, 2))
+        assert_that(hit.cached).is_true()
+        assert_that(cache.get(ask("What is the capital of Spain?"))).is_none()
+        assert_that(cache.hit_rate).is_equal_to(0.5)
+
+    def test_context_and_model_scope_the_replies(self):
+        cache = semantic.SemanticCache()
+        reply = conversation.Message("assistant", "Paris")
+        cache.put(ask("Capital of France?", context="Be brief"), reply)
+        question = "Capital of France?"
+        assert_that(cache.get(ask(question, "Be brief"))).is_not_none()
+        assert_that(cache.get(ask(question))).is_none()
+        assert_that(cache.get(ask(question, "Be brief", "gpt-4"))).is_none()
+
+    def test_least_recently_used_question_is_evicted(self):
+        cache = semantic.SemanticCache(max_size=2)
+        for question in ["Capital of France", "Capital of Spain"]:
+            cache.put(ask(question), conversation.Message("assistant", "?"))
+        cache.get(ask("Capital of France"))
+        cache.put(ask("Capital of Italy"), conversation.Message("user", "?"))
+        assert_that(cache).is_length(2)
+        assert_that(cache.get(ask("Capital of Spain"))).is_none()
+        assert_that(cache.get(ask("Capital of France"))).is_not_none()
+
+    def test_expired_reply_is_not_returned(self):
+        cache = semantic.SemanticCache(ttl=60)
+        cache.put(ask("Capital of France"), conversation.Message("user", "?"))
+        with mock.patch("time.time", return_value=time.time() + 61):
+            assert_that(cache.get(ask("Capital of France"))).is_none()
+        assert_that(cache).is_empty()
+
+    def test_disk_copy_survives_restarts(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "semantic.db"
+            cache = semantic.SemanticCache(path=path, max_size=1)
+            for question in ["Capital of France", "Capital of Spain"]:
+                reply = conversation.Message("assistant", question)
+                cache.put(ask(question), reply)
+            cache.close()
+            cache = semantic.SemanticCache(path=path)
+            assert_that(cache).is_length(1)
+            hit = cache.get(ask("capital of spain?"))
+            assert_that(hit.content).is_equal_to("Capital of Spain")
+            cache.close()
+
+    def test_offline_evaluation(self):
+        evaluation = semantic.evaluate(PAIRS, threshold=0.8)
+        assert_that(evaluation.paraphrases).is_equal_to(3)
+        assert_that(evaluation.hit_rate).is_equal_to(1.0)
+        assert_that(evaluation.false_hit_rate).is_equal_to(0.0)
+        loose = semantic.evaluate(PAIRS, threshold=0.5)
+        assert_that(loose.false_hits).is_equal_to(3)
+
+    def test_conversation_reuses_replies_to_paraphrases(self):
+        backend = FakeBackend(reply=lambda messages: "Paris")
+        cache = semantic.SemanticCache()
+        for question in ["Capital of France?", "capital of france"]:
+            new_conversation = conversation.Conversation(
+                backend=backend, scheduler=Scheduler(), semantic_cache=cache
+            )
+            new_conversation.send(conversation.Message("user", question))
+        assert_that(backend.requests).is_equal_to(1)
+        assert_that(new_conversation.last.cached).is_true()
+        assert_that(new_conversation.last.content).is_equal_to("Paris")
@@ -0,0 +1,279 @@
+import asyncio
+import json
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from aiohttp.test_utils import TestClient, TestServer
+from assertpy import assert_that
+
+from wrapgpt import server
+from wrapgpt.backend import FakeBackend
+from wrapgpt.conversation import Conversation
+from wrapgpt.loadgen import TraceRecorder, read_trace
+from wrapgpt.scheduler import Scheduler
+from wrapgpt.store import JSONLStore
+
+
+class TestSessions(unittest.IsolatedAsyncioTestCase):
+    async def start(self, **options) -> TestClient:
+        options.setdefault("backend", FakeBackend())
+        options.setdefault("scheduler", Scheduler())
+        client = TestClient(TestServer(server.build_app(**options)))
+        await client.start_server()
+        self.addAsyncCleanup(client.close)
+        return client
+
+    async def create(self, client: TestClient, **body) -> str:
+        response = await client.post("/sessions", json=body)
+        assert_that(response.status).is_equal_to(201)
+        return (await response.json())["id"]
+
+    async def test_send_and_stats(self):
+        client = await self.start()
+        session_id = await self.create(client, context="Be brief")
+        response = await client.post(
+            f"/sessions/{session_id}/messages", json={"content": "Hello"}
+        )
+        assert_that(await response.json()).contains_entry(
+            {"content": "Hello"}, {"cached": False}
+        )
+        stats = await (await client.get(f"/sessions/{session_id}")).json()
+        assert_that(stats["messages"]).is_equal_to(2)
+        stats = await (await client.get("/stats")).json()
+        assert_that(stats).contains_entry({"sessions": 1}, {"calls": 1})
+
+    async def test_stream(self):
+        client = await self.start()
+        session_id = await self.create(client)
+        response = await client.post(
+            f"/sessions/{session_id}/stream",
+            json={"content": "Hello there"},
+        )
+        events = (await response.text()).strip().split("\n\n")
+        deltas = [json.loads(event[len("data: ") :]) for event in events[:-1]]
+        assert_that(deltas).is_equal_to(
+            [{"delta": "Hello"}, {"delta": " there"}]
+        )
+        assert_that(events[-1]).starts_with("event: done")
+
+    async def test_turns_are_traced(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "trace.jsonl"
+            client = await self.start(trace=TraceRecorder(path))
+            session_id = await self.create(client)
+            for path_name in ("messages", "stream"):
+                response = await client.post(
+                    f"/sessions/{session_id}/{path_name}",
+                    json={"content": "Hello"},
+                )
+                await response.read()
+            trace = read_trace(path)
+        assert_that([turn.session for turn in trace]).is_equal_to(
+            [session_id, session_id]
+        )
+        assert_that([turn.stream for turn in trace]).is_equal_to([False, True])
+
+    async def test_websocket(self):
+        client = await self.start()
+        session_id = await self.create(client)
+        async with client.ws_connect(f"/sessions/{session_id}/ws") as socket:
+            await socket.send_str("Hello there")
+            frames = [await socket.receive_json() for _ in range(3)]
+        assert_that(frames[0]).is_equal_to({"delta": "Hello"})
+        assert_that(frames[2]["done"]["content"]).is_equal_to("Hello there")
+
+    async def test_errors(self):
+        client = await self.start()
+        response = await client.post(
+            "/sessions/unknown/messages", json={"content": "Hello"}
+        )
+        assert_that(response.status).is_equal_to(404)
+        session_id = await self.create(client)
+        response = await client.post(
+            f"/sessions/{session_id}/messages", json={"text": "Hello"}
+        )
+        assert_that(response.status).is_equal_to(400)
+
+    async def test_upstream_errors(self):
+        def unrecorded(messages):
+            raise LookupError("The request was not recorded.")
+
+        client = await self.start(
+            backend=FakeBackend(reply=unrecorded),
+            scheduler=Scheduler(max_retries=0),
+        )
+        session_id = await self.create(client)
+        response = await client.post(
+            f"/sessions/{session_id}/messages", json={"content": "Hello"}
+        )
+        assert_that(response.status).is_equal_to(502)
+        assert_that(await response.json()).is_equal_to(
+            {"error": "The request was not recorded.", "type": "LookupError"}
+        )
+        response = await client.post(
+            f"/sessions/{session_id}/stream", json={"content": "Hello"}
+        )
+        events = (await response.text()).strip().split("\n\n")
+        assert_that(events[-1]).starts_with("event: error")
+        async with client.ws_connect(f"/sessions/{session_id}/ws") as socket:
+            await socket.send_str("Hello")
+            frame = await socket.receive_json()
+        assert_that(frame).contains_entry({"type": "LookupError"})
+        stats = await (await client.get(f"/sessions/{session_id}")).json()
+        assert_that(stats["messages"]).is_equal_to(0)
+
+    async def test_overloaded_upstream(self):
+        client = await self.start(
+            backend=FakeBackend(error_rate=1.0),
+            scheduler=Scheduler(max_retries=0),
+        )
+        session_id = await self.create(client)
+        response = await client.post(
+            f"/sessions/{session_id}/messages", json={"content": "Hello"}
+        )
+        assert_that(response.status).is_equal_to(503)
+        assert_that(await response.json()).contains_entry(
+            {"type": "ServiceUnavailableError"}
+        )
+
+    async def test_backpressure(self):
+        client = await self.start(
+            backend=FakeBackend(latency=0.1), max_pending=1
+        )
+        first, second = await self.create(client), await self.create(client)
+        slow = asyncio.ensure_future(
+            client.post(f"/sessions/{first}/messages", json={"content": "A"})
+        )
+        await asyncio.sleep(0.05)
+        response = await client.post(
+            f"/sessions/{second}/messages", json={"content": "B"}
+        )
+        assert_that(response.status).is_equal_to(429)
+        assert_that((await slow).status).is_equal_to(200)
+
+    async def test_session_limit_without_store(self):
+        client = await self.start(max_sessions=1)
+        await self.create(client)
+        response = await client.post("/sessions")
+        assert_that(response.status).is_equal_to(503)
+
+    async def test_evicted_sessions_are_resumed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = JSONLStore(Path(directory) / "store.jsonl", 0)
+            client = await self.start(store=store, max_sessions=1)
+            first = await self.create(client)
+            await client.post(
+                f"/sessions/{first}/messages", json={"content": "Hello"}
+            )
+            await self.create(client)
+            stats = await (await client.get("/stats")).json()
+            assert_that(stats).contains_entry(
+                {"sessions": 1}, {"evictions": 1}
+            )
+            stats = await (await client.get(f"/sessions/{first}")).json()
+            assert_that(stats["messages"]).is_equal_to(2)
+            store.close()
+
+    async def test_evicted_session_is_resumed_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = JSONLStore(Path(directory) / "store.jsonl", 0)
+            client = await self.start(store=store, max_sessions=1)
+            first = await self.create(client)
+            await self.create(client)
+            resume_now = Conversation.resume
+
+            def slow_resume(*args, **kwargs):
+                time.sleep(0.05)
+                return resume_now(*args, **kwargs)
+
+            with mock.patch.object(
+                Conversation, "resume", side_effect=slow_resume
+            ) as resume:
+                responses = await asyncio.gather(
+                    *(client.get(f"/sessions/{first}") for _ in range(3))
+                )
+            assert_that([r.status for r in responses]).is_equal_to(
+                [200, 200, 200]
+            )
+            assert_that(resume.call_count).is_equal_to(1)
+            store.close()
+
+    async def test_evicted_sessions_are_forgotten_past_the_limit(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = JSONLStore(Path(directory) / "store.jsonl", 0)
+            sessions = server.SessionManager(
+                store, max_sessions=1, max_evicted=1
+            )
+            first, second, _ = (sessions.create() for _ in range(3))
+            with self.assertRaises(KeyError):
+                await sessions.get(first.conversation.id)
+            session = await sessions.get(second.conversation.id)
+            assert_that(session.conversation.id).is_equal_to(
+                second.conversation.id
+            )
+            store.close()
+
+    async def test_sessions_with_open_sockets_are_not_evicted(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = JSONLStore(Path(directory) / "store.jsonl", 0)
+            client = await self.start(store=store, idle_timeout=0.0)
+            session_id = await self.create(client)
+            url = f"/sessions/{session_id}/ws"
+            async with client.ws_connect(url) as socket:
+                await socket.send_str("Hello")
+                await socket.receive_json()
+                await socket.receive_json()
+                await asyncio.sleep(0.01)
+                await self.create(client)
+                stats = await (await client.get("/stats")).json()
+                assert_that(stats).contains_entry(
+                    {"sessions": 2}, {"evictions": 0}
+                )
+                await socket.send_str("Again")
+                await socket.receive_json()
+                reply = await socket.receive_json()
+            assert_that(reply["done"]["content"]).is_equal_to("Again")
+            stats = await (await client.get(f"/sessions/{session_id}")).json()
+            assert_that(stats["messages"]).is_equal_to(4)
+            store.close()
+
+    async def test_rejected_turns_are_not_traced(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "trace.jsonl"
+            client = await self.start(
+                backend=FakeBackend(latency=0.1),
+                max_pending=1,
+                trace=TraceRecorder(path),
+            )
+            first, second = await self.create(client), await self.create(
+                client
+            )
+            slow = asyncio.ensure_future(
+                client.post(
+                    f"/sessions/{first}/messages", json={"content": "A"}
+                )
+            )
+            await asyncio.sleep(0.05)
+            response = await client.post(
+                f"/sessions/{second}/messages", json={"content": "B"}
+            )
+            assert_that(response.status).is_equal_to(429)
+            await slow
+            trace = read_trace(path)
+        assert_that([turn.content for turn in trace]).is_equal_to(["A"])
+
+    def test_sessions_are_packed_on_demand(self):
+        for packed in (False, True):
+            options = {"packed": packed} if packed else {}
+            app = server.build_app(FakeBackend(), **options)
+            session = app[server.SERVER].sessions.create()
+            assert_that(session.conversation.packed).is_equal_to(packed)
+
+    async def test_load_test(self):
+        app = server.build_app(FakeBackend(), scheduler=Scheduler())
+        result = await server.load_test(app, sessions=20, turns=2)
+        assert_that(result["failures"]).is_equal_to(0)
+        assert_that(result["p99"]).is_positive()
@@ -0,0 +1,90 @@
+import json
+import os
+import subprocess
+import sys
+import time
+import unittest
+from pathlib import Path
+
+from assertpy import assert_that
+
+ROOT = Path(__file__).resolve().parent.parent
+FIRST_PROMPT = b"Ask me anything.:"
+# Regression thresholds, a few times the times measured on a single core:
+# about 0.15s to import the CLI and 0.25s to the first prompt.
+MAX_IMPORT_SECONDS = 0.75
+MAX_FIRST_PROMPT_SECONDS = 1.5
+LAZY_MODULES = ("openai", "aiohttp", "dotenv", "urllib.request")
+# Modules of the other commands, and of the options the chat may not use.
+COMMAND_MODULES = (
+    "rich",
+    "sqlite3",
+    "tracemalloc",
+    "wrapgpt.batch",
+    "wrapgpt.benchmark",
+    "wrapgpt.loadgen",
+    "wrapgpt.metrics",
+    "wrapgpt.semantic",
+    "wrapgpt.store",
+    "wrapgpt.usage",
+)
+
+
+def measure_import(
+    module: str = "main", lazy: tuple[str, ...] = LAZY_MODULES
+) -> dict:
+    script = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"lazy = [name for name in {lazy!r} if name in sys.modules]\n"
+        "print(json.dumps({'elapsed': elapsed, 'loaded': lazy}))\n"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=ROOT,
+        capture_output=True,
+        check=True,
+    ).stdout
+    return json.loads(output)
+
+
+def measure_first_prompt() -> float:
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "main.py", "chat", "--backend", "fake"],
+        cwd=ROOT,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        env={**os.environ, "COLUMNS": "80"},
+    )
+    output = b""
+    try:
+        while FIRST_PROMPT not in output:
+            chunk = os.read(process.stdout.fileno(), 4096)
+            if not chunk:
+                raise AssertionError(f"No prompt in {output!r}")
+            output += chunk
+        return time.perf_counter() - start
+    finally:
+        process.stdin.close()
+        process.wait(timeout=10)
+        process.stdout.close()
+
+
+class TestStartup(unittest.TestCase):
+    def test_import_defers_heavy_modules(self):
+        results = [measure_import() for _ in range(3)]
+        result = min(results, key=lambda result: result["elapsed"])
+        assert_that(result["loaded"]).is_empty()
+        assert_that(result["elapsed"]).is_less_than(MAX_IMPORT_SECONDS)
+
+    def test_cli_import_defers_the_other_commands(self):
+        result = measure_import("wrapgpt.cli", COMMAND_MODULES)
+        assert_that(result["loaded"]).is_empty()
+
+    def test_time_to_first_prompt(self):
+        elapsed = min(measure_first_prompt() for _ in range(3))
+        assert_that(elapsed).is_less_than(MAX_FIRST_PROMPT_SECONDS)
@@ -0,0 +1,230 @@
+import datetime
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+
+from assertpy import assert_that
+
+from wrapgpt import conversation, cost, interactions, store
+
+
+class StoreTests:
+    def open_store(self, path: Path) -> store.ConversationStore:
+        raise NotImplementedError
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = self.open_store(Path(self.directory.name))
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def build_conversation(self) -> conversation.Conversation:
+        new_conversation = conversation.Conversation(store=self.store)
+        new_conversation.context = conversation.Message(
+            role="system", content="You are a programmer"
+        )
+        new_conversation.add_message(
+            conversation.Message(role="user", content="Hello")
+        )
+        new_conversation.add_message(
+            conversation.Message(
+                role="assistant", content="Hi", cost=cost.Cost(10, 20)
+            )
+        )
+        new_conversation.add_suggestion_cost(cost.Cost(5, 1))
+        return new_conversation
+
+    def test_resume_conversation(self):
+        new_conversation = self.build_conversation()
+        resumed = conversation.Conversation.resume(
+            self.store, new_conversation.id
+        )
+        assert_that(resumed.dict).is_equal_to(new_conversation.dict)
+        assert_that(resumed.cost).is_equal_to(cost.Cost(15, 21))
+        assert_that(resumed.suggestion_cost).is_equal_to(cost.Cost(5, 1))
+
+    def test_resume_only_the_last_messages(self):
+        new_conversation = self.build_conversation()
+        resumed = conversation.Conversation.resume(
+            self.store, new_conversation.id, last=1
+        )
+        assert_that(resumed.context.content).is_equal_to(
+            "You are a programmer"
+        )
+        assert_that(resumed.messages).is_length(1)
+        assert_that(resumed.last.content).is_equal_to("Hi")
+        assert_that(resumed.cost.total).is_equal_to(36)
+
+    def test_resume_compacted_conversation(self):
+        new_conversation = self.build_conversation()
+        for index in range(3):
+            new_conversation.add_message(
+                conversation.Message(role="user", content=f"Message {index}")
+            )
+        summary = conversation.Message(
+            "system", "Summary", cost=cost.Cost(7, 3)
+        )
+        new_conversation._apply_summary(summary, 3)
+        new_conversation.add_message(
+            conversation.Message(role="user", content="Last")
+        )
+        resumed = conversation.Conversation.resume(
+            self.store, new_conversation.id
+        )
+        assert_that(resumed.dict).is_equal_to(new_conversation.dict)
+        assert_that(resumed.summary.content).is_equal_to("Summary")
+        assert_that(resumed.compaction_cost).is_equal_to(cost.Cost(7, 3))
+        assert_that(resumed.cost).is_equal_to(cost.Cost(22, 24))
+        last = conversation.Conversation.resume(
+            self.store, new_conversation.id, last=1
+        )
+        assert_that(last.messages).is_length(1)
+        assert_that(last.summary.content).is_equal_to("Summary")
+
+    def test_resume_after_a_message_was_popped(self):
+        new_conversation = self.build_conversation()
+        new_conversation.add_message(
+            conversation.Message("user", "Unanswered", cost.Cost(4, 0))
+        )
+        new_conversation.pop_message()
+        for last in (None, 1):
+            resumed = conversation.Conversation.resume(
+                self.store, new_conversation.id, last=last
+            )
+            assert_that(resumed.last.content).is_equal_to("Hi")
+            assert_that(resumed.cost).is_equal_to(cost.Cost(15, 21))
+
+    def test_resume_keeps_the_lost_cost(self):
+        new_conversation = self.build_conversation()
+        new_conversation.add_lost_cost(cost.Cost(4, 2))
+        resumed = conversation.Conversation.resume(
+            self.store, new_conversation.id
+        )
+        assert_that(resumed.lost_cost).is_equal_to(cost.Cost(4, 2))
+        assert_that(resumed.suggestion_cost).is_equal_to(cost.Cost(5, 1))
+        assert_that(resumed.cost).is_equal_to(cost.Cost(19, 23))
+
+    def test_resumed_conversation_keeps_recording(self):
+        new_conversation = self.build_conversation()
+        resumed = conversation.Conversation.resume(
+            self.store, new_conversation.id
+        )
+        del resumed.messages
+        del resumed.context
+        resumed.add_message(conversation.Message(role="user", content="Bye"))
+        resumed_again = conversation.Conversation.resume(
+            self.store, new_conversation.id
+        )
+        assert_that(resumed_again.dict).is_equal_to(
+            [{"role": "user", "content": "Bye"}]
+        )
+
+    def test_store_interactions(self):
+        session = interactions.SessionInteractions(store=self.store)
+        session.current.prompt_tokens = 10
+        session.finish_interaction()
+        session.current.completion_tokens = 20
+        session.finish_interaction()
+        stored = self.store.interactions()
+        assert_that(stored).is_length(2)
+        assert_that(stored[0].prompt_tokens).is_equal_to(10)
+        assert_that(stored[1].completion_tokens).is_equal_to(20)
+        assert_that(stored[1].end).is_not_none()
+
+    def test_interactions_round_trip(self):
+        interaction = interactions.Interaction(
+            prompt_tokens=1,
+            completion_tokens=2,
+            suggestion_tokens=3,
+            compaction_tokens=4,
+            cache_hits=5,
+            shared_calls=6,
+            lost_tokens=7,
+            calls=8,
+            errors=9,
+            retries=10,
+            latency=1.5,
+            time_to_first_token=0.25,
+            end=datetime.datetime.now(),
+        )
+        self.store.add_interaction(interaction)
+        assert_that(self.store.interactions()).is_equal_to([interaction])
+
+    def test_records_are_buffered_until_flushed(self):
+        new_conversation = self.build_conversation()
+        reopened = self.open_store(Path(self.directory.name))
+        try:
+            assert_that(reopened.load(new_conversation.id).messages).is_empty()
+            self.store.flush()
+            assert_that(reopened.load(new_conversation.id).messages).is_length(
+                2
+            )
+        finally:
+            reopened.close()
+
+
+class TestJSONLStore(StoreTests, unittest.TestCase):
+    def open_store(self, path: Path) -> store.ConversationStore:
+        return store.open_store(path / "conversations.jsonl", 60)
+
+
+class TestSQLiteStore(StoreTests, unittest.TestCase):
+    def open_store(self, path: Path) -> store.ConversationStore:
+        return store.open_store(path / "conversations.db", 60)
+
+    def test_interactions_of_older_versions_are_loaded(self):
+        path = Path(self.directory.name) / "old.db"
+        connection = sqlite3.connect(path)
+        with connection:
+            connection.execute(
+                "CREATE TABLE interactions (id TEXT PRIMARY KEY,"
+                " prompt_tokens INTEGER NOT NULL,"
+                " completion_tokens INTEGER NOT NULL,"
+                " suggestion_tokens INTEGER NOT NULL,"
+                " start TEXT NOT NULL, end TEXT)"
+            )
+            connection.execute(
+                "INSERT INTO interactions"
+                " VALUES ('old', 1, 2, 3, '2023-01-01T00:00:00', NULL)"
+            )
+        connection.close()
+        old_store = store.open_store(path, 0)
+        try:
+            interaction = interactions.Interaction(calls=4, latency=0.5)
+            old_store.add_interaction(interaction)
+            stored = old_store.interactions()
+        finally:
+            old_store.close()
+        assert_that(stored).is_length(2)
+        assert_that(stored[0].suggestion_tokens).is_equal_to(3)
+        assert_that(stored[0].calls).is_zero()
+        assert_that(stored[1]).is_equal_to(interaction)
+
+    def test_events_of_older_versions_are_loaded(self):
+        path = Path(self.directory.name) / "old.db"
+        connection = sqlite3.connect(path)
+        with connection:
+            connection.execute(
+                "CREATE TABLE events (seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " conversation TEXT NOT NULL, type TEXT NOT NULL, role TEXT,"
+                " content TEXT, prompt_tokens INTEGER NOT NULL DEFAULT 0,"
+                " completion_tokens INTEGER NOT NULL DEFAULT 0,"
+                " suggestion INTEGER NOT NULL DEFAULT 0,"
+                " cached INTEGER NOT NULL DEFAULT 0)"
+            )
+            connection.execute(
+                "INSERT INTO events (conversation, type, prompt_tokens,"
+                " completion_tokens) VALUES ('old', 'cost', 3, 1)"
+            )
+        connection.close()
+        old_store = store.open_store(path, 0)
+        try:
+            old_store.add_cost("old", cost.Cost(4, 2), lost=True)
+            stored = old_store.load("old")
+        finally:
+            old_store.close()
+        assert_that(stored.cost).is_equal_to(cost.Cost(7, 3))
+        assert_that(stored.lost_cost).is_equal_to(cost.Cost(4, 2))
@@ -0,0 +1,184 @@
+import unittest
+from unittest import mock
+
+from assertpy import assert_that
+
+from wrapgpt import conversation, tokens
+
+# Usage reported by the API for gpt-3.5-turbo.
+RECORDED_USAGE = [
+    ([{"role": "user", "content": "Say this is a test!"}], 13),
+    ([{"role": "user", "content": "Hello"}], 8),
+    (
+        [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": "Hello!"},
+        ],
+        19,
+    ),
+]
+
+# Usage of more varied prompts, counted with the cl100k_base encoding, which
+# gives the usage above.
+VARIED_USAGE = [
+    (
+        [
+            {"role": "system", "content": "You review Python code."},
+            {
+                "role": "user",
+                "content": (
+                    "def fibonacci(n: int) -> list[int]:\n"
+                    '    """Return the first n Fibonacci numbers."""\n'
+                    "    numbers = [0, 1]\n"
+                    "    while len(numbers) < n:\n"
+                    "        numbers.append(numbers[-1] + numbers[-2])\n"
+                    "    return numbers[:n]\n"
+                ),
+            },
+        ],
+        70,
+    ),
+    (
+        [
+            {
+                "role": "user",
+                "content": (
+                    "const total = items.reduce((sum, { price, qty }) => "
+                    "sum + price * qty, 0);\n"
+                    "console.log(`Total: ${total.toFixed(2)}`);"
+                ),
+            }
+        ],
+        43,
+    ),
+    (
+        [
+            {
+                "role": "user",
+                "content": "Pouvez-vous m'expliquer la différence entre une "
+                "liste et un tuple en Python ?",
+            }
+        ],
+        27,
+    ),
+    (
+        [
+            {
+                "role": "user",
+                "content": "Die Straßenbahnhaltestelle befindet sich "
+                "gegenüber dem Hauptbahnhof.",
+            }
+        ],
+        26,
+    ),
+    (
+        [
+            {
+                "role": "user",
+                "content": "Привет! Как дела? Расскажи мне, пожалуйста, о "
+                "погоде в Москве.",
+            }
+        ],
+        43,
+    ),
+    ([{"role": "user", "content": "请用简单的语言解释一下什么是机器学习。"}], 28),
+    ([{"role": "user", "content": "東京で一番おいしいラーメン屋さんはどこですか？"}], 30),
+    (
+        [
+            {
+                "role": "user",
+                "content": "한국어는 아름다운 언어입니다. 어디에서 배울 수 있나요?",
+            }
+        ],
+        33,
+    ),
+    ([{"role": "user", "content": "العربية لغة جميلة، أليس كذلك؟"}], 30),
+    (
+        [
+            {
+                "role": "user",
+                "content": " ".join(
+                    [
+                        "The history of computing is longer than the history "
+                        "of computing hardware and modern computing "
+                        "technology and includes the history of methods "
+                        "intended for pen and paper or for chalk and slate, "
+                        "with or without the aid of tables.",
+                        "Digital computing is intimately tied to the "
+                        "representation of numbers.",
+                        "But long before abstractions like the number arose, "
+                        "there were mathematical concepts to serve the "
+                        "purposes of civilization.",
+                        "These concepts are implicit in concrete practices "
+                        "such as one-to-one correspondence, the basis of "
+                        "counting, comparison to a standard, used for "
+                        "measurement, and the 3-4-5 right triangle, a device "
+                        "for assuring a right angle.",
+                    ]
+                    * 4
+                ),
+            }
+        ],
+        491,
+    ),
+]
+
+
+# Largest relative error of the estimate on the varied prompts. Words with
+# letters outside of ASCII, such as German compounds, are the least precise.
+ESTIMATE_TOLERANCE = 0.25
+
+
+def prompt_tokens(messages: list[dict]) -> int:
+    new_conversation = conversation.Conversation()
+    for message in messages:
+        new_conversation.add_message(conversation.Message(**message))
+    return new_conversation.tokens
+
+
+class TestTokens(unittest.TestCase):
+    @unittest.skipUnless(
+        tokens._encoding(), "tiktoken and its encoding are not available"
+    )
+    def test_count_matches_recorded_usage(self):
+        for messages, usage in RECORDED_USAGE + VARIED_USAGE:
+            assert_that(prompt_tokens(messages)).is_equal_to(usage)
+
+    def test_estimate_matches_recorded_usage(self):
+        with mock.patch.object(tokens, "_encoding", return_value=None):
+            for messages, usage in RECORDED_USAGE:
+                assert_that(prompt_tokens(messages)).is_equal_to(usage)
+
+    def test_estimate_is_close_to_varied_usage(self):
+        with mock.patch.object(tokens, "_encoding", return_value=None):
+            for messages, usage in VARIED_USAGE:
+                assert_that(prompt_tokens(messages)).is_close_to(
+                    usage, usage * ESTIMATE_TOLERANCE
+                )
+
+    def test_estimate_long_words_as_several_tokens(self):
+        assert_that(tokens.estimate_tokens("Hello")).is_equal_to(1)
+        assert_that(
+            tokens.estimate_tokens("supercalifragilisticexpialidocious")
+        ).is_greater_than(1)
+
+    def test_message_tokens_are_memoized(self):
+        message = conversation.Message(role="user", content="Hello")
+        tokens_before = message.tokens
+        with mock.patch(
+            "wrapgpt.message.count_message_tokens", return_value=0
+        ) as count:
+            assert_that(message.tokens).is_equal_to(tokens_before)
+            count.assert_not_called()
+            message.content = "Hello, how are you?"
+            assert_that(message.tokens).is_equal_to(0)
+            count.assert_called_once()
+
+    def test_estimate_conversation_cost(self):
+        new_conversation = conversation.Conversation()
+        new_conversation.add_message(
+            conversation.Message(role="user", content="Say this is a test!")
+        )
+        estimate = new_conversation.estimate_cost(completion_tokens=7)
+        assert_that(estimate.prompt_tokens).is_equal_to(13)
+        assert_that(estimate.total).is_equal_to(20)
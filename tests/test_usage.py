@@ -0,0 +1,139 @@
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from assertpy import assert_that
+
+from wrapgpt import usage
+from wrapgpt.cost import Cost
+from wrapgpt.interactions import Call, SessionInteractions
+from wrapgpt.metrics import Metrics
+
+CALLS = [
+    Call("gpt-4", 1000, 500, latency=0.2),
+    Call(
+        "gpt-4-0613",
+        1000,
+        0,
+        latency=0.4,
+        lost_tokens=150,
+        lost_usage={"gpt-3.5-turbo": Cost(100, 50)},
+    ),
+    Call("gpt-4", 1000, 500, latency=0.01, cached=True),
+    Call("gpt-3.5-turbo", 2000, 1000, latency=1.0),
+    Call("gpt-3.5-turbo", latency=3.0, error="Timeout"),
+    Call("mystery", 10, 10, latency=0.5),
+]
+
+
+class TestQuantileSketch(unittest.TestCase):
+    def test_quantiles_within_the_accuracy(self):
+        sketch = usage.QuantileSketch(0.01)
+        values = [index / 1000 for index in range(1, 10_001)]
+        for value in values:
+            sketch.add(value)
+        for percent in (1, 50, 95, 99, 100):
+            expected = values[round(percent / 100 * (len(values) - 1))]
+            assert_that(sketch.quantile(percent)).is_close_to(
+                expected, expected * 0.01
+            )
+        assert_that(len(sketch._buckets)).is_less_than(500)
+
+    def test_zeros_and_empty(self):
+        sketch = usage.QuantileSketch()
+        assert_that(sketch.quantile(50)).is_zero()
+        sketch.add(0.0)
+        sketch.add(2.0)
+        assert_that(sketch.quantile(0)).is_zero()
+        assert_that(sketch.quantile(100)).is_close_to(2.0, 0.02)
+
+
+class TestPrices(unittest.TestCase):
+    def test_longest_model_name_wins(self):
+        assert_that(usage.price("gpt-4-32k-0613")).is_equal_to((0.06, 0.12))
+        assert_that(usage.price("gpt-4-0613")).is_equal_to((0.03, 0.06))
+        assert_that(usage.price("mystery")).is_none()
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = Path(self.directory.name)
+
+    def export(self, format: usage.UsageFormat) -> None:
+        exporter = usage.UsageExporter(self.path, format, batch_size=4)
+        metrics = Metrics([exporter])
+        statistics = SessionInteractions(listeners=[metrics.add_interaction])
+        for call in CALLS:
+            metrics.add_call(call)
+            statistics.add_call(call)
+        statistics.finish_interaction()
+        metrics.close()
+
+    def assert_summary(self) -> None:
+        models = usage.summarize(self.path)
+        gpt4 = models["gpt-4"]
+        assert_that(gpt4.calls).is_equal_to(2)
+        assert_that(gpt4.prompt_tokens).is_equal_to(1000)
+        assert_that(gpt4.cost).is_close_to(0.06, 1e-9)
+        assert_that(models["gpt-4-0613"].cost).is_close_to(0.03, 1e-9)
+        cheap = models["gpt-3.5-turbo"]
+        assert_that(cheap.calls).is_equal_to(2)
+        assert_that(cheap.errors).is_equal_to(1)
+        assert_that(cheap.lost_tokens).is_equal_to(150)
+        assert_that(cheap.tokens).is_equal_to(3150)
+        assert_that(cheap.cost).is_close_to(0.00525, 1e-9)
+        assert_that(cheap.latency.quantile(100)).is_close_to(3.0, 0.03)
+        assert_that(models["mystery"].cost).is_zero()
+        interactions = list(usage.read_parts(self.path, "interactions"))
+        assert_that(interactions).is_length(1)
+        assert_that(interactions[0]["calls"]).is_equal_to([len(CALLS)])
+        assert_that(interactions[0]["errors"]).is_equal_to([1])
+
+    def test_csv_export_and_summary(self):
+        self.export(usage.UsageFormat.CSV)
+        parts = sorted((self.path / "calls").iterdir())
+        assert_that(parts).is_length(2)
+        assert_that(parts[0].suffix).is_equal_to(".csv")
+        self.assert_summary()
+
+    @unittest.skipUnless(usage._pyarrow(), "pyarrow is not installed")
+    def test_columnar_export_and_summary(self):
+        for format in (usage.UsageFormat.PARQUET, usage.UsageFormat.ARROW):
+            with self.subTest(format=format):
+                self.export(format)
+                self.assert_summary()
+                for part in self.path.rglob("part-*"):
+                    part.unlink()
+
+    def test_time_range(self):
+        self.export(usage.UsageFormat.CSV)
+        future = time.time() + 60
+        assert_that(usage.summarize(self.path, since=future)).is_empty()
+        assert_that(usage.summarize(self.path, until=future)).is_length(4)
+
+    def test_full_batches_are_written_in_the_background(self):
+        exporter = usage.UsageExporter(
+            self.path, usage.UsageFormat.CSV, batch_size=2, flush_interval=60
+        )
+        self.addCleanup(exporter.close)
+        exporter.export(CALLS[0])
+        exporter.export(CALLS[1])
+        deadline = time.monotonic() + 5
+        while not list(self.path.glob("calls/part-*")):
+            assert_that(time.monotonic()).is_less_than(deadline)
+            time.sleep(0.01)
+        batches = list(usage.read_parts(self.path))
+        assert_that(batches[0]["model"]).is_equal_to(["gpt-4", "gpt-4-0613"])
+
+    def test_columnar_format_needs_pyarrow(self):
+        with mock.patch.object(usage, "_pyarrow", return_value=None):
+            assert_that(usage.default_format()).is_equal_to(
+                usage.UsageFormat.CSV
+            )
+            assert_that(usage.write_part).raises(ValueError).when_called_with(
+                self.path, "calls", [], usage.UsageFormat.PARQUET
+            )
@@ -0,0 +1,87 @@
+import unittest
+
+from assertpy import assert_that, fail
+
+from wrapgpt import conversation, tokens, window
+
+
+def build_messages(turns: int) -> list[conversation.Message]:
+    messages = []
+    for turn in range(turns):
+        messages.append(conversation.Message("user", f"Question {turn}"))
+        messages.append(conversation.Message("assistant", f"Answer {turn}"))
+    return messages
+
+
+class TestWindow(unittest.TestCase):
+    def test_sliding_window_without_budget_keeps_everything(self):
+        messages = build_messages(3)
+        selected = window.SlidingWindow().select(messages, None)
+        assert_that(selected).is_equal_to(messages)
+
+    def test_sliding_window_keeps_newest_messages_in_budget(self):
+        messages = build_messages(3)
+        budget = sum(m.tokens for m in messages[-3:])
+        selected = window.SlidingWindow().select(messages, budget)
+        assert_that(selected).is_equal_to(messages[-3:])
+
+    def test_window_always_keeps_the_newest_message(self):
+        messages = build_messages(2)
+        selected = window.SlidingWindow().select(messages, 1)
+        assert_that(selected).is_equal_to(messages[-1:])
+        selected = window.DropOldestTurns().select(messages, 1)
+        assert_that(selected).is_equal_to(messages[-2:])
+
+    def test_drop_oldest_turns_keeps_whole_turns(self):
+        messages = build_messages(3)
+        budget = sum(m.tokens for m in messages[-3:])
+        selected = window.DropOldestTurns().select(messages, budget)
+        assert_that(selected).is_equal_to(messages[-2:])
+
+    def test_last_turns(self):
+        messages = build_messages(5)
+        selected = window.LastTurns(turns=2).select(messages, None)
+        assert_that(selected).is_equal_to(messages[-4:])
+
+    def test_last_turns_with_invalid_turns(self):
+        try:
+            window.LastTurns(turns=0)
+            fail("Should have raised an exception")
+        except ValueError as e:
+            assert_that(str(e)).contains("at least 1")
+
+    def test_conversation_window_always_sends_context(self):
+        new_conversation = conversation.Conversation(
+            window=window.LastTurns(turns=1)
+        )
+        new_conversation.context = conversation.Message(
+            role="system", content="You are a programmer"
+        )
+        for message in build_messages(3):
+            new_conversation.add_message(message)
+        assert_that(new_conversation.dict).is_equal_to(
+            [
+                {"role": "system", "content": "You are a programmer"},
+                {"role": "user", "content": "Question 2"},
+                {"role": "assistant", "content": "Answer 2"},
+            ]
+        )
+        assert_that(new_conversation.messages).is_length(6)
+
+    def test_conversation_window_budget_includes_context(self):
+        context = conversation.Message(role="system", content="Be brief")
+        messages = build_messages(3)
+        max_tokens = (
+            tokens.TOKENS_PER_REPLY
+            + context.tokens
+            + sum(m.tokens for m in messages[-4:])
+        )
+        new_conversation = conversation.Conversation(
+            window=window.DropOldestTurns(max_tokens=max_tokens)
+        )
+        new_conversation.context = context
+        for message in messages:
+            new_conversation.add_message(message)
+        assert_that(new_conversation.window_messages).is_equal_to(
+            messages[-4:]
+        )
@@ -1,8 +1,12 @@
-import openai
+import time
+from enum import Enum
+from typing import Optional
+
 import typer
 
 from .conversation import Conversation
 from .message import Message
+from .scheduler import Attempts
 
 
 def __prompt(prompt_message: str = "", is_first: bool = False) -> str:
@@ -19,18 +23,128 @@ def __prompt(prompt_message: str = "", is_first: bool = False) -> str:
     return prompt
 
 
-def __suggest_next_prompt(conversation: Conversation) -> str:
-    ask_for_prompt = Message(
-        "user",
-        "Give me a brief prompt, in the same language as the previous"
-        " user message.",
+SUGGESTION_REQUEST = Message(
+    "user",
+    "Give me a brief prompt, in the same language as the previous"
+    " user message.",
+)
+CHEAP_SUGGESTION_WINDOW = 2
+CHEAP_SUGGESTION_MAX_TOKENS = 32
+
+
+class SuggestionMode(str, Enum):
+    """When and how the next prompt is suggested.
+
+    Attributes:
+        OFF: Never suggest a prompt.
+        LAZY: Suggest a prompt only when the user asks for one.
+        BACKGROUND: Suggest a prompt while the answer is being rendered.
+            The suggestion is made from the conversation up to the prompt,
+            since the answer does not exist yet: it follows up on the
+            prompt, not on its answer.
+        CHEAP: Like BACKGROUND, but only the context and the last messages
+            are sent and the suggestion is kept short.
+    """
+
+    OFF = "off"
+    LAZY = "lazy"
+    BACKGROUND = "background"
+    CHEAP = "cheap"
+
+
+def __suggestion_request(
+    conversation: Conversation, mode: SuggestionMode
+) -> dict:
+    """Build the request for a suggestion without touching the history."""
+    messages = conversation.dict
+    params = {}
+    if mode is SuggestionMode.CHEAP:
+        preamble = bool(conversation.context) + bool(conversation.summary)
+        messages = [
+            *messages[:preamble],
+            *messages[preamble:][-CHEAP_SUGGESTION_WINDOW:],
+        ]
+        params["max_tokens"] = CHEAP_SUGGESTION_MAX_TOKENS
+    return dict(
+        model=conversation.model,
+        messages=[*messages, SUGGESTION_REQUEST.dict],
+        **params,
     )
-    conversation.add_message(ask_for_prompt)
-    completion = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo", messages=conversation.dict
+
+
+def __suggest_next_prompt(
+    conversation: Conversation, mode: SuggestionMode = SuggestionMode.LAZY
+) -> Message:
+    start = time.perf_counter()
+    request = __suggestion_request(conversation, mode)
+    key, suggestion = conversation.lookup(request)
+    attempts = Attempts(conversation.backend.complete)
+    if suggestion is None:
+        try:
+            suggestion = conversation.scheduler.call(
+                attempts,
+                conversation.tokens + SUGGESTION_REQUEST.tokens,
+                **request,
+            )
+            suggestion = conversation.claim(suggestion, attempts)
+        except Exception as error:
+            conversation.record_call(
+                request["model"],
+                None,
+                start,
+                attempts,
+                suggestion=True,
+                error=error,
+            )
+            raise
+        conversation.remember(key, suggestion)
+        if not suggestion.cached:
+            conversation.add_suggestion_cost(suggestion.cost)
+    conversation.record_call(
+        request["model"], suggestion, start, attempts, suggestion=True
+    )
+    return suggestion
+
+
+async def __asuggest_next_prompt(
+    conversation: Conversation,
+    mode: SuggestionMode = SuggestionMode.LAZY,
+    request: Optional[dict] = None,
+) -> Message:
+    """Suggest the next prompt.
+
+    Args:
+        conversation (Conversation): Conversation to follow up on.
+        mode (SuggestionMode): How the prompt is suggested.
+        request (Optional[dict]): Request for the suggestion, built from
+            the conversation when the coroutine runs if None.
+    """
+    start = time.perf_counter()
+    request = request or __suggestion_request(conversation, mode)
+    key, suggestion = conversation.lookup(request)
+    attempts = Attempts(conversation.backend.acomplete)
+    if suggestion is None:
+        try:
+            suggestion = await conversation.scheduler.acall(
+                attempts,
+                conversation.tokens + SUGGESTION_REQUEST.tokens,
+                **request,
+            )
+            suggestion = conversation.claim(suggestion, attempts)
+        except Exception as error:
+            conversation.record_call(
+                request["model"],
+                None,
+                start,
+                attempts,
+                suggestion=True,
+                error=error,
+            )
+            raise
+        conversation.remember(key, suggestion)
+        if not suggestion.cached:
+            conversation.add_suggestion_cost(suggestion.cost)
+    conversation.record_call(
+        request["model"], suggestion, start, attempts, suggestion=True
     )
-    conversation.messages.pop()
-    message_cost = Message.from_openai(completion).cost
-    conversation.add_cost(message_cost)
-    prompt_message = Message(**completion.choices[0].message)
-    return prompt_message.content
+    return suggestion
@@ -0,0 +1,417 @@
+"""Backends that complete the conversations."""
+import abc
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from enum import Enum
+from pathlib import Path
+from typing import AsyncIterator, Callable, Iterator, Optional, Union
+
+from .cache import request_key
+from .cost import Cost
+from .message import Message
+from .tokens import TOKENS_PER_REPLY, count_message_tokens, count_tokens
+
+# Parameters that do not change the completion of a request.
+TRANSPORT_PARAMS = ("api_key", "request_timeout", "stream")
+
+
+class Backend(abc.ABC):
+    """Completes the messages of a conversation.
+
+    Every method takes the parameters of a chat completion request, such as
+    `model` and `messages`. Streaming methods make the request when they are
+    called, so errors are raised before the first delta is consumed.
+    """
+
+    @property
+    def endpoint(self) -> Optional[str]:
+        """Return the URL the requests are sent to, None if there is none."""
+        return None
+
+    @abc.abstractmethod
+    def complete(self, **request) -> Message:
+        """Complete the messages, waiting for the whole reply."""
+
+    @abc.abstractmethod
+    async def acomplete(self, **request) -> Message:
+        """Asynchronous version of `complete`."""
+
+    @abc.abstractmethod
+    def stream(self, **request) -> Iterator[str]:
+        """Complete the messages, returning the deltas of the reply."""
+
+    @abc.abstractmethod
+    async def astream(self, **request) -> AsyncIterator[str]:
+        """Asynchronous version of `stream`."""
+
+
+def _prompt_tokens(messages: list[dict]) -> int:
+    """Count the prompt tokens of the messages of a request, reply included."""
+    return TOKENS_PER_REPLY + sum(
+        count_message_tokens(message["role"], message["content"])
+        for message in messages
+    )
+
+
+def _deltas(chunk) -> str:
+    """Return the content delta of a streamed chunk from OpenAI."""
+    return chunk.choices[0].delta.get("content") or ""
+
+
+class OpenAIBackend(Backend):
+    """Backend that completes the messages with the OpenAI API.
+
+    The `openai` package is only imported by the first request, since
+    importing it and its HTTP stack takes longer than the rest of startup.
+
+    Attributes:
+        api_key (Optional[str]): Key of the API. The global `openai.api_key`
+            if None.
+    """
+
+    def __init__(self, api_key: Optional[str] = None):
+        self.api_key = api_key
+
+    @classmethod
+    def from_env(cls) -> "OpenAIBackend":
+        """Build a backend with the key in the `OPENIA_API_KEY` variable."""
+        return cls(os.getenv("OPENIA_API_KEY"))
+
+    @property
+    def endpoint(self) -> Optional[str]:
+        import openai
+
+        return openai.api_base
+
+    def _request(self, request: dict) -> dict:
+        if self.api_key:
+            request["api_key"] = self.api_key
+        return request
+
+    def complete(self, **request) -> Message:
+        import openai
+
+        completion = openai.ChatCompletion.create(**self._request(request))
+        return Message.from_openai(completion)
+
+    async def acomplete(self, **request) -> Message:
+        import openai
+
+        completion = await openai.ChatCompletion.acreate(
+            **self._request(request)
+        )
+        return Message.from_openai(completion)
+
+    def stream(self, **request) -> Iterator[str]:
+        import openai
+
+        chunks = openai.ChatCompletion.create(
+            **self._request(request), stream=True
+        )
+        return (delta for chunk in chunks if (delta := _deltas(chunk)))
+
+    async def astream(self, **request) -> AsyncIterator[str]:
+        import openai
+
+        chunks = await openai.ChatCompletion.acreate(
+            **self._request(request), stream=True
+        )
+        return (delta async for chunk in chunks if (delta := _deltas(chunk)))
+
+
+def echo(messages: list[dict]) -> str:
+    """Reply with the content of the last message."""
+    return messages[-1]["content"] if messages else ""
+
+
+class FakeBackend(Backend):
+    """In-process backend with configurable latency, errors and usage.
+
+    Attributes:
+        reply (Callable[[list[dict]], str]): Builds the reply to the messages.
+        latency (float): Seconds before the first token of the reply, the
+            median if `latency_sigma` is set.
+        token_interval (float): Seconds between the tokens of a streamed
+            reply.
+        prompt_tokens (Optional[int]): Prompt tokens reported for every
+            request. Counted locally if None.
+        completion_tokens (Optional[int]): Completion tokens reported for
+            every request. Counted locally if None.
+        latency_sigma (float): Spread of the latency, which is drawn from a
+            log-normal distribution when it is positive, so a few requests
+            are much slower than the median, as with a real API.
+        error_rate (float): Probability that a request fails, after its
+            latency, with an error the schedulers retry.
+        seed (Optional[int]): Seed of the latencies and errors drawn.
+        requests (int): Number of requests completed.
+        failures (int): Number of requests failed.
+        usage (Cost): Tokens reported for the requests completed.
+    """
+
+    def __init__(
+        self,
+        reply: Callable[[list[dict]], str] = echo,
+        latency: float = 0.0,
+        token_interval: float = 0.0,
+        prompt_tokens: Optional[int] = None,
+        completion_tokens: Optional[int] = None,
+        latency_sigma: float = 0.0,
+        error_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        if not 0.0 <= error_rate <= 1.0:
+            raise ValueError("Error rate must be between 0 and 1.")
+        self.reply = reply
+        self.latency = latency
+        self.token_interval = token_interval
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.requests = 0
+        self.failures = 0
+        self.usage = Cost()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _latency(self) -> float:
+        """Draw the seconds before the first token of a reply."""
+        if self.latency_sigma <= 0 or self.latency <= 0:
+            return self.latency
+        with self._lock:
+            spread = self._random.lognormvariate(0.0, self.latency_sigma)
+        return self.latency * spread
+
+    def _complete(self, request: dict) -> Message:
+        """Build the reply to a request and count it.
+
+        Raises:
+            openai.error.ServiceUnavailableError: If the request is drawn to
+                fail.
+        """
+        with self._lock:
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.failures += 1
+            else:
+                self.requests += 1
+        if failed:
+            import openai
+
+            raise openai.error.ServiceUnavailableError(
+                "The fake backend failed.", http_status=503
+            )
+        reply = self._reply(request)
+        with self._lock:
+            self.usage += reply.cost
+        return reply
+
+    def _reply(self, request: dict) -> Message:
+        """Build the reply to a request."""
+        messages = request["messages"]
+        content = self.reply(messages)
+        prompt_tokens = self.prompt_tokens
+        if prompt_tokens is None:
+            prompt_tokens = _prompt_tokens(messages)
+        completion_tokens = self.completion_tokens
+        if completion_tokens is None:
+            completion_tokens = count_tokens(content)
+        return Message(
+            "assistant", content, Cost(prompt_tokens, completion_tokens)
+        )
+
+    def _split(self, content: str) -> list[str]:
+        """Split a reply in word-sized deltas."""
+        words = content.split(" ")
+        return [words[0]] + [f" {word}" for word in words[1:]]
+
+    def complete(self, **request) -> Message:
+        time.sleep(self._latency())
+        reply = self._complete(request)
+        time.sleep(self.token_interval * reply.cost.completion_tokens)
+        return reply
+
+    async def acomplete(self, **request) -> Message:
+        await asyncio.sleep(self._latency())
+        reply = self._complete(request)
+        await asyncio.sleep(self.token_interval * reply.cost.completion_tokens)
+        return reply
+
+    def stream(self, **request) -> Iterator[str]:
+        time.sleep(self._latency())
+        reply = self._complete(request)
+
+        def deltas() -> Iterator[str]:
+            for delta in self._split(reply.content):
+                time.sleep(self.token_interval)
+                yield delta
+
+        return deltas()
+
+    async def astream(self, **request) -> AsyncIterator[str]:
+        await asyncio.sleep(self._latency())
+        reply = self._complete(request)
+
+        async def deltas() -> AsyncIterator[str]:
+            for delta in self._split(reply.content):
+                await asyncio.sleep(self.token_interval)
+                yield delta
+
+        return deltas()
+
+
+def replay_key(request: dict) -> str:
+    """Return the key of a request in a recording."""
+    return request_key(
+        **{
+            name: value
+            for name, value in request.items()
+            if name not in TRANSPORT_PARAMS
+        }
+    )
+
+
+class RecordingBackend(Backend):
+    """Backend that records the replies of another backend.
+
+    Every reply is appended to a JSON Lines file, so it can be served later,
+    without a network, by a `ReplayBackend`. The API does not report the
+    usage of streamed replies, so their tokens are counted locally.
+
+    Attributes:
+        backend (Backend): Backend that completes the messages.
+        path (Path): Path of the recording.
+    """
+
+    def __init__(self, backend: Backend, path: Union[str, Path]):
+        self.backend = backend
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    @property
+    def endpoint(self) -> Optional[str]:
+        return self.backend.endpoint
+
+    def _record(self, request: dict, reply: Message) -> None:
+        record = {
+            "key": replay_key(request),
+            "role": reply.role,
+            "content": reply.content,
+            "prompt_tokens": reply.cost.prompt_tokens,
+            "completion_tokens": reply.cost.completion_tokens,
+        }
+        with self._lock, open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(record) + "\n")
+
+    def _record_stream(self, request: dict, content: list[str]) -> None:
+        reply = "".join(content)
+        cost = Cost(_prompt_tokens(request["messages"]), count_tokens(reply))
+        self._record(request, Message("assistant", reply, cost))
+
+    def complete(self, **request) -> Message:
+        reply = self.backend.complete(**request)
+        self._record(request, reply)
+        return reply
+
+    async def acomplete(self, **request) -> Message:
+        reply = await self.backend.acomplete(**request)
+        self._record(request, reply)
+        return reply
+
+    def stream(self, **request) -> Iterator[str]:
+        deltas = self.backend.stream(**request)
+
+        def record() -> Iterator[str]:
+            content = []
+            for delta in deltas:
+                content.append(delta)
+                yield delta
+            self._record_stream(request, content)
+
+        return record()
+
+    async def astream(self, **request) -> AsyncIterator[str]:
+        deltas = await self.backend.astream(**request)
+
+        async def record() -> AsyncIterator[str]:
+            content = []
+            async for delta in deltas:
+                content.append(delta)
+                yield delta
+            self._record_stream(request, content)
+
+        return record()
+
+
+class ReplayBackend(FakeBackend):
+    """Backend that serves the replies of a recording.
+
+    Attributes:
+        path (Path): Path of the recording.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        latency: float = 0.0,
+        token_interval: float = 0.0,
+    ):
+        super().__init__(latency=latency, token_interval=token_interval)
+        self.path = Path(path)
+        self._replies: dict[str, Message] = {}
+        with open(self.path, encoding="utf-8") as file:
+            for line in file:
+                record = json.loads(line)
+                self._replies[record["key"]] = Message(
+                    record["role"],
+                    record["content"],
+                    Cost(record["prompt_tokens"], record["completion_tokens"]),
+                )
+
+    def _reply(self, request: dict) -> Message:
+        try:
+            reply = self._replies[replay_key(request)]
+        except KeyError:
+            raise LookupError("The request was not recorded.") from None
+        return Message(reply.role, reply.content, reply.cost)
+
+
+class BackendKind(str, Enum):
+    """Backends that can be chosen from the command line."""
+
+    OPENAI = "openai"
+    FAKE = "fake"
+    RECORD = "record"
+    REPLAY = "replay"
+
+
+def open_backend(
+    kind: BackendKind = BackendKind.OPENAI,
+    recording: Optional[Union[str, Path]] = None,
+) -> Backend:
+    """Build a backend.
+
+    Args:
+        kind (BackendKind): Kind of backend.
+        recording (Optional[Union[str, Path]]): Recording written by the
+            record backend and served by the replay backend.
+
+    Returns:
+        Backend: The backend.
+
+    Raises:
+        ValueError: If the backend needs a recording and there is none.
+    """
+    if kind is BackendKind.FAKE:
+        return FakeBackend()
+    if kind in (BackendKind.RECORD, BackendKind.REPLAY) and not recording:
+        raise ValueError(f"The {kind.value} backend needs a recording.")
+    if kind is BackendKind.RECORD:
+        return RecordingBackend(OpenAIBackend.from_env(), recording)
+    if kind is BackendKind.REPLAY:
+        return ReplayBackend(recording)
+    return OpenAIBackend.from_env()
@@ -0,0 +1,271 @@
+"""Run many conversations from a file with a pool of workers."""
+import asyncio
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+from .backend import Backend
+from .cache import ResponseCache
+from .conversation import Conversation
+from .engine import Engine
+from .interactions import Call, Interaction
+from .message import Message
+from .scheduler import Scheduler, default_scheduler
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """Return the percentile of a list of values, 0 if it is empty.
+
+    Args:
+        values (list[float]): Values, in any order.
+        percent (float): Percentile to compute, between 0 and 100.
+
+    Returns:
+        float: Value below which `percent` percent of the values fall.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = round(percent / 100 * (len(ordered) - 1))
+    return ordered[index]
+
+
+@dataclass
+class BatchReport:
+    """Statistics of a batch run.
+
+    Attributes:
+        conversations (int): Number of conversations run.
+        skipped (int): Number of conversations already in the checkpoint.
+        errors (int): Number of conversations that failed.
+        prompt_tokens (int): Number of prompt tokens used.
+        completion_tokens (int): Number of completion tokens used.
+        latencies (list[float]): Seconds taken by each request.
+        elapsed (float): Seconds taken by the whole run.
+        usage (Interaction): Usage of every request of the run.
+    """
+
+    conversations: int = 0
+    skipped: int = 0
+    errors: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    latencies: list[float] = field(default_factory=list)
+    elapsed: float = 0.0
+    usage: Interaction = field(default_factory=Interaction)
+
+    @property
+    def requests(self) -> int:
+        """Return the number of requests made."""
+        return len(self.latencies)
+
+    @property
+    def throughput(self) -> float:
+        """Return the number of requests made per second."""
+        return self.requests / self.elapsed if self.elapsed else 0.0
+
+    def latency(self, percent: float) -> float:
+        """Return a percentile of the request latency, in seconds."""
+        return percentile(self.latencies, percent)
+
+
+def read_jobs(path: Path) -> Iterator[dict]:
+    """Read the conversations to run from a JSON Lines file.
+
+    Each line is a conversation with an "id" and, optionally, a "context",
+    the "messages" already in the conversation and the "prompts" to send one
+    after the other. If there are no prompts, the conversation is completed
+    as it is.
+
+    Args:
+        path (Path): Path of the file.
+
+    Yields:
+        dict: Conversations to run.
+    """
+    with open(path, encoding="utf-8") as file:
+        for number, line in enumerate(file, start=1):
+            if line.strip():
+                job = json.loads(line)
+                job.setdefault("id", str(number))
+                yield job
+
+
+def read_checkpoint(path: Path) -> set[str]:
+    """Return the ids of the conversations already run without an error."""
+    return _read_results(path)[0]
+
+
+def _read_results(path: Path) -> tuple[set[str], set[str]]:
+    """Return the ids of the conversations run, without and with an error."""
+    done: set[str] = set()
+    failed: set[str] = set()
+    if not path.exists():
+        return done, failed
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                result = json.loads(line)
+                if result.get("error") is None:
+                    done.add(result["id"])
+                else:
+                    failed.add(result["id"])
+    return done, failed - done
+
+
+def _drop_superseded(path: Path, ids: set[str]) -> None:
+    """Keep only the last result of each conversation run again.
+
+    The output is rewritten under a temporary name first, so it is never
+    left half written.
+    """
+    last: dict[str, int] = {}
+    with open(path, encoding="utf-8") as file:
+        for number, line in enumerate(file):
+            if line.strip() and (result_id := json.loads(line)["id"]) in ids:
+                last[result_id] = number
+    temporary = path.with_name(f".{path.name}.tmp")
+    with open(path, encoding="utf-8") as source, open(
+        temporary, "w", encoding="utf-8"
+    ) as target:
+        for number, line in enumerate(source):
+            if not line.strip():
+                continue
+            result_id = json.loads(line)["id"]
+            if result_id not in ids or last[result_id] == number:
+                target.write(line)
+    os.replace(temporary, path)
+
+
+async def run_job(
+    job: dict,
+    engine: Engine,
+    model: str,
+    cache: Optional[ResponseCache],
+    scheduler: Scheduler,
+    backend: Optional[Backend] = None,
+    listeners: tuple[Callable[[Call], None], ...] = (),
+) -> dict:
+    """Run a single conversation.
+
+    Args:
+        job (dict): Conversation to run.
+        engine (Engine): Engine the requests are submitted to.
+        model (str): Model used for the completions.
+        cache (Optional[ResponseCache]): Cache of replies.
+        scheduler (Scheduler): Scheduler that paces and retries the requests.
+        backend (Optional[Backend]): Backend that completes the
+            conversation. The OpenAI API if None.
+        listeners (tuple[Callable[[Call], None], ...]): Called with the
+            record of every request.
+
+    Returns:
+        dict: Result of the conversation, with the replies, the tokens used
+            and the latency of each request.
+    """
+    conversation = Conversation(cache=cache, scheduler=scheduler)
+    if backend is not None:
+        conversation.backend = backend
+    conversation.listeners.extend(listeners)
+    if job.get("context"):
+        conversation.context = Message("system", job["context"])
+    for message in job.get("messages", []):
+        conversation.add_message(Message(message["role"], message["content"]))
+    prompts = job.get("prompts") or [None]
+    result = {"id": job["id"], "replies": [], "latencies": [], "error": None}
+
+    async def ask(prompt: Optional[str]) -> tuple[Message, float]:
+        start = time.perf_counter()
+        message = Message("user", prompt) if prompt is not None else None
+        reply = await conversation.asend(message, model=model)
+        return reply, time.perf_counter() - start
+
+    try:
+        for prompt in prompts:
+            reply, latency = await engine.submit(ask(prompt))
+            result["replies"].append(reply.content)
+            result["latencies"].append(latency)
+    except Exception as error:
+        result["error"] = f"{type(error).__name__}: {error}"
+    result["prompt_tokens"] = conversation.cost.prompt_tokens
+    result["completion_tokens"] = conversation.cost.completion_tokens
+    return result
+
+
+async def run_batch(
+    input_path: Path,
+    output_path: Path,
+    workers: int = 8,
+    model: str = "gpt-3.5-turbo",
+    cache: Optional[ResponseCache] = None,
+    scheduler: Optional[Scheduler] = None,
+    backend: Optional[Backend] = None,
+    listeners: tuple[Callable[[Call], None], ...] = (),
+) -> BatchReport:
+    """Run the conversations of a file with a pool of workers.
+
+    Results are appended to the output file as soon as each conversation
+    finishes, so they are written in completion order. Conversations already
+    in the output file are skipped, so an interrupted run can be resumed by
+    running it again. Conversations that failed are run again, and their
+    previous result is then removed from the output file.
+
+    Args:
+        input_path (Path): JSON Lines file with the conversations to run.
+        output_path (Path): JSON Lines file where the results are appended.
+        workers (int): Number of conversations run concurrently.
+        model (str): Model used for the completions.
+        cache (Optional[ResponseCache]): Cache of replies.
+        scheduler (Optional[Scheduler]): Scheduler that paces and retries the
+            requests. The shared one if None.
+        backend (Optional[Backend]): Backend that completes the
+            conversations. The OpenAI API if None.
+        listeners (tuple[Callable[[Call], None], ...]): Called with the
+            record of every request, besides the report.
+
+    Returns:
+        BatchReport: Statistics of the run.
+    """
+    scheduler = scheduler or default_scheduler()
+    report = BatchReport()
+    done, failed = _read_results(output_path)
+    retried: set[str] = set()
+    jobs = read_jobs(input_path)
+    start = time.perf_counter()
+
+    async def work(engine: Engine, output) -> None:
+        for job in jobs:
+            if job["id"] in done:
+                report.skipped += 1
+                continue
+            result = await run_job(
+                job,
+                engine,
+                model,
+                cache,
+                scheduler,
+                backend,
+                (report.usage.add_call, *listeners),
+            )
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            if job["id"] in failed:
+                retried.add(job["id"])
+            report.conversations += 1
+            report.errors += result["error"] is not None
+            report.prompt_tokens += result["prompt_tokens"]
+            report.completion_tokens += result["completion_tokens"]
+            report.latencies.extend(result["latencies"])
+
+    with open(output_path, "a", encoding="utf-8") as output:
+        async with Engine(concurrency=workers) as engine:
+            await asyncio.gather(
+                *(work(engine, output) for _ in range(workers))
+            )
+    if retried:
+        _drop_superseded(output_path, retried)
+    report.elapsed = time.perf_counter() - start
+    return report
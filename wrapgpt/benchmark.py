@@ -0,0 +1,183 @@
+"""Offline benchmarks of the conversation engine and the chat loop."""
+import asyncio
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from ._prompt import SuggestionMode, __asuggest_next_prompt
+from .backend import Backend, FakeBackend
+from .batch import percentile
+from .conversation import Conversation
+from .engine import Engine
+from .message import Message
+from .scheduler import Scheduler
+
+HISTORY_SIZES = (0, 100, 1_000)
+
+
+@dataclass
+class BenchmarkResult:
+    """Measurements of a benchmark scenario.
+
+    Attributes:
+        scenario (str): Name of the scenario.
+        history (int): Number of messages in the conversation before the
+            measured turns.
+        latencies (list[float]): Seconds taken by each turn.
+        elapsed (float): Seconds taken by all the turns.
+        peak_memory (int): Peak bytes allocated while building the
+            conversation and running the turns.
+    """
+
+    scenario: str
+    history: int
+    latencies: list[float] = field(default_factory=list)
+    elapsed: float = 0.0
+    peak_memory: int = 0
+
+    @property
+    def turns(self) -> int:
+        """Return the number of turns measured."""
+        return len(self.latencies)
+
+    @property
+    def throughput(self) -> float:
+        """Return the number of turns per second."""
+        return self.turns / self.elapsed if self.elapsed else 0.0
+
+    def latency(self, percent: float) -> float:
+        """Return a percentile of the turn latency, in seconds."""
+        return percentile(self.latencies, percent)
+
+
+def build_conversation(history: int, backend: Backend) -> Conversation:
+    """Build a conversation with a history of alternating turns.
+
+    Args:
+        history (int): Number of messages in the history.
+        backend (Backend): Backend that completes the conversation.
+
+    Returns:
+        Conversation: The conversation, paced by a scheduler with no limits.
+    """
+    conversation = Conversation(scheduler=Scheduler(), backend=backend)
+    conversation.context = Message("system", "You are a helpful assistant.")
+    for index in range(history):
+        role = "user" if index % 2 == 0 else "assistant"
+        conversation.add_message(Message(role, f"Message number {index}."))
+    return conversation
+
+
+def engine_turns(conversation: Conversation, turns: int) -> list[float]:
+    """Send prompts to a conversation, waiting for each whole reply.
+
+    Returns:
+        list[float]: Seconds taken by each turn.
+    """
+    latencies = []
+    for index in range(turns):
+        start = time.perf_counter()
+        conversation.send(Message("user", f"Prompt number {index}."))
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def chat_turns(
+    conversation: Conversation,
+    turns: int,
+    suggestions: SuggestionMode = SuggestionMode.BACKGROUND,
+) -> list[float]:
+    """Run turns of the chat loop, without rendering them.
+
+    Each turn streams the reply through an engine while the next prompt is
+    suggested concurrently, as the command line interface does.
+
+    Returns:
+        list[float]: Seconds taken by each turn.
+    """
+    latencies = []
+    async with Engine() as engine:
+        for index in range(turns):
+            start = time.perf_counter()
+            conversation.add_message(
+                Message("user", f"Prompt number {index}.")
+            )
+            suggestion = None
+            if suggestions in (
+                SuggestionMode.BACKGROUND,
+                SuggestionMode.CHEAP,
+            ):
+                suggestion = asyncio.ensure_future(
+                    engine.submit(
+                        __asuggest_next_prompt(conversation, suggestions)
+                    )
+                )
+            async for _ in engine.stream(conversation.astream()):
+                pass
+            if suggestion:
+                await suggestion
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+SCENARIOS: dict[str, Callable[[Conversation, int], list[float]]] = {
+    "engine": engine_turns,
+    "chat": lambda conversation, turns: asyncio.run(
+        chat_turns(conversation, turns)
+    ),
+}
+
+
+def measure(
+    scenario: str,
+    history: int,
+    turns: int,
+    backend: Optional[Callable[[], Backend]] = None,
+) -> BenchmarkResult:
+    """Measure a scenario at a history size.
+
+    The latency is measured first, then the memory in a second run, so the
+    tracing of the allocations does not slow down the timed turns.
+
+    Args:
+        scenario (str): Name of the scenario, a key of `SCENARIOS`.
+        history (int): Number of messages in the history.
+        turns (int): Number of turns measured.
+        backend (Optional[Callable[[], Backend]]): Builds the backend of the
+            conversations. A `FakeBackend` with no latency if None.
+
+    Returns:
+        BenchmarkResult: Measurements of the scenario.
+    """
+    run = SCENARIOS[scenario]
+    backend = backend or FakeBackend
+    result = BenchmarkResult(scenario, history)
+    conversation = build_conversation(history, backend())
+    start = time.perf_counter()
+    result.latencies = run(conversation, turns)
+    result.elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        run(build_conversation(history, backend()), turns)
+        result.peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result
+
+
+def run_benchmarks(
+    history_sizes: tuple[int, ...] = HISTORY_SIZES,
+    turns: int = 50,
+    backend: Optional[Callable[[], Backend]] = None,
+) -> list[BenchmarkResult]:
+    """Measure every scenario at every history size.
+
+    Returns:
+        list[BenchmarkResult]: Measurements, by scenario and history size.
+    """
+    return [
+        measure(scenario, history, turns, backend)
+        for scenario in SCENARIOS
+        for history in history_sizes
+    ]
@@ -0,0 +1,195 @@
+"""Cache of responses to identical requests to the API."""
+import collections
+import hashlib
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+from .cost import Cost
+from .message import Message
+
+
+def request_key(**request) -> str:
+    """Build a stable key for a request to the API.
+
+    Args:
+        **request: Parameters of the request, such as the model and the
+            messages.
+
+    Returns:
+        str: Hash of the request, the same for identical requests.
+    """
+    payload = json.dumps(request, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Two-tier cache of responses, keyed by `request_key`.
+
+    Responses are kept in an in-memory LRU and, optionally, in a SQLite
+    database, so they survive restarts. Entries older than `ttl` seconds are
+    never returned. The database is trimmed to the `max_disk_size` most
+    recently used responses once it holds a tenth more, so that most puts
+    only insert their response.
+
+    Attributes:
+        max_size (int): Maximum number of responses kept in memory.
+        ttl (Optional[float]): Seconds a response is valid. Forever if None.
+        path (Optional[Path]): Path of the on-disk tier, if any.
+        max_disk_size (int): Maximum number of responses kept on disk.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl: Optional[float] = None,
+        path: Optional[Union[str, Path]] = None,
+        max_disk_size: int = 100_000,
+    ):
+        if max_size < 1 or max_disk_size < 1:
+            raise ValueError("Cache size must be at least 1.")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = Path(path) if path else None
+        self.max_disk_size = max_disk_size
+        self._entries: collections.OrderedDict[
+            str, tuple[float, str, str, int, int]
+        ] = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._disk_size = 0
+        if self.path:
+            import sqlite3
+
+            self._connection = sqlite3.connect(
+                self.path, check_same_thread=False
+            )
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    prompt_tokens INTEGER NOT NULL,
+                    completion_tokens INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS responses_accessed
+                    ON responses (accessed);
+                """
+            )
+            self._count_disk_size()
+
+    def get(self, key: str) -> Optional[Message]:
+        """Return the cached response of a request.
+
+        Args:
+            key (str): Key of the request.
+
+        Returns:
+            Optional[Message]: Cached response, flagged as cached and with
+                the cost of the original request, or None if there is none.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            elif self._connection:
+                entry = self._connection.execute(
+                    "SELECT created, role, content, prompt_tokens,"
+                    " completion_tokens FROM responses WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                if entry is not None:
+                    with self._connection:
+                        self._connection.execute(
+                            "UPDATE responses SET accessed = ? WHERE key = ?",
+                            (now, key),
+                        )
+                    self._remember(key, entry)
+            if entry is None:
+                return None
+            if self.ttl is not None and now - entry[0] > self.ttl:
+                self._forget(key)
+                return None
+        _, role, content, prompt_tokens, completion_tokens = entry
+        return Message(
+            role, content, Cost(prompt_tokens, completion_tokens), cached=True
+        )
+
+    def put(self, key: str, message: Message) -> None:
+        """Cache the response of a request.
+
+        Args:
+            key (str): Key of the request.
+            message (Message): Response to the request.
+        """
+        now = time.time()
+        entry = (
+            now,
+            message.role,
+            message.content,
+            message.cost.prompt_tokens,
+            message.cost.completion_tokens,
+        )
+        with self._lock:
+            self._remember(key, entry)
+            if self._connection:
+                with self._connection:
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO responses"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (key, now, *entry),
+                    )
+                    # Replaced responses are counted too, which only trims
+                    # earlier.
+                    self._disk_size += 1
+                    if self._disk_size > self._trim_size:
+                        self._trim()
+
+    def __len__(self) -> int:
+        """Return the number of responses kept in memory."""
+        return len(self._entries)
+
+    def close(self) -> None:
+        """Close the on-disk tier."""
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+
+    @property
+    def _trim_size(self) -> int:
+        return self.max_disk_size + self.max_disk_size // 10
+
+    def _trim(self) -> None:
+        self._connection.execute(
+            "DELETE FROM responses WHERE key IN ("
+            " SELECT key FROM responses ORDER BY accessed DESC"
+            " LIMIT -1 OFFSET ?)",
+            (self.max_disk_size,),
+        )
+        self._count_disk_size()
+
+    def _count_disk_size(self) -> None:
+        (self._disk_size,) = self._connection.execute(
+            "SELECT COUNT(*) FROM responses"
+        ).fetchone()
+
+    def _remember(self, key: str, entry: tuple) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _forget(self, key: str) -> None:
+        self._entries.pop(key, None)
+        if self._connection:
+            with self._connection:
+                deleted = self._connection.execute(
+                    "DELETE FROM responses WHERE key = ?", (key,)
+                ).rowcount
+            self._disk_size -= deleted
@@ -1,23 +1,61 @@
-"""Command line interface for the chatbot."""
-import openai
-from rich import print
-from rich.prompt import Prompt
-from rich.table import Table
+"""Command line interface for the chatbot.
 
-from ._prompt import __prompt, __suggest_next_prompt
+Only what the chat needs to show its first prompt is imported with the
+module. Rich, the stores, the metrics and the modules of the other commands
+are imported when they are used.
+"""
+import asyncio
+import json
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Optional
+
+from ._prompt import (
+    SuggestionMode,
+    __asuggest_next_prompt,
+    __prompt,
+    __suggest_next_prompt,
+    __suggestion_request,
+)
+from .backend import Backend, BackendKind, FakeBackend, open_backend
+from .cache import ResponseCache
+from .compaction import Compactor
 from .conversation import Conversation
+from .engine import Engine
 from .interactions import SessionInteractions
 from .message import Message
+from .racing import Racer, Route
+from .scheduler import Scheduler
+from .window import DropOldestTurns
+
+if TYPE_CHECKING:
+    from rich.table import Table
 
 WELCOME_MESSAGE = """Hello! I'm a chatbot. Ask me anything."""
 
+# Compactions running in the background, kept so they are not collected
+# before they are done.
+__compactions: set[asyncio.Task] = set()
+
+
+def print(*objects, **kwargs) -> None:
+    """Print with rich markup, importing rich on first use."""
+    from rich import print as rich_print
+
+    rich_print(*objects, **kwargs)
+
+
+def __build_commands_table(suggestions: SuggestionMode) -> "Table":
+    from rich.table import Table
 
-def __build_commands_table() -> Table:
     commands_table = Table("Commands", "Description")
     commands_table.add_row("exit", "Exit the chat")
     commands_table.add_row("new", "Reset the chat history")
     commands_table.add_row("stats", "Show usage statistics")
     commands_table.add_row("ctx", "Set a context for the chat")
+    if suggestions is not SuggestionMode.OFF:
+        commands_table.add_row("suggest", "Suggest the next prompt")
     commands_table.add_row(
         "!!",
         "Ask for a given command and recieve a response "
@@ -26,28 +64,287 @@ def __build_commands_table() -> Table:
     return commands_table
 
 
-def __ask_gpt(user_input: str, conversation: Conversation) -> Message:
-    message = Message(role="user", content=user_input)
-    conversation.add_message(message)
-    completion = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo", messages=conversation.dict
-    )
-    gpt_message = Message.from_openai(completion)
+async def __stream_gpt(
+    user_input: str,
+    conversation: Conversation,
+    engine: Engine,
+    suggestions: SuggestionMode,
+) -> Optional[Message]:
+    """Render the answer while the next prompt is suggested concurrently.
+
+    Old messages are compacted in the background: the compaction is not
+    awaited, so it goes on during the next turns until it is done. A
+    failed compaction is reported and retried on the next turn.
 
-    return gpt_message
+    The suggestion is requested from the conversation as it is once the
+    prompt is added, before the answer exists, so it is based on the prompt
+    and the turns before it, not on the answer. If the answer fails, the
+    prompt is taken back from the conversation so it can be sent again. A
+    failed suggestion is no suggestion.
 
+    Returns:
+        Optional[Message]: Suggested next prompt, if suggestions are made in
+            the background.
 
-def run():
-    """Run the chatbot."""
+    Raises:
+        Exception: The error of the answer, if it failed.
+    """
+    from rich.console import Console
+
+    console = Console()
+    conversation.add_message(Message(role="user", content=user_input))
+    suggestion = None
+    if suggestions in (SuggestionMode.BACKGROUND, SuggestionMode.CHEAP):
+        request = __suggestion_request(conversation, suggestions)
+        suggestion = asyncio.ensure_future(
+            engine.submit(
+                __asuggest_next_prompt(conversation, suggestions, request)
+            )
+        )
+    if conversation.compactor:
+        compaction = asyncio.ensure_future(
+            engine.submit(conversation.acompact())
+        )
+        __compactions.add(compaction)
+        compaction.add_done_callback(__compaction_done)
+    console.print(">  ", end="", style="green")
+    try:
+        async for delta in engine.stream(conversation.astream()):
+            console.print(
+                delta, end="", style="green", markup=False, highlight=False
+            )
+    except Exception:
+        console.print()
+        conversation.pop_message()
+        if suggestion:
+            suggestion.cancel()
+        raise
+    console.print("\n")
+    if suggestion is None:
+        return None
+    try:
+        return await suggestion
+    except Exception:
+        return None
+
+
+async def __warm_up(engine: Engine, backend: Backend) -> None:
+    """Import the HTTP stack and connect to the backend ahead of time."""
+    await engine.warm(backend.endpoint)
+
+
+def __read_prompt(
+    loop: asyncio.AbstractEventLoop, prompt_message: str, is_first: bool
+) -> str:
+    """Read the next prompt while the background tasks go on.
+
+    The prompt is read in a daemon thread while the loop runs, so the
+    warm-up and the compactions progress while the user types.
+    """
+    future = loop.create_future()
+
+    def read() -> None:
+        try:
+            user_input = __prompt(
+                prompt_message=prompt_message, is_first=is_first
+            )
+        except BaseException as error:
+            loop.call_soon_threadsafe(future.set_exception, error)
+        else:
+            loop.call_soon_threadsafe(future.set_result, user_input)
+
+    threading.Thread(target=read, daemon=True).start()
+    return loop.run_until_complete(future)
+
+
+def __print_error(error: Exception) -> None:
+    """Report a failed request without leaving the chat."""
+    from rich.markup import escape
+
+    print(f"[red][!][/red]{type(error).__name__}: {escape(str(error))}")
+
+
+def __compaction_done(compaction: asyncio.Task) -> None:
+    """Forget a background compaction and report its failure, if any."""
+    __compactions.discard(compaction)
+    if not compaction.cancelled() and compaction.exception() is not None:
+        print(f"[red][!][/red]Compaction failed: {compaction.exception()}")
+
+
+def run(
+    suggestions: SuggestionMode = SuggestionMode.BACKGROUND,
+    context_tokens: Optional[int] = None,
+    store: Optional[Path] = None,
+    resume: Optional[str] = None,
+    resume_messages: Optional[int] = None,
+    flush_interval: float = 1.0,
+    cache: bool = False,
+    cache_path: Optional[Path] = None,
+    cache_ttl: Optional[float] = None,
+    semantic_threshold: Optional[float] = None,
+    semantic_path: Optional[Path] = None,
+    requests_per_minute: Optional[float] = None,
+    tokens_per_minute: Optional[float] = None,
+    max_retries: int = 5,
+    backend: BackendKind = BackendKind.OPENAI,
+    recording: Optional[Path] = None,
+    metrics_port: Optional[int] = None,
+    trace_endpoint: Optional[str] = None,
+    metrics_path: Optional[Path] = None,
+    compact_tokens: Optional[int] = None,
+    compact_keep: int = 4,
+    model: str = "gpt-3.5-turbo",
+    race: Optional[List[str]] = None,
+    hedge: bool = False,
+    usage_path: Optional[Path] = None,
+):
+    """Run the chatbot.
+
+    Args:
+        suggestions (SuggestionMode): When and how the next prompt is
+            suggested.
+        context_tokens (Optional[int]): Token budget of each request. The
+            oldest turns are not sent once the budget is exceeded.
+        store (Optional[Path]): File where the conversation is recorded, a
+            SQLite database (.db) or a JSON Lines file.
+        resume (Optional[str]): Id of a recorded conversation to resume.
+        resume_messages (Optional[int]): Number of messages to load when
+            resuming. All of them if not set.
+        flush_interval (float): Seconds between writes to the store.
+        cache (bool): Whether replies to identical requests are cached.
+        cache_path (Optional[Path]): SQLite database where replies are
+            cached across sessions. Enables the cache.
+        cache_ttl (Optional[float]): Seconds a cached reply is valid.
+        semantic_threshold (Optional[float]): Similarity above which the
+            reply to a paraphrase of a question is reused. Replies are only
+            reused for identical requests if not set.
+        semantic_path (Optional[Path]): SQLite database where the replies
+            to paraphrases are cached across sessions.
+        requests_per_minute (Optional[float]): Requests allowed per minute.
+        tokens_per_minute (Optional[float]): Tokens allowed per minute.
+        max_retries (int): Maximum number of retries of a failed request.
+        backend (BackendKind): Backend that completes the conversation.
+        recording (Optional[Path]): JSON Lines file written by the record
+            backend and served by the replay backend.
+        metrics_port (Optional[int]): Port where Prometheus metrics are
+            served.
+        trace_endpoint (Optional[str]): OTLP/HTTP endpoint where a span of
+            every request is sent.
+        metrics_path (Optional[Path]): JSON Lines file where every request
+            is recorded.
+        compact_tokens (Optional[int]): Tokens of history above which the
+            oldest messages are replaced by a summary. Never if not set.
+        compact_keep (int): Number of newest messages never summarized.
+        model (str): Model used for the completions.
+        race (Optional[List[str]]): Other models every reply is raced
+            against. The first reply, or first token, wins.
+        hedge (bool): Whether a request is duplicated, to the next model
+            raced if any, only once it misses the 95th percentile of the
+            times to first token, instead of racing all the models at once.
+        usage_path (Optional[Path]): Directory where every request and
+            interaction is exported in a columnar format.
+    """
+    from .metrics import open_metrics
+    from .store import open_store
+
+    completion_backend = open_backend(backend, recording)
+    racer = None
+    if race or hedge:
+        routes = [Route(completion_backend, name) for name in race or []]
+        racer = Racer(routes, hedge)
+    metrics = open_metrics(
+        metrics_port, trace_endpoint, metrics_path, usage_path
+    )
+    compactor = None
+    if compact_tokens:
+        compactor = Compactor(compact_tokens, compact_keep)
     print(f"[bold green]{WELCOME_MESSAGE}[/bold green]")
-    commands_table = __build_commands_table()
+    commands_table = __build_commands_table(suggestions)
     print(commands_table)
-    conversation = Conversation()
+    conversation_store = open_store(store, flush_interval) if store else None
+    response_cache = None
+    if cache or cache_path:
+        response_cache = ResponseCache(ttl=cache_ttl, path=cache_path)
+    semantic_cache = None
+    if semantic_threshold:
+        from .semantic import SemanticCache
+
+        semantic_cache = SemanticCache(
+            semantic_threshold, ttl=cache_ttl, path=semantic_path
+        )
+    window = DropOldestTurns(context_tokens)
+    scheduler = Scheduler(requests_per_minute, tokens_per_minute, max_retries)
+    if resume and conversation_store:
+        conversation = Conversation.resume(
+            conversation_store,
+            resume,
+            resume_messages,
+            window=window,
+            cache=response_cache,
+            semantic_cache=semantic_cache,
+            scheduler=scheduler,
+            backend=completion_backend,
+            compactor=compactor,
+            model=model,
+            racer=racer,
+        )
+    else:
+        conversation = Conversation(
+            window=window,
+            store=conversation_store,
+            cache=response_cache,
+            semantic_cache=semantic_cache,
+            scheduler=scheduler,
+            backend=completion_backend,
+            compactor=compactor,
+            model=model,
+            racer=racer,
+        )
+    if conversation_store:
+        print(f"[cyan]Conversation id: {conversation.id}[/cyan]")
+    statistics = SessionInteractions(store=conversation_store)
+    conversation.listeners.append(statistics.add_call)
+    if metrics:
+        conversation.listeners.append(metrics.add_call)
+        statistics.listeners.append(metrics.add_interaction)
+    engine = Engine()
+    loop = asyncio.new_event_loop()
+    loop.create_task(__warm_up(engine, completion_backend))
+    try:
+        __chat(conversation, statistics, engine, loop, suggestions)
+    finally:
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(
+                asyncio.gather(*pending, return_exceptions=True)
+            )
+        loop.run_until_complete(engine.close())
+        loop.close()
+        if conversation_store or metrics:
+            statistics.finish_interaction()
+        if conversation_store:
+            conversation_store.close()
+        if response_cache is not None:
+            response_cache.close()
+        if semantic_cache is not None:
+            semantic_cache.close()
+        if metrics:
+            metrics.close()
+
+
+def __chat(
+    conversation: Conversation,
+    statistics: SessionInteractions,
+    engine: Engine,
+    loop: asyncio.AbstractEventLoop,
+    suggestions: SuggestionMode,
+) -> None:
     prompt_message = ""
-    statistics = SessionInteractions()
     is_first = True
     while True:
-        user_input = __prompt(prompt_message=prompt_message, is_first=is_first)
+        user_input = __read_prompt(loop, prompt_message, is_first)
         is_first = False
         if user_input == "new":
             is_first = True
@@ -58,8 +355,20 @@ def run():
             for table in statistics.table:
                 print(table)
         elif user_input == "ctx":
+            from rich.prompt import Prompt
+
             context_message = Prompt.ask("Set a context for the chat")
             conversation.context = Message("system", context_message)
+        elif user_input == "suggest":
+            if suggestions is SuggestionMode.OFF:
+                print("[red][!][/red]Suggestions are off")
+            else:
+                try:
+                    prompt_message = __suggest_next_prompt(
+                        conversation, suggestions
+                    ).content
+                except Exception as error:
+                    __print_error(error)
         elif user_input == "rmctx":
             if not conversation.context:
                 print("[red][!][/red]There is no context to remove")
@@ -67,6 +376,349 @@ def run():
                 del conversation.context
                 print("[green]Context removed[/green]")
         else:
-            gpt_message = __ask_gpt(user_input, conversation)
-            prompt_message = __suggest_next_prompt(conversation)
-            print(f"[green]>  {gpt_message.content}[/green]\n")
+            try:
+                suggestion = loop.run_until_complete(
+                    __stream_gpt(user_input, conversation, engine, suggestions)
+                )
+            except Exception as error:
+                __print_error(error)
+                suggestion = None
+            prompt_message = suggestion.content if suggestion else ""
+
+
+def batch(
+    input_path: Path,
+    output_path: Path,
+    workers: int = 8,
+    model: str = "gpt-3.5-turbo",
+    cache_path: Optional[Path] = None,
+    requests_per_minute: Optional[float] = None,
+    tokens_per_minute: Optional[float] = None,
+    max_retries: int = 5,
+    backend: BackendKind = BackendKind.OPENAI,
+    recording: Optional[Path] = None,
+    metrics_port: Optional[int] = None,
+    trace_endpoint: Optional[str] = None,
+    metrics_path: Optional[Path] = None,
+    coalesce: bool = True,
+    usage_path: Optional[Path] = None,
+):
+    """Run the conversations of a JSON Lines file without prompting.
+
+    Args:
+        input_path (Path): File with one conversation per line.
+        output_path (Path): File where the results are appended. Runs are
+            resumed from the conversations already in it.
+        workers (int): Number of conversations run concurrently.
+        model (str): Model used for the completions.
+        cache_path (Optional[Path]): SQLite database where replies are
+            cached across runs.
+        requests_per_minute (Optional[float]): Requests allowed per minute.
+        tokens_per_minute (Optional[float]): Tokens allowed per minute.
+        max_retries (int): Maximum number of retries of a failed request.
+        backend (BackendKind): Backend that completes the conversations.
+        recording (Optional[Path]): JSON Lines file written by the record
+            backend and served by the replay backend.
+        metrics_port (Optional[int]): Port where Prometheus metrics are
+            served.
+        trace_endpoint (Optional[str]): OTLP/HTTP endpoint where a span of
+            every request is sent.
+        metrics_path (Optional[Path]): JSON Lines file where every request
+            is recorded.
+        coalesce (bool): Whether identical requests in flight share one
+            upstream request.
+        usage_path (Optional[Path]): Directory where every request is
+            exported in a columnar format.
+    """
+    from rich.table import Table
+
+    from .batch import run_batch
+    from .metrics import open_metrics
+
+    completion_backend = open_backend(backend, recording)
+    metrics = open_metrics(
+        metrics_port, trace_endpoint, metrics_path, usage_path
+    )
+    response_cache = ResponseCache(path=cache_path) if cache_path else None
+    scheduler = Scheduler(
+        requests_per_minute, tokens_per_minute, max_retries, coalesce=coalesce
+    )
+    try:
+        report = asyncio.run(
+            run_batch(
+                input_path,
+                output_path,
+                workers,
+                model,
+                response_cache,
+                scheduler,
+                completion_backend,
+                (metrics.add_call,) if metrics else (),
+            )
+        )
+    finally:
+        if response_cache is not None:
+            response_cache.close()
+        if metrics:
+            metrics.close()
+    report_table = Table(title="Batch statistics")
+    report_table.add_column("Metric", style="cyan")
+    report_table.add_column("Value", style="cyan")
+    report_table.add_row("Conversations", str(report.conversations))
+    report_table.add_row("Skipped", str(report.skipped))
+    report_table.add_row("Errors", str(report.errors))
+    report_table.add_row("Requests", str(report.requests))
+    report_table.add_row("Retries", str(report.usage.retries))
+    report_table.add_row("Cache Hits", str(report.usage.cache_hits))
+    report_table.add_row("Requests/s", f"{report.throughput:.2f}")
+    for percent in (50, 90, 99):
+        report_table.add_row(
+            f"Latency p{percent}", f"{report.latency(percent):.3f}s"
+        )
+    report_table.add_row(
+        "Avg Time To First Token",
+        f"{report.usage.average_time_to_first_token:.3f}s",
+    )
+    report_table.add_row("Prompt Tokens", str(report.prompt_tokens))
+    report_table.add_row("Completion Tokens", str(report.completion_tokens))
+    print(report_table)
+
+
+def bench(
+    history: Optional[List[int]] = None,
+    turns: int = 50,
+    latency: float = 0.0,
+    token_interval: float = 0.0,
+):
+    """Benchmark the conversation engine and the chat loop offline.
+
+    Args:
+        history (Optional[List[int]]): History sizes to measure.
+        turns (int): Number of turns measured at each history size.
+        latency (float): Seconds the fake backend takes before replying.
+        token_interval (float): Seconds between the tokens of a reply.
+    """
+    from rich.table import Table
+
+    from .benchmark import HISTORY_SIZES, run_benchmarks
+
+    results = run_benchmarks(
+        tuple(history or HISTORY_SIZES),
+        turns,
+        lambda: FakeBackend(latency=latency, token_interval=token_interval),
+    )
+    report_table = Table(title="Benchmark")
+    for column in (
+        "Scenario",
+        "History",
+        "Turns/s",
+        "Latency p50",
+        "Latency p99",
+        "Peak Memory",
+    ):
+        report_table.add_column(column, style="cyan")
+    for result in results:
+        report_table.add_row(
+            result.scenario,
+            str(result.history),
+            f"{result.throughput:.1f}",
+            f"{result.latency(50) * 1e3:.3f}ms",
+            f"{result.latency(99) * 1e3:.3f}ms",
+            f"{result.peak_memory / 1024:.1f}KiB",
+        )
+    print(report_table)
+
+
+def cache_eval(
+    pairs_path: Path, thresholds: Optional[List[float]] = None
+) -> None:
+    """Measure the hit and false hit rates of the semantic cache offline.
+
+    Args:
+        pairs_path (Path): JSON Lines file of labelled question pairs, each
+            with a "first" and a "second" question and whether they are the
+            "same" question.
+        thresholds (Optional[List[float]]): Similarity thresholds to measure.
+    """
+    from rich.table import Table
+
+    from .semantic import evaluate
+
+    with open(pairs_path, encoding="utf-8") as file:
+        pairs = [json.loads(line) for line in file if line.strip()]
+    pairs = [(pair["first"], pair["second"], pair["same"]) for pair in pairs]
+    report_table = Table(title="Semantic Cache")
+    for column in ("Threshold", "Hit Rate", "False Hit Rate"):
+        report_table.add_column(column, style="cyan")
+    for threshold in thresholds or (0.6, 0.7, 0.8, 0.9):
+        evaluation = evaluate(pairs, threshold)
+        report_table.add_row(
+            f"{threshold:.2f}",
+            f"{evaluation.hit_rate:.1%}",
+            f"{evaluation.false_hit_rate:.1%}",
+        )
+    print(report_table)
+
+
+def replay(
+    trace_path: Path,
+    speedup: float = 1.0,
+    latency: float = 0.0,
+    latency_sigma: float = 0.0,
+    token_interval: float = 0.0,
+    error_rate: float = 0.0,
+    seed: Optional[int] = None,
+    concurrency: int = 64,
+    memory: bool = True,
+    output_path: Optional[Path] = None,
+    baseline_path: Optional[Path] = None,
+    tolerance: float = 0.1,
+):
+    """Replay recorded sessions as load against a fake backend.
+
+    Args:
+        trace_path (Path): Trace of the sessions, such as the one written by
+            the server with `--trace`.
+        speedup (float): Multiplier of the rate of the recorded traffic.
+        latency (float): Median seconds the fake backend takes to reply.
+        latency_sigma (float): Spread of the log-normal latency.
+        token_interval (float): Seconds between the tokens of a reply.
+        error_rate (float): Probability that a request fails.
+        seed (Optional[int]): Seed of the latencies and errors.
+        concurrency (int): Maximum number of requests in flight.
+        memory (bool): Whether the memory per session is measured.
+        output_path (Optional[Path]): File where the report is written as
+            JSON. Printed if None.
+        baseline_path (Optional[Path]): Report of a baseline run. The
+            command fails if the run regressed from it.
+        tolerance (float): Fraction by which the throughput, latency and
+            memory may be worse than the baseline.
+    """
+    from rich.console import Console
+
+    from . import loadgen
+
+    backend = FakeBackend(
+        latency=latency,
+        token_interval=token_interval,
+        latency_sigma=latency_sigma,
+        error_rate=error_rate,
+        seed=seed,
+    )
+    report = asyncio.run(
+        loadgen.replay(
+            loadgen.read_trace(trace_path),
+            backend,
+            speedup,
+            concurrency=concurrency,
+            memory=memory,
+        )
+    ).as_dict()
+    if output_path:
+        output_path.write_text(json.dumps(report, indent=2) + "\n")
+    else:
+        Console().print_json(data=report)
+    if baseline_path:
+        baseline = json.loads(baseline_path.read_text())
+        found = loadgen.regressions(report, baseline, tolerance)
+        for regression in found:
+            print(f"[red]Regression: {regression}[/red]")
+        if found:
+            raise SystemExit(1)
+
+
+def usage_report(
+    usage_path: Path,
+    prices_path: Optional[Path] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    json_output: bool = False,
+):
+    """Report the token spend, latency and cost by model of an export.
+
+    Args:
+        usage_path (Path): Directory of the export, written with
+            `--usage-path`.
+        prices_path (Optional[Path]): JSON file with the dollars per
+            thousand prompt and completion tokens of models, such as
+            {"gpt-4": [0.03, 0.06]}, on top of the known prices.
+        since (Optional[datetime]): Only count the requests from this time.
+        until (Optional[datetime]): Only count the requests before this
+            time.
+        json_output (bool): Whether the report is printed as JSON.
+    """
+    from rich.console import Console
+    from rich.table import Table
+
+    from .usage import PRICES, summarize
+
+    prices = dict(PRICES)
+    if prices_path:
+        prices.update(
+            (model, tuple(rates))
+            for model, rates in json.loads(prices_path.read_text()).items()
+        )
+    models = summarize(
+        usage_path,
+        prices,
+        since.timestamp() if since else None,
+        until.timestamp() if until else None,
+    )
+    rows = [
+        {
+            "model": model.model,
+            "calls": model.calls,
+            "errors": model.errors,
+            "prompt_tokens": model.prompt_tokens,
+            "completion_tokens": model.completion_tokens,
+            "lost_tokens": model.lost_tokens,
+            "latency_p50": model.latency.quantile(50),
+            "latency_p95": model.latency.quantile(95),
+            "latency_p99": model.latency.quantile(99),
+            "cost": model.cost,
+        }
+        for model in sorted(models.values(), key=lambda model: -model.cost)
+    ]
+    if json_output:
+        Console().print_json(data=rows)
+        return
+    report_table = Table(title="Usage")
+    for column in (
+        "Model",
+        "Calls",
+        "Errors",
+        "Prompt Tokens",
+        "Completion Tokens",
+        "Lost Tokens",
+        "Latency p50",
+        "Latency p95",
+        "Latency p99",
+        "Cost",
+    ):
+        report_table.add_column(column, style="cyan")
+    for row in rows:
+        report_table.add_row(
+            row["model"],
+            str(row["calls"]),
+            str(row["errors"]),
+            str(row["prompt_tokens"]),
+            str(row["completion_tokens"]),
+            str(row["lost_tokens"]),
+            f"{row['latency_p50'] * 1e3:.1f}ms",
+            f"{row['latency_p95'] * 1e3:.1f}ms",
+            f"{row['latency_p99'] * 1e3:.1f}ms",
+            f"${row['cost']:.4f}",
+        )
+    report_table.add_row(
+        "Total",
+        str(sum(row["calls"] for row in rows)),
+        str(sum(row["errors"] for row in rows)),
+        str(sum(row["prompt_tokens"] for row in rows)),
+        str(sum(row["completion_tokens"] for row in rows)),
+        str(sum(row["lost_tokens"] for row in rows)),
+        "",
+        "",
+        "",
+        f"${sum(row['cost'] for row in rows):.4f}",
+    )
+    print(report_table)
@@ -0,0 +1,106 @@
+"""Compaction of long conversations into a rolling summary."""
+import collections
+import threading
+from dataclasses import dataclass, field
+from typing import Optional
+
+from .cache import request_key
+from .message import Message
+
+SUMMARY_REQUEST = Message(
+    "user",
+    "Summarize the conversation so far in a few sentences. Keep every fact,"
+    " decision and open question needed to continue it.",
+)
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+
+@dataclass
+class Compactor:
+    """Folds the oldest messages of a conversation into a rolling summary.
+
+    Once the messages of a conversation take more than `threshold` tokens,
+    all but the newest `keep` are summarized, together with the previous
+    summary, and replaced by the new summary. Summaries are cached by the
+    request that produced them, so the same prefix is never summarized
+    twice.
+
+    Attributes:
+        threshold (int): Tokens of the messages that trigger a compaction.
+        keep (int): Number of newest messages kept as they are.
+        model (str): Model used for the summaries.
+        max_tokens (int): Maximum number of tokens of a summary.
+        max_cached (int): Maximum number of summaries kept in the cache.
+    """
+
+    threshold: int
+    keep: int = 4
+    model: str = "gpt-3.5-turbo"
+    max_tokens: int = 256
+    max_cached: int = 128
+    _summaries: collections.OrderedDict = field(
+        default_factory=collections.OrderedDict, init=False, repr=False
+    )
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False
+    )
+
+    def __post_init__(self):
+        if self.threshold < 1:
+            raise ValueError("Threshold must be at least 1.")
+        if self.keep < 0:
+            raise ValueError("Messages kept must be positive.")
+
+    def due(self, messages: list[Message]) -> bool:
+        """Return whether the messages should be compacted."""
+        return len(messages) > self.keep and (
+            sum(message.tokens for message in messages) > self.threshold
+        )
+
+    def request(
+        self, summary: Optional[Message], messages: list[Message]
+    ) -> dict:
+        """Build the request that summarizes messages.
+
+        Args:
+            summary (Optional[Message]): Summary of the messages before them.
+            messages (list[Message]): Messages to summarize.
+
+        Returns:
+            dict: Parameters of the request.
+        """
+        history = [summary.dict] if summary else []
+        history.extend(message.dict for message in messages)
+        history.append(SUMMARY_REQUEST.dict)
+        return dict(
+            model=self.model, messages=history, max_tokens=self.max_tokens
+        )
+
+    def get(self, key: str) -> Optional[Message]:
+        """Return the cached summary of a request, flagged as cached."""
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                return None
+            self._summaries.move_to_end(key)
+        return Message(summary.role, summary.content, summary.cost, True)
+
+    def put(self, key: str, summary: Message) -> None:
+        """Cache the summary of a request."""
+        with self._lock:
+            self._summaries[key] = summary
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > self.max_cached:
+                self._summaries.popitem(last=False)
+
+    @staticmethod
+    def key(request: dict) -> str:
+        """Return the key of a summary request."""
+        return request_key(**request)
+
+    @staticmethod
+    def summary(reply: Message) -> Message:
+        """Turn the reply to a summary request into a summary message."""
+        return Message(
+            "system", SUMMARY_PREFIX + reply.content, reply.cost, reply.cached
+        )
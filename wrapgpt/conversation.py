@@ -1,9 +1,49 @@
 """Defines the Conversation class."""
+import collections
+import contextlib
+import functools
+import threading
+import time
+import uuid
 from dataclasses import dataclass, field
-from typing import Dict, Optional
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+)
 
+from .backend import Backend, OpenAIBackend
+from .cache import ResponseCache, request_key
+from .compaction import SUMMARY_REQUEST, Compactor
 from .cost import Cost
+from .history import PackedHistory
+from .interactions import Call
 from .message import Message
+from .prefix import Prefix
+from .racing import Racer
+from .scheduler import Attempts, Scheduler, default_scheduler
+from .tokens import TOKENS_PER_REPLY
+from .turns import TurnOrder
+from .window import ContextWindow
+
+if TYPE_CHECKING:
+    from .semantic import SemanticCache
+    from .store import ConversationStore
+
+
+def _locked(method: Callable) -> Callable:
+    """Run a method of a conversation while holding its lock."""
+
+    @functools.wraps(method)
+    def locked(self: "Conversation", *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return locked
 
 
 @dataclass
@@ -13,60 +53,962 @@ class Conversation:
     Attributes:
         _context (Optional[Message]): Context of the conversation.
         _messages (list[Message]): Messages in the conversation.
+        cost (Cost): Cost of all the requests made for the conversation.
+        suggestion_cost (Cost): Part of the cost spent on suggesting prompts.
+        compaction_cost (Cost): Part of the cost spent on summarizing old
+            messages.
+        lost_cost (Cost): Part of the cost spent on requests that lost a
+            race, estimated. Includes the usage of the completions that
+            lost a synchronous race: they finish on their own threads, so
+            their usage is queued and added at the next request.
+        _summary (Optional[Message]): Summary of the messages compacted
+            away, sent right after the context.
+        window (Optional[ContextWindow]): Chooses which messages are sent.
+            All of them are sent if None.
+        id (str): Unique identifier of the conversation.
+        store (Optional[ConversationStore]): Store where every change to the
+            conversation is recorded.
+        cache (Optional[ResponseCache]): Cache of replies to identical
+            requests.
+        semantic_cache (Optional[SemanticCache]): Cache of replies to
+            paraphrases of the last question, looked up when `cache` misses.
+            Prompt suggestions and summaries never go through it.
+        scheduler (Scheduler): Scheduler that paces and retries the requests.
+            Shared by all the conversations by default.
+        backend (Backend): Backend that completes the conversation. The
+            OpenAI API with the key of the environment by default.
+        model (str): Model used for the completions, unless a request
+            chooses another one.
+        racer (Optional[Racer]): Races or hedges the replies over other
+            routes. Prompt suggestions and summaries are never raced.
+        compactor (Optional[Compactor]): Summarizes the oldest messages once
+            the history grows too long. The history is never compacted if
+            None.
+        listeners (list[Callable[[Call], None]]): Called with the record of
+            every request made for the conversation, such as
+            `SessionInteractions.add_call`.
+        packed (bool): Whether the messages are kept in a `PackedHistory`,
+            which takes a fraction of the memory of a list of messages.
+        spill_bytes (Optional[int]): Bytes of content a packed history keeps
+            in memory before moving it to a memory-mapped file. Never moved
+            if None.
+        thread_safe (bool): Whether the conversation can be used from
+            several threads at once. Its state is then changed under a lock,
+            the payloads handed out are copied before they are changed, and
+            the turns run one at a time, in the order they were sent.
 
     Properties:
         dict (list[Dict[str, str]]): Dictionary representation of the
             conversation.
         messages (list[Message]): Messages in the conversation.
         context (Optional[Message]): Context of the conversation.
+        summary (Optional[Message]): Summary of the compacted messages.
+        prefix (Prefix): Stable start of the next payloads.
     """
 
     _context: Optional[Message] = None
     _messages: list[Message] = field(default_factory=list)
     cost: Cost = field(default_factory=Cost)
+    suggestion_cost: Cost = field(default_factory=Cost)
+    compaction_cost: Cost = field(default_factory=Cost)
+    lost_cost: Cost = field(default_factory=Cost)
+    _summary: Optional[Message] = None
+    window: Optional[ContextWindow] = None
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    store: Optional["ConversationStore"] = field(
+        default=None, repr=False, compare=False
+    )
+    cache: Optional[ResponseCache] = field(
+        default=None, repr=False, compare=False
+    )
+    semantic_cache: Optional["SemanticCache"] = field(
+        default=None, repr=False, compare=False
+    )
+    scheduler: Scheduler = field(
+        default_factory=default_scheduler, repr=False, compare=False
+    )
+    backend: Backend = field(
+        default_factory=OpenAIBackend.from_env, repr=False, compare=False
+    )
+    model: str = "gpt-3.5-turbo"
+    racer: Optional[Racer] = field(default=None, repr=False, compare=False)
+    compactor: Optional[Compactor] = field(
+        default=None, repr=False, compare=False
+    )
+    listeners: list[Callable[[Call], None]] = field(
+        default_factory=list, repr=False, compare=False
+    )
+    packed: bool = field(default=False, repr=False, compare=False)
+    spill_bytes: Optional[int] = field(default=None, repr=False, compare=False)
+    _payload: Optional[list[Dict[str, str]]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _compacting: bool = field(
+        default=False, init=False, repr=False, compare=False
+    )
+    thread_safe: bool = field(default=False, repr=False, compare=False)
+    _generation: int = field(default=0, init=False, repr=False, compare=False)
+    _preamble_prefix: Optional[Prefix] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _history_prefix: Optional[Prefix] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _payload_shared: bool = field(
+        default=False, init=False, repr=False, compare=False
+    )
+    _late_lost: collections.deque[Cost] = field(
+        default_factory=collections.deque,
+        init=False,
+        repr=False,
+        compare=False,
+    )
+
+    def __post_init__(self):
+        self._lock = (
+            threading.RLock() if self.thread_safe else contextlib.nullcontext()
+        )
+        self._turns = TurnOrder() if self.thread_safe else None
+        if self.packed and not isinstance(self._messages, PackedHistory):
+            self._messages = self._new_history(self._messages)
+
+    def _new_history(self, messages: Iterable[Message] = ()) -> list[Message]:
+        """Return a history of messages, packed if the conversation is."""
+        if self.packed:
+            return PackedHistory(messages, self.spill_bytes)
+        return list(messages)
+
+    @classmethod
+    def resume(
+        cls,
+        store: "ConversationStore",
+        conversation_id: str,
+        last: Optional[int] = None,
+        **kwargs,
+    ) -> "Conversation":
+        """Resume a conversation recorded in a store.
+
+        Args:
+            store (ConversationStore): Store where the conversation is
+                recorded. New changes are recorded there too.
+            conversation_id (str): Id of the conversation.
+            last (Optional[int]): Number of messages to load, counting from
+                the newest. All of them if None.
+            **kwargs: Other attributes of the conversation.
+
+        Returns:
+            Conversation: Resumed conversation.
+        """
+        stored = store.load(conversation_id, last)
+        return cls(
+            _context=stored.context,
+            _messages=stored.messages,
+            cost=stored.cost,
+            suggestion_cost=stored.suggestion_cost,
+            compaction_cost=stored.compaction_cost,
+            lost_cost=stored.lost_cost,
+            _summary=stored.summary,
+            id=conversation_id,
+            store=store,
+            **kwargs,
+        )
 
     @property
+    @_locked
     def dict(self) -> list[Dict[str, str]]:
         """Build the dictionary representation of the conversation.
 
         Builds a list of dictionaries, where each dictionary represents a
         message in the conversation. The dictionary has two keys:
         "role" and "content". The role is added first, followed by the
-        content of the message. The context is added first, if it exists.
+        content of the message. The context is added first, if it exists,
+        followed by the summary of the compacted messages, if any. Only the
+        messages chosen by the window are included.
+
+        When all the messages are sent, the list is maintained incrementally
+        as messages are added instead of being built on every call, so it
+        must not be modified. Thread-safe conversations copy it before the
+        next message is added once it was handed out. Packed conversations
+        build it on every call instead, so that the contents are not kept in
+        memory twice.
 
         Returns:
             list[Dict[str, str]]: Dictionary representation of the
                 conversation.
         """
-        messages = []
-        if self._context:
-            messages.append(self._context.dict)
-        for message in self._messages:
+        window_messages = self.window_messages
+        if window_messages is self._messages:
+            return self._full_payload()
+        messages = self._preamble()
+        for message in window_messages:
             messages.append(message.dict)
         return messages
 
+    def _full_payload(self) -> list[Dict[str, str]]:
+        """Return the payload with all the messages, rebuilding it if stale."""
+        if self.packed:
+            return self._preamble() + [
+                message.dict for message in self._messages
+            ]
+        payload = self._payload
+        size = len(self._messages) + bool(self._context) + bool(self._summary)
+        if payload is None or len(payload) != size:
+            payload = self._preamble()
+            payload.extend(message.dict for message in self._messages)
+            self._payload = payload
+        self._payload_shared = self.thread_safe
+        return payload
+
+    def _preamble(self) -> list[Dict[str, str]]:
+        """Return the context and the summary, the start of every payload."""
+        preamble = [self._context.dict] if self._context else []
+        if self._summary:
+            preamble.append(self._summary.dict)
+        return preamble
+
+    @property
+    @_locked
+    def prefix(self) -> Prefix:
+        """Return the stable start of the next payloads.
+
+        The prefix is the context and the summary, followed by all the
+        messages when no window limits them, since the payloads then only grow
+        until the history is reset or compacted. It is hashed and its tokens
+        are counted once, then extended as messages are added.
+        """
+        if self._preamble_prefix is None:
+            preamble = [self._context] if self._context else []
+            if self._summary:
+                preamble.append(self._summary)
+            self._preamble_prefix = Prefix().extend(preamble)
+        if self._windowed:
+            return self._preamble_prefix
+        if self._history_prefix is None:
+            self._history_prefix = self._preamble_prefix.extend(self._messages)
+        return self._history_prefix
+
+    @property
+    def _windowed(self) -> bool:
+        """Return whether a window may leave messages out of the payloads."""
+        return self.window is not None and self.window.limited
+
+    def _invalidate_payload(self) -> None:
+        """Forget the payload and its prefix, once its start changed."""
+        self._payload = None
+        self._payload_shared = False
+        self._preamble_prefix = None
+        self._history_prefix = None
+
+    @property
+    def window_messages(self) -> list[Message]:
+        """Return the messages that fit in the context window."""
+        if not self.window:
+            return self._messages
+        budget = self.window.max_tokens
+        if budget is not None:
+            budget -= TOKENS_PER_REPLY
+            if self._context:
+                budget -= self._context.tokens
+            if self._summary:
+                budget -= self._summary.tokens
+        return self.window.select(self._messages, budget)
+
+    @_locked
     def add_message(self, message: Message) -> None:
         """Add a message to the conversation.
 
+        The cost of the message is added to the cost of the conversation,
+        unless the message was served from a cache.
+
         Args:
             message (Message): Message to add to the conversation.
         """
         self._messages.append(message)
-        self.cost += message.cost
+        if self._payload_shared:
+            self._payload = [*self._payload, message.dict]
+            self._payload_shared = False
+        elif self._payload is not None:
+            self._payload.append(message.dict)
+        if self._history_prefix is not None:
+            self._history_prefix = self._history_prefix.extend([message])
+        if not message.cached:
+            self.cost += message.cost
+        if self.store:
+            self.store.add_message(self.id, message)
+
+    def send(
+        self, message: Optional[Message] = None, model: Optional[str] = None
+    ) -> Message:
+        """Send a message and wait for the whole completion.
+
+        The message, if any, and the reply are both added to the conversation.
+        The reply is served from the cache when the same request was already
+        made.
+
+        Args:
+            message (Optional[Message]): Message to send.
+            model (Optional[str]): Model used for the completion. The model
+                of the conversation if None.
+
+        Returns:
+            Message: Reply of the chatbot.
+        """
+        with self._turn():
+            return self._send(message, model)
+
+    async def asend(
+        self, message: Optional[Message] = None, model: Optional[str] = None
+    ) -> Message:
+        """Asynchronous version of `send`."""
+        async with self._aturn():
+            return await self._asend(message, model)
+
+    def stream(
+        self, message: Optional[Message] = None, model: Optional[str] = None
+    ) -> Iterator[str]:
+        """Send a message and yield the reply as it is generated.
+
+        The reply is assembled from the deltas and added to the conversation,
+        together with its cost, once the stream ends. The API does not report
+        usage for streamed completions, so the prompt tokens are counted
+        locally and each content delta is counted as one completion token.
+        A cached reply is yielded all at once.
+
+        Args:
+            message (Optional[Message]): Message to send.
+            model (Optional[str]): Model used for the completion. The model
+                of the conversation if None.
+
+        Yields:
+            str: Content deltas of the reply.
+        """
+        with self._turn():
+            yield from self._stream(message, model)
+
+    async def astream(
+        self, message: Optional[Message] = None, model: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """Asynchronous version of `stream`."""
+        async with self._aturn():
+            async for delta in self._astream(message, model):
+                yield delta
+
+    def _turn(self) -> contextlib.AbstractContextManager:
+        """Wait for the turn of a message, if the turns are ordered."""
+        return self._turns.turn() if self._turns else contextlib.nullcontext()
+
+    def _aturn(self) -> contextlib.AbstractAsyncContextManager:
+        """Asynchronous version of `_turn`."""
+        return self._turns.aturn() if self._turns else contextlib.nullcontext()
+
+    @_locked
+    def _snapshot(self, model: str) -> tuple[dict, Prefix, int, int]:
+        """Build the next request and what is known of it, consistently.
+
+        Returns:
+            tuple[dict, Prefix, int, int]: Request, prefix of its messages,
+                its prompt tokens and the number of messages left out of it.
+        """
+        request = dict(model=model, messages=self.dict)
+        return request, self.prefix, self.tokens, self._truncated(request)
+
+    def _send(
+        self, message: Optional[Message] = None, model: Optional[str] = None
+    ) -> Message:
+        model = model or self.model
+        if message:
+            self.add_message(message)
+        start = time.perf_counter()
+        request, prefix, tokens, truncated = self._snapshot(model)
+        key, reply = self.lookup(request, semantic=True, prefix=prefix)
+        attempts = Attempts(self.backend.complete)
+        if reply is None:
+            try:
+                reply = self._call("complete", attempts, tokens, request)
+                reply = self.claim(reply, attempts)
+            except Exception as error:
+                self.record_call(
+                    model,
+                    None,
+                    start,
+                    attempts,
+                    truncated=truncated,
+                    error=error,
+                )
+                raise
+            self.remember(key, reply, request)
+        self.add_message(reply)
+        self.record_call(model, reply, start, attempts, truncated=truncated)
+        return reply
+
+    async def _asend(
+        self, message: Optional[Message] = None, model: Optional[str] = None
+    ) -> Message:
+        model = model or self.model
+        if message:
+            self.add_message(message)
+        start = time.perf_counter()
+        request, prefix, tokens, truncated = self._snapshot(model)
+        key, reply = self.lookup(request, semantic=True, prefix=prefix)
+        attempts = Attempts(self.backend.acomplete)
+        if reply is None:
+            try:
+                reply = await self._acall(
+                    "acomplete", attempts, tokens, request
+                )
+                reply = self.claim(reply, attempts)
+            except Exception as error:
+                self.record_call(
+                    model,
+                    None,
+                    start,
+                    attempts,
+                    truncated=truncated,
+                    error=error,
+                )
+                raise
+            self.remember(key, reply, request)
+        self.add_message(reply)
+        self.record_call(model, reply, start, attempts, truncated=truncated)
+        return reply
+
+    def _stream(
+        self, message: Optional[Message] = None, model: Optional[str] = None
+    ) -> Iterator[str]:
+        model = model or self.model
+        if message:
+            self.add_message(message)
+        start = time.perf_counter()
+        request, prefix, tokens, truncated = self._snapshot(model)
+        key, reply = self.lookup(request, semantic=True, prefix=prefix)
+        if reply is not None:
+            yield reply.content
+            self.add_message(reply)
+            self.record_call(model, reply, start, truncated=truncated)
+            return
+        cost = Cost(tokens)
+        attempts = Attempts(self.backend.stream)
+        content = []
+        first_token = None
+        try:
+            deltas = self._call(
+                "stream", attempts, cost.prompt_tokens, request
+            )
+            for delta in deltas:
+                if first_token is None:
+                    first_token = time.perf_counter()
+                content.append(delta)
+                yield delta
+        except Exception as error:
+            self.record_call(
+                model,
+                None,
+                start,
+                attempts,
+                first_token,
+                truncated=truncated,
+                error=error,
+            )
+            raise
+        reply = self.claim(self._streamed_reply(cost, content), attempts)
+        self.remember(key, reply, request)
+        self.add_message(reply)
+        self.record_call(
+            model, reply, start, attempts, first_token, truncated=truncated
+        )
+
+    async def _astream(
+        self, message: Optional[Message] = None, model: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        model = model or self.model
+        if message:
+            self.add_message(message)
+        start = time.perf_counter()
+        request, prefix, tokens, truncated = self._snapshot(model)
+        key, reply = self.lookup(request, semantic=True, prefix=prefix)
+        if reply is not None:
+            yield reply.content
+            self.add_message(reply)
+            self.record_call(model, reply, start, truncated=truncated)
+            return
+        cost = Cost(tokens)
+        attempts = Attempts(self.backend.astream)
+        content = []
+        first_token = None
+        try:
+            deltas = await self._acall(
+                "astream", attempts, cost.prompt_tokens, request
+            )
+            async for delta in deltas:
+                if first_token is None:
+                    first_token = time.perf_counter()
+                content.append(delta)
+                yield delta
+        except Exception as error:
+            self.record_call(
+                model,
+                None,
+                start,
+                attempts,
+                first_token,
+                truncated=truncated,
+                error=error,
+            )
+            raise
+        reply = self.claim(self._streamed_reply(cost, content), attempts)
+        self.remember(key, reply, request)
+        self.add_message(reply)
+        self.record_call(
+            model, reply, start, attempts, first_token, truncated=truncated
+        )
+
+    def _call(
+        self, method: str, attempts: Attempts, tokens: int, request: dict
+    ):
+        """Make a request for a reply, raced if there is a racer.
+
+        Args:
+            method (str): Method of the backend that makes the request.
+            attempts (Attempts): Attempts of the request to the backend.
+            tokens (int): Estimated number of tokens of the request.
+            request (dict): Parameters of the request.
+
+        Returns:
+            Result of the request, a reply or its deltas.
+        """
+        self._add_late_lost_cost()
+        if self.racer is None:
+            return self.scheduler.call(attempts, tokens, **request)
+        result = self.racer.call(
+            self.scheduler,
+            method,
+            attempts,
+            tokens,
+            request,
+            on_lost=self._late_lost.append,
+        )
+        self.add_lost_cost(attempts.lost)
+        return result
+
+    async def _acall(
+        self, method: str, attempts: Attempts, tokens: int, request: dict
+    ):
+        """Asynchronous version of `_call`."""
+        self._add_late_lost_cost()
+        if self.racer is None:
+            return await self.scheduler.acall(attempts, tokens, **request)
+        result = await self.racer.acall(
+            self.scheduler, method, attempts, tokens, request
+        )
+        self.add_lost_cost(attempts.lost)
+        return result
+
+    def compact(self) -> Optional[Message]:
+        """Summarize the oldest messages if the history is too long.
+
+        The summarized messages are replaced by the summary, which also
+        folds in the previous one. Nothing is done if there is no compactor,
+        if the history is short enough, or if a compaction is in progress.
+
+        Returns:
+            Optional[Message]: New summary, None if there was no compaction.
+        """
+        compaction = self._plan_compaction()
+        if compaction is None:
+            return None
+        folded, request, key, generation = compaction
+        start = time.perf_counter()
+        attempts = Attempts(self.backend.complete)
+        try:
+            summary = self.compactor.get(key)
+            if summary is None:
+                reply = self.scheduler.call(
+                    attempts, self._compaction_tokens(folded), **request
+                )
+                summary = self.compactor.summary(self.claim(reply, attempts))
+                self.compactor.put(key, summary)
+        except Exception as error:
+            self.record_call(
+                request["model"],
+                None,
+                start,
+                attempts,
+                error=error,
+                compaction=True,
+            )
+            raise
+        finally:
+            self._compacting = False
+        self.record_call(
+            request["model"], summary, start, attempts, compaction=True
+        )
+        self._apply_summary(summary, len(folded), generation)
+        return summary
+
+    async def acompact(self) -> Optional[Message]:
+        """Asynchronous version of `compact`."""
+        compaction = self._plan_compaction()
+        if compaction is None:
+            return None
+        folded, request, key, generation = compaction
+        start = time.perf_counter()
+        attempts = Attempts(self.backend.acomplete)
+        try:
+            summary = self.compactor.get(key)
+            if summary is None:
+                reply = await self.scheduler.acall(
+                    attempts, self._compaction_tokens(folded), **request
+                )
+                summary = self.compactor.summary(self.claim(reply, attempts))
+                self.compactor.put(key, summary)
+        except Exception as error:
+            self.record_call(
+                request["model"],
+                None,
+                start,
+                attempts,
+                error=error,
+                compaction=True,
+            )
+            raise
+        finally:
+            self._compacting = False
+        self.record_call(
+            request["model"], summary, start, attempts, compaction=True
+        )
+        self._apply_summary(summary, len(folded), generation)
+        return summary
+
+    @_locked
+    def _plan_compaction(
+        self,
+    ) -> Optional[tuple[list[Message], dict, str, int]]:
+        """Choose the messages to compact, if it is time to.
+
+        The conversation is marked as compacting until the compaction ends.
+
+        Returns:
+            Optional[tuple[list[Message], dict, str, int]]: Messages to
+                summarize, request that summarizes them, its key and the
+                generation of the messages. None if there is nothing to
+                compact.
+        """
+        compactor = self.compactor
+        if (
+            compactor is None
+            or self._compacting
+            or not compactor.due(self._messages)
+        ):
+            return None
+        folded = self._messages[: len(self._messages) - compactor.keep]
+        request = compactor.request(self._summary, folded)
+        self._compacting = True
+        return folded, request, compactor.key(request), self._generation
+
+    def _compaction_tokens(self, folded: list[Message]) -> int:
+        """Return the prompt tokens of the request that summarizes messages."""
+        tokens = TOKENS_PER_REPLY + SUMMARY_REQUEST.tokens
+        if self._summary:
+            tokens += self._summary.tokens
+        return tokens + sum(message.tokens for message in folded)
+
+    @_locked
+    def _apply_summary(
+        self, summary: Message, count: int, generation: Optional[int] = None
+    ) -> None:
+        """Replace the oldest messages by their summary.
+
+        The summary is discarded if the messages were reset or compacted
+        while it was being made.
+
+        Args:
+            summary (Message): Summary of the messages.
+            count (int): Number of oldest messages summarized.
+            generation (Optional[int]): Generation of the messages when the
+                summary was requested. Not checked if None.
+        """
+        if count > len(self._messages) or (
+            generation is not None and generation != self._generation
+        ):
+            return
+        self._summary = summary
+        self._messages = self._messages[count:]
+        self._invalidate_payload()
+        self._generation += 1
+        if not summary.cached:
+            self.cost += summary.cost
+            self.compaction_cost += summary.cost
+        if self.store:
+            self.store.set_summary(self.id, summary, count)
+
+    def lookup(
+        self,
+        request: dict,
+        semantic: bool = False,
+        prefix: Optional[Prefix] = None,
+    ) -> tuple[Optional[str], Optional[Message]]:
+        """Look up the reply to a request in the caches.
+
+        Args:
+            request (dict): Parameters of the request.
+            semantic (bool): Whether a reply to a paraphrase of the request
+                is looked up when there is no reply to the request itself.
+            prefix (Optional[Prefix]): Prefix the messages of the request
+                start with, so that only the rest is hashed into the key.
+
+        Returns:
+            tuple[Optional[str], Optional[Message]]: Key of the request, None
+                if there is no cache, and cached reply, if any.
+        """
+        key = reply = None
+        if self.cache is not None:
+            key = prefix.key(request) if prefix else request_key(**request)
+            reply = self.cache.get(key)
+        if reply is None and semantic and self.semantic_cache is not None:
+            reply = self.semantic_cache.get(request)
+        return key, reply
+
+    def remember(
+        self,
+        key: Optional[str],
+        reply: Message,
+        request: Optional[dict] = None,
+    ) -> None:
+        """Cache the reply to a request.
+
+        Args:
+            key (Optional[str]): Key of the request in `cache`.
+            reply (Message): Reply to the request.
+            request (Optional[dict]): Request, to cache the reply to its
+                paraphrases too.
+        """
+        if self.cache is not None and key:
+            self.cache.put(key, reply)
+        if request is not None and self.semantic_cache is not None:
+            self.semantic_cache.put(request, reply)
+
+    def record_call(
+        self,
+        model: str,
+        reply: Optional[Message],
+        start: float,
+        attempts: Optional[Attempts] = None,
+        first_token: Optional[float] = None,
+        suggestion: bool = False,
+        truncated: int = 0,
+        error: Optional[BaseException] = None,
+        compaction: bool = False,
+    ) -> Call:
+        """Record a request and pass it to the listeners.
 
+        Args:
+            model (str): Model used for the completion, unless another one
+                won the race.
+            reply (Optional[Message]): Reply to the request. None if it
+                failed.
+            start (float): `time.perf_counter` when the request started.
+            attempts (Optional[Attempts]): Attempts of the request. None if
+                it was not made.
+            first_token (Optional[float]): `time.perf_counter` when the first
+                token arrived. The end of the request if None.
+            suggestion (bool): Whether the request suggested a prompt.
+            truncated (int): Number of messages left out of the request by
+                the window.
+            error (Optional[BaseException]): Error of the request, if it
+                failed.
+            compaction (bool): Whether the request summarized old messages.
+
+        Returns:
+            Call: Record of the request.
+        """
+        end = time.perf_counter()
+        cost = reply.cost if reply else Cost()
+        call = Call(
+            model=attempts.model if attempts and attempts.model else model,
+            prompt_tokens=cost.prompt_tokens,
+            completion_tokens=cost.completion_tokens,
+            latency=end - start,
+            time_to_first_token=(first_token or end) - start,
+            cached=reply.cached if reply else False,
+            retries=attempts.retries if attempts else 0,
+            shared=attempts.shared if attempts else False,
+            raced=attempts.raced if attempts else 1,
+            lost_tokens=attempts.lost.total if attempts else 0,
+            suggestion=suggestion,
+            truncated=truncated,
+            error=type(error).__name__ if error else None,
+            compaction=compaction,
+            lost_usage=dict(attempts.lost_usage) if attempts else {},
+        )
+        for listener in self.listeners:
+            listener(call)
+        return call
+
+    @staticmethod
+    def claim(reply: Message, attempts: Attempts) -> Message:
+        """Return the reply of a request, as a copy if it was shared.
+
+        A reply shared with an identical request in flight is paid for by
+        that request, so the copy is flagged as cached and its cost is not
+        spent again.
+
+        Args:
+            reply (Message): Reply returned by the scheduler.
+            attempts (Attempts): Attempts of the request.
+
+        Returns:
+            Message: Reply owned by the conversation.
+        """
+        if not attempts.shared:
+            return reply
+        return Message(reply.role, reply.content, reply.cost, cached=True)
+
+    def _truncated(self, request: dict) -> int:
+        """Return the number of messages left out of a request."""
+        sent = len(request["messages"]) - len(self._preamble())
+        return len(self._messages) - sent
+
+    @staticmethod
+    def _streamed_reply(cost: Cost, content: list[str]) -> Message:
+        """Assemble a streamed reply.
+
+        Args:
+            cost (Cost): Estimated cost of the request.
+            content (list[str]): Content deltas of the reply.
+
+        Returns:
+            Message: Reply, with each delta counted as a completion token.
+        """
+        return Message(
+            role="assistant",
+            content="".join(content),
+            cost=Cost(cost.prompt_tokens, len(content)),
+        )
+
+    @property
+    @_locked
+    def tokens(self) -> int:
+        """Return the number of prompt tokens of the next request.
+
+        The tokens are counted locally, so no request is needed. Only the
+        messages that fit in the window are counted, and the ones of the
+        prefix are only counted once.
+        """
+        if not self._windowed:
+            return TOKENS_PER_REPLY + self.prefix.tokens
+        tokens = TOKENS_PER_REPLY
+        if self._context:
+            tokens += self._context.tokens
+        if self._summary:
+            tokens += self._summary.tokens
+        return tokens + sum(message.tokens for message in self.window_messages)
+
+    def estimate_cost(self, completion_tokens: int = 0) -> Cost:
+        """Estimate the cost of the next request before making it.
+
+        Args:
+            completion_tokens (int): Expected number of completion tokens.
+
+        Returns:
+            Cost: Estimated cost of the request.
+        """
+        return Cost(
+            prompt_tokens=self.tokens, completion_tokens=completion_tokens
+        )
+
+    @property
+    def last(self) -> Optional[Message]:
+        """Return the last message in the conversation."""
+        return self._messages[-1] if self._messages else None
+
+    @_locked
     def add_cost(self, cost: Cost) -> None:
         """Set the cost of the conversation."""
         self.cost += cost
+        if self.store:
+            self.store.add_cost(self.id, cost)
+
+    @_locked
+    def add_suggestion_cost(self, cost: Cost) -> None:
+        """Add the cost of suggesting a prompt to the conversation.
+
+        The cost is added to the total cost of the conversation and is also
+        tracked on its own.
+        """
+        self.cost += cost
+        self.suggestion_cost += cost
+        if self.store:
+            self.store.add_cost(self.id, cost, suggestion=True)
+
+    @_locked
+    def add_lost_cost(self, cost: Cost) -> None:
+        """Add the cost of the requests that lost a race to the conversation.
+
+        The cost is added to the total cost of the conversation and is also
+        tracked on its own.
+        """
+        if not cost.total:
+            return
+        self.cost += cost
+        self.lost_cost += cost
+        if self.store:
+            self.store.add_cost(self.id, cost, lost=True)
+
+    def _add_late_lost_cost(self) -> None:
+        """Add the queued usage of the requests that lost a race late.
+
+        The losers of a synchronous race finish on their own threads and
+        only queue their usage, so the conversation and its store are
+        updated by the thread that makes the requests.
+        """
+        while self._late_lost:
+            self.add_lost_cost(self._late_lost.popleft())
 
     @property
     def messages(self) -> list[Message]:
         """Return the messages in the conversation."""
         return self._messages
 
+    @_locked
+    def pop_message(self) -> Message:
+        """Remove the last message of the conversation.
+
+        Used to take back a prompt whose request failed. The cost of the
+        message is taken off the cost of the conversation.
+
+        Returns:
+            Message: The removed message.
+
+        Raises:
+            IndexError: If the conversation has no messages.
+        """
+        if not self._messages:
+            raise IndexError("The conversation has no messages.")
+        last = self._messages[-1]
+        message = Message(last.role, last.content, last.cost, last.cached)
+        self._messages = self._messages[:-1]
+        self._invalidate_payload()
+        cost = Cost() if message.cached else message.cost
+        self.cost -= cost
+        if self.store:
+            self.store.drop_message(self.id, cost)
+        return message
+
     @messages.deleter
+    @_locked
     def messages(self) -> None:
         """Reset the messages in the conversation."""
-        self._messages = []
+        self._messages = self._new_history()
+        self._summary = None
+        self._invalidate_payload()
+        self._generation += 1
+        if self.store:
+            self.store.reset(self.id)
+
+    @property
+    def summary(self) -> Optional[Message]:
+        """Return the summary of the compacted messages."""
+        return self._summary
 
     @property
     def context(self) -> Optional[Message]:
@@ -74,11 +1016,19 @@ class Conversation:
         return self._context
 
     @context.setter
+    @_locked
     def context(self, message: Message) -> None:
         """Set the context of the conversation."""
         self._context = message
+        self._invalidate_payload()
+        if self.store:
+            self.store.set_context(self.id, message)
 
     @context.deleter
+    @_locked
     def context(self) -> None:
         """Reset the context of the conversation."""
         self._context = None
+        self._invalidate_payload()
+        if self.store:
+            self.store.set_context(self.id, None)
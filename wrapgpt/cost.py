@@ -2,7 +2,7 @@
 from dataclasses import dataclass
 
 
-@dataclass
+@dataclass(slots=True)
 class Cost:
     """Cost class for storing the cost of a prompt and completion.
 
@@ -46,3 +46,17 @@ class Cost:
             self.prompt_tokens + other.prompt_tokens,
             self.completion_tokens + other.completion_tokens,
         )
+
+    def __sub__(self, other: "Cost") -> "Cost":
+        """Take the cost of a prompt and response off this one.
+
+        Args:
+            other: The cost to take off, at most this one.
+
+        Returns:
+            The difference of the two costs.
+        """
+        return Cost(
+            self.prompt_tokens - other.prompt_tokens,
+            self.completion_tokens - other.completion_tokens,
+        )
@@ -0,0 +1,137 @@
+"""Asynchronous engine to run requests to the API concurrently."""
+import asyncio
+from dataclasses import dataclass, field
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    Awaitable,
+    Iterable,
+    Optional,
+    TypeVar,
+)
+
+if TYPE_CHECKING:
+    import aiohttp
+
+T = TypeVar("T")
+
+
+@dataclass
+class Engine:
+    """Runs requests to the API concurrently over a pooled HTTP session.
+
+    All the requests submitted to the engine share the same HTTP session, so
+    connections are reused between them, and at most `concurrency` of them
+    are in flight at the same time. The HTTP stack is imported when the
+    session is opened, by the first request or by `warm`.
+
+    Attributes:
+        concurrency (int): Maximum number of requests in flight.
+    """
+
+    concurrency: int = 8
+    _semaphore: Optional[asyncio.Semaphore] = field(
+        default=None, init=False, repr=False
+    )
+    _session: Optional["aiohttp.ClientSession"] = field(
+        default=None, init=False, repr=False
+    )
+
+    def __post_init__(self):
+        """Ensure that the concurrency limit is valid."""
+        if self.concurrency < 1:
+            raise ValueError("Concurrency must be at least 1.")
+
+    async def __aenter__(self) -> "Engine":
+        """Open the pooled HTTP session."""
+        self._use_session()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        """Close the pooled HTTP session."""
+        await self.close()
+
+    def _use_session(self) -> None:
+        """Make the current task use the pooled HTTP session.
+
+        The session must be created from within a running event loop, so it is
+        opened on the first request.
+        """
+        import aiohttp
+        import openai
+
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency)
+            )
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        openai.aiosession.set(self._session)
+
+    async def warm(self, url: Optional[str] = None) -> None:
+        """Open the pooled HTTP session ahead of the first request.
+
+        Meant to run in the background at startup, such as while the user
+        types the first prompt. Failures are ignored, since the first request
+        connects anyway.
+
+        Args:
+            url (Optional[str]): URL of the API. A connection to it is opened
+                and kept in the pool, so the first request does not pay for
+                the TCP and TLS handshakes. Nothing is connected if None.
+        """
+        self._use_session()
+        if url is None:
+            return
+        try:
+            async with self._session.head(url) as response:
+                await response.read()
+        except Exception:  # the first request reports connection errors
+            pass
+
+    async def submit(self, request: Awaitable[T]) -> T:
+        """Run a request once there is room for it.
+
+        Args:
+            request (Awaitable[T]): Request to run.
+
+        Returns:
+            T: Result of the request.
+        """
+        self._use_session()
+        async with self._semaphore:
+            return await request
+
+    async def stream(self, request: AsyncIterator[T]) -> AsyncIterator[T]:
+        """Stream a request once there is room for it.
+
+        The request keeps its slot until the stream is exhausted.
+
+        Args:
+            request (AsyncIterator[T]): Streamed request to run.
+
+        Yields:
+            T: Items produced by the request.
+        """
+        self._use_session()
+        async with self._semaphore:
+            async for item in request:
+                yield item
+
+    async def gather(self, requests: Iterable[Awaitable[T]]) -> list[T]:
+        """Run many requests concurrently.
+
+        Args:
+            requests (Iterable[Awaitable[T]]): Requests to run.
+
+        Returns:
+            list[T]: Results of the requests, in the same order.
+        """
+        return await asyncio.gather(
+            *(self.submit(request) for request in requests)
+        )
+
+    async def close(self) -> None:
+        """Close the pooled HTTP session."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
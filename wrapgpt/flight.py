@@ -0,0 +1,237 @@
+"""Coalescing of identical requests in flight into one upstream call."""
+import asyncio
+import threading
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Hashable,
+    Iterator,
+    Optional,
+    TypeVar,
+)
+
+T = TypeVar("T")
+
+_END = object()
+
+
+class SingleFlight:
+    """Shares one call between the identical requests made at the same time.
+
+    The first request with a key makes the call, and the requests made with
+    the same key before the call ends wait for it and get its result, or its
+    error. Streamed results, iterators of deltas, are replayed to every
+    request from the first delta as the deltas arrive, and the key stays in
+    flight until the stream ends, so requests made mid-stream join it too.
+
+    Attributes:
+        shared (int): Number of requests that joined a call in flight.
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, _Call] = {}
+        self._tasks: dict[Hashable, asyncio.Task] = {}
+
+    def call(self, key: Hashable, function: Callable[[], T]) -> tuple[T, bool]:
+        """Make a call, or join the identical call in flight.
+
+        Args:
+            key (Hashable): Key of the call, the same for identical calls.
+            function (Callable[[], T]): Makes the call.
+
+        Returns:
+            tuple[T, bool]: Result of the call, and whether it was shared
+                with the call in flight instead of made.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            shared = call is not None
+            if shared:
+                self.shared += 1
+            else:
+                call = self._calls[key] = _Call()
+        if shared:
+            return call.join(), True
+        try:
+            result = function()
+        except BaseException as error:
+            self._land(key)
+            call.fail(error)
+            raise
+        if isinstance(result, Iterator):
+            tee = _Tee(result, lambda: self._land(key))
+            call.succeed(tee)
+            return tee.reader(), False
+        self._land(key)
+        call.succeed(result)
+        return result, False
+
+    async def acall(
+        self, key: Hashable, function: Callable[[], Awaitable[T]]
+    ) -> tuple[T, bool]:
+        """Asynchronous version of `call`.
+
+        The call runs in its own task, so it goes on for the other requests
+        when the one that started it is cancelled.
+        """
+        with self._lock:
+            task = self._tasks.get(key)
+            shared = task is not None
+            if shared:
+                self.shared += 1
+            else:
+                task = asyncio.ensure_future(self._arun(key, function))
+                task.add_done_callback(_retrieve)
+                self._tasks[key] = task
+        result = await asyncio.shield(task)
+        if isinstance(result, _AsyncTee):
+            return result.reader(), shared
+        return result, shared
+
+    async def _arun(self, key: Hashable, function: Callable[[], Awaitable]):
+        try:
+            result = await function()
+        except BaseException:
+            self._aland(key)
+            raise
+        if isinstance(result, AsyncIterator):
+            return _AsyncTee(result, lambda: self._aland(key))
+        self._aland(key)
+        return result
+
+    def _land(self, key: Hashable) -> None:
+        with self._lock:
+            self._calls.pop(key, None)
+
+    def _aland(self, key: Hashable) -> None:
+        with self._lock:
+            self._tasks.pop(key, None)
+
+
+def _retrieve(task: asyncio.Task) -> None:
+    """Mark the error of a call as retrieved, even if nobody waits for it."""
+    if not task.cancelled():
+        task.exception()
+
+
+class _Call:
+    """Result of a synchronous call in flight."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error: Optional[BaseException] = None
+
+    def succeed(self, result) -> None:
+        self._result = result
+        self._done.set()
+
+    def fail(self, error: BaseException) -> None:
+        self._error = error
+        self._done.set()
+
+    def join(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        if isinstance(self._result, _Tee):
+            return self._result.reader()
+        return self._result
+
+
+class _Tee:
+    """Replays a stream to many readers, pulled by whichever needs more."""
+
+    def __init__(self, source: Iterator, on_end: Callable[[], None]):
+        self._source = source
+        self._on_end = on_end
+        self._items = []
+        self._done = False
+        self._error: Optional[BaseException] = None
+        self._pulling = False
+        self._condition = threading.Condition()
+
+    def reader(self) -> Iterator:
+        index = 0
+        while True:
+            item = self._item(index)
+            if item is _END:
+                return
+            index += 1
+            yield item
+
+    def _item(self, index: int):
+        with self._condition:
+            while True:
+                if index < len(self._items):
+                    return self._items[index]
+                if self._done:
+                    if self._error is not None:
+                        raise self._error
+                    return _END
+                if not self._pulling:
+                    self._pulling = True
+                    break
+                self._condition.wait()
+        error = None
+        try:
+            item = next(self._source, _END)
+        except BaseException as raised:
+            item = _END
+            error = raised
+        with self._condition:
+            self._pulling = False
+            if item is _END:
+                self._done = True
+                self._error = error
+            else:
+                self._items.append(item)
+            self._condition.notify_all()
+        if item is _END:
+            self._on_end()
+        if error is not None:
+            raise error
+        return item
+
+
+class _AsyncTee:
+    """Replays an asynchronous stream to many readers as it is drained."""
+
+    def __init__(self, source: AsyncIterator, on_end: Callable[[], None]):
+        self._items = []
+        self._done = False
+        self._error: Optional[BaseException] = None
+        self._changed = asyncio.Event()
+        self._drain_task = asyncio.ensure_future(self._drain(source, on_end))
+
+    async def _drain(self, source: AsyncIterator, on_end: Callable[[], None]):
+        try:
+            async for item in source:
+                self._items.append(item)
+                self._notify()
+        except BaseException as error:
+            self._error = error
+        finally:
+            self._done = True
+            on_end()
+            self._notify()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def reader(self) -> AsyncIterator:
+        index = 0
+        while True:
+            if index < len(self._items):
+                yield self._items[index]
+                index += 1
+            elif self._done:
+                if self._error is not None:
+                    raise self._error
+                return
+            else:
+                await self._changed.wait()
@@ -0,0 +1,228 @@
+"""Packed storage of the messages of long conversations."""
+import mmap
+import sys
+import tempfile
+from array import array
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+from .cost import Cost
+from .message import Message
+
+# Roles are stored as indexes in this table, shared by all the histories.
+ROLES: list[str] = ["system", "user", "assistant"]
+_ROLE_INDEXES: dict[str, int] = {
+    role: index for index, role in enumerate(ROLES)
+}
+
+
+def _role_index(role: str) -> int:
+    """Return the index of a role, adding it to the table if it is new."""
+    index = _ROLE_INDEXES.get(role)
+    if index is None:
+        if len(ROLES) > 255:
+            raise ValueError("Too many distinct roles.")
+        index = _ROLE_INDEXES[sys.intern(role)] = len(ROLES)
+        ROLES.append(sys.intern(role))
+    return index
+
+
+class MessageView(Message):
+    """Read-only message of a `PackedHistory`, decoded when accessed.
+
+    Reading the role or the tokens of the message does not decode its
+    content.
+    """
+
+    __slots__ = ("_history", "_index")
+
+    def __init__(self, history: "PackedHistory", index: int):
+        self._history = history
+        self._index = index
+
+    @property
+    def role(self) -> str:
+        return ROLES[self._history._roles[self._index]]
+
+    @property
+    def content(self) -> str:
+        return self._history._content(self._index)
+
+    @property
+    def cost(self) -> Cost:
+        history = self._history
+        return Cost(
+            history._prompt_tokens[self._index],
+            history._completion_tokens[self._index],
+        )
+
+    @property
+    def cached(self) -> bool:
+        return bool(self._history._cached[self._index])
+
+    @property
+    def tokens(self) -> int:
+        return self._history._tokens[self._index]
+
+    @property
+    def dict(self) -> dict:
+        return {"role": self.role, "content": self.content}
+
+
+class PackedHistory(Sequence):
+    """Append-only list of messages packed in flat columns.
+
+    Roles are interned as one byte each, costs and token counts are kept in
+    `array` columns, and the contents are encoded in one contiguous buffer.
+    Once the buffer holds more than `spill_bytes`, it is moved to a
+    temporary file that is memory-mapped, so cold history is paged in by the
+    operating system only when it is read. Items are `MessageView` objects
+    built on access.
+
+    Attributes:
+        spill_bytes (Optional[int]): Bytes of content kept in memory before
+            they are moved to a file. Never moved if None.
+        spill_dir (Optional[Path]): Directory of the spill file. The default
+            temporary directory if None.
+    """
+
+    def __init__(
+        self,
+        messages: Iterable[Message] = (),
+        spill_bytes: Optional[int] = None,
+        spill_dir: Optional[Union[str, Path]] = None,
+    ):
+        self.spill_bytes = spill_bytes
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+        self._roles = array("B")
+        self._prompt_tokens = array("q")
+        self._completion_tokens = array("q")
+        self._cached = array("b")
+        self._tokens = array("q")
+        self._offsets = array("q", [0])
+        self._buffer = bytearray()
+        self._spilled = 0
+        self._file = None
+        self._map: Optional[mmap.mmap] = None
+        self.total_tokens = 0
+        self.extend(messages)
+
+    def append(self, message: Message) -> None:
+        """Add a message at the end of the history."""
+        tokens = message.tokens
+        self._roles.append(_role_index(message.role))
+        self._prompt_tokens.append(message.cost.prompt_tokens)
+        self._completion_tokens.append(message.cost.completion_tokens)
+        self._cached.append(message.cached)
+        self._tokens.append(tokens)
+        self._buffer += message.content.encode("utf-8")
+        self._offsets.append(self._spilled + len(self._buffer))
+        self.total_tokens += tokens
+        if (
+            self.spill_bytes is not None
+            and len(self._buffer) > self.spill_bytes
+        ):
+            self._spill()
+
+    def extend(self, messages: Iterable[Message]) -> None:
+        """Add messages at the end of the history."""
+        for message in messages:
+            self.append(message)
+
+    def __len__(self) -> int:
+        return len(self._roles)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._slice(*index.indices(len(self)))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("History index out of range.")
+        return MessageView(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield MessageView(self, index)
+
+    @property
+    def nbytes(self) -> int:
+        """Return the bytes held in memory by the columns and the buffer."""
+        columns = (
+            self._roles,
+            self._prompt_tokens,
+            self._completion_tokens,
+            self._cached,
+            self._tokens,
+            self._offsets,
+        )
+        return len(self._buffer) + sum(
+            column.itemsize * len(column) for column in columns
+        )
+
+    def close(self) -> None:
+        """Release the spill file, if any."""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __del__(self):
+        self.close()
+
+    def _content(self, index: int) -> str:
+        start, end = self._offsets[index], self._offsets[index + 1]
+        if end <= self._spilled:
+            return self._map[start:end].decode("utf-8")
+        spilled = self._spilled
+        return self._buffer[start - spilled : end - spilled].decode("utf-8")
+
+    def _spill(self) -> None:
+        """Move the buffer to the end of the spill file and map it again."""
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(dir=self.spill_dir)
+        self._file.seek(0, 2)
+        self._file.write(self._buffer)
+        self._file.flush()
+        self._spilled += len(self._buffer)
+        self._buffer = bytearray()
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(
+            self._file.fileno(), self._spilled, access=mmap.ACCESS_READ
+        )
+
+    def _slice(self, start: int, stop: int, step: int) -> "PackedHistory":
+        history = PackedHistory(
+            spill_bytes=self.spill_bytes, spill_dir=self.spill_dir
+        )
+        if step != 1:
+            history.extend(self[index] for index in range(start, stop, step))
+            return history
+        stop = max(start, stop)
+        history._roles = self._roles[start:stop]
+        history._prompt_tokens = self._prompt_tokens[start:stop]
+        history._completion_tokens = self._completion_tokens[start:stop]
+        history._cached = self._cached[start:stop]
+        history._tokens = self._tokens[start:stop]
+        first = self._offsets[start]
+        history._offsets = array(
+            "q", (offset - first for offset in self._offsets[start : stop + 1])
+        )
+        last = self._offsets[stop]
+        spilled = self._spilled
+        if first < spilled:
+            history._buffer += self._map[first : min(last, spilled)]
+        if last > spilled:
+            begin = max(first, spilled) - spilled
+            history._buffer += self._buffer[begin : last - spilled]
+        history.total_tokens = sum(history._tokens)
+        if (
+            history.spill_bytes is not None
+            and len(history._buffer) > history.spill_bytes
+        ):
+            history._spill()
+        return history
@@ -1,10 +1,82 @@
 """Module that contains the Interaction class."""
+import collections
 import datetime
+import threading
 import uuid
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import TYPE_CHECKING, Callable, Optional
 
-from rich.table import Table
+from .cost import Cost
+
+if TYPE_CHECKING:
+    from rich.table import Table
+
+    from .store import ConversationStore
+
+
+# Number of calls kept by a session for inspection.
+CALL_HISTORY = 1000
+
+
+@dataclass(slots=True)
+class Call:
+    """Represents a single request for a completion.
+
+    Attributes:
+        model (str): Model used for the completion
+        prompt_tokens (int): Number of prompt tokens of the request
+        completion_tokens (int): Number of completion tokens of the reply
+        latency (float): Seconds from the request to the whole reply,
+            including the waits of the scheduler
+        time_to_first_token (float): Seconds from the request to the first
+            token of the reply
+        cached (bool): Whether the reply was served from the cache
+        retries (int): Number of times the request was retried
+        shared (bool): Whether the reply was shared by an identical request
+            in flight
+        raced (int): Number of requests raced for the reply
+        lost_tokens (int): Estimated tokens of the requests that lost the
+            race. A completion that lost a synchronous race and was still
+            running when the reply was returned only counts its prompt
+            tokens: the rest of its usage is added to the `lost_cost` of
+            the conversation at the request after it finishes, not to the
+            call
+        suggestion (bool): Whether the request suggested a prompt
+        truncated (int): Number of messages left out of the request by the
+            context window
+        error (Optional[str]): Type of the error of the request, if it failed
+        compaction (bool): Whether the request summarized old messages
+        lost_usage (dict[str, Cost]): Estimated usage of the requests that
+            lost the race, by their model
+    """
+
+    model: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    latency: float = 0.0
+    time_to_first_token: float = 0.0
+    cached: bool = False
+    retries: int = 0
+    shared: bool = False
+    raced: int = 1
+    lost_tokens: int = 0
+    suggestion: bool = False
+    truncated: int = 0
+    error: Optional[str] = None
+    compaction: bool = False
+    lost_usage: dict[str, Cost] = field(default_factory=dict)
+
+    @property
+    def tokens(self) -> int:
+        """Return the total number of tokens of the call."""
+        return self.prompt_tokens + self.completion_tokens
+
+    @property
+    def kind(self) -> str:
+        """Return the kind of request: "chat", "suggestion" or "compaction"."""
+        if self.suggestion:
+            return "suggestion"
+        return "compaction" if self.compaction else "chat"
 
 
 @dataclass
@@ -16,7 +88,23 @@ class Interaction:
 
     Attributes:
         id (str): Unique identifier for the interaction
-        tokens (int): Number of tokens used in the interaction
+        prompt_tokens (int): Number of prompt tokens used in the interaction
+        completion_tokens (int): Number of completion tokens used in the
+            interaction
+        suggestion_tokens (int): Number of tokens used to suggest prompts
+        compaction_tokens (int): Number of tokens used to summarize old
+            messages
+        cache_hits (int): Number of requests served from the cache
+        shared_calls (int): Number of requests that shared the reply of an
+            identical request in flight
+        lost_tokens (int): Estimated tokens of the requests that lost a
+            race, see `Call.lost_tokens`
+        calls (int): Number of requests made, cached or not
+        errors (int): Number of requests that failed
+        retries (int): Number of times the requests were retried
+        latency (float): Total seconds taken by the requests
+        time_to_first_token (float): Total seconds until the first token of
+            each reply
         start (datetime.datetime): Datetime when the interaction started
         end (Optional[datetime.datetime]): Datetime when the interaction ended
     """
@@ -24,13 +112,68 @@ class Interaction:
     id: str = field(default_factory=lambda: uuid.uuid4().hex)
     prompt_tokens: int = 0
     completion_tokens: int = 0
+    suggestion_tokens: int = 0
+    compaction_tokens: int = 0
+    cache_hits: int = 0
+    shared_calls: int = 0
+    lost_tokens: int = 0
+    calls: int = 0
+    errors: int = 0
+    retries: int = 0
+    latency: float = 0.0
+    time_to_first_token: float = 0.0
     start: datetime.datetime = field(default_factory=datetime.datetime.now)
     end: Optional[datetime.datetime] = None
 
     @property
     def tokens(self) -> int:
         """Return the total number of tokens used in the interaction."""
-        return self.prompt_tokens + self.completion_tokens
+        return (
+            self.prompt_tokens
+            + self.completion_tokens
+            + self.suggestion_tokens
+            + self.compaction_tokens
+            + self.lost_tokens
+        )
+
+    @property
+    def average_latency(self) -> float:
+        """Return the average seconds taken by a request."""
+        return self.latency / self.calls if self.calls else 0.0
+
+    @property
+    def average_time_to_first_token(self) -> float:
+        """Return the average seconds until the first token of a reply."""
+        return self.time_to_first_token / self.calls if self.calls else 0.0
+
+    def add_call(self, call: Call) -> None:
+        """Add a request to the interaction.
+
+        Cached replies count as cache hits instead of tokens, and shared
+        replies as shared calls. Failed requests count as errors, and
+        suggestions and compactions count apart.
+
+        Args:
+            call (Call): The request.
+        """
+        self.calls += 1
+        self.retries += call.retries
+        self.lost_tokens += call.lost_tokens
+        self.latency += call.latency
+        self.time_to_first_token += call.time_to_first_token
+        if call.error:
+            self.errors += 1
+        elif call.shared:
+            self.shared_calls += 1
+        elif call.cached:
+            self.cache_hits += 1
+        elif call.suggestion:
+            self.suggestion_tokens += call.tokens
+        elif call.compaction:
+            self.compaction_tokens += call.tokens
+        else:
+            self.prompt_tokens += call.prompt_tokens
+            self.completion_tokens += call.completion_tokens
 
     @property
     def duration(self) -> datetime.timedelta:
@@ -40,21 +183,43 @@ class Interaction:
         return self.end - self.start if self.end else datetime.timedelta(0)
 
     @property
-    def table(self) -> Table:
+    def table(self) -> "Table":
         """Return a table with the information about the interaction.
 
         Returns:
             Table: Table with the information about the interaction.
         """
+        from rich.table import Table
+
         table = Table(title="Interaction Statistics")
         table.add_column("Total Tokens", style="cyan")
         table.add_column("Prompt Tokens", style="cyan")
         table.add_column("Completion Tokens", style="cyan")
+        table.add_column("Suggestion Tokens", style="cyan")
+        table.add_column("Compaction Tokens", style="cyan")
+        table.add_column("Cache Hits", style="cyan")
+        table.add_column("Shared", style="cyan")
+        table.add_column("Lost Tokens", style="cyan")
+        table.add_column("Calls", style="cyan")
+        table.add_column("Errors", style="cyan")
+        table.add_column("Retries", style="cyan")
+        table.add_column("Avg Latency", style="cyan")
+        table.add_column("Avg TTFT", style="cyan")
         table.add_column("Start", style="cyan")
         table.add_row(
             str(self.tokens),
             str(self.prompt_tokens),
             str(self.completion_tokens),
+            str(self.suggestion_tokens),
+            str(self.compaction_tokens),
+            str(self.cache_hits),
+            str(self.shared_calls),
+            str(self.lost_tokens),
+            str(self.calls),
+            str(self.errors),
+            str(self.retries),
+            f"{self.average_latency:.2f}s",
+            f"{self.average_time_to_first_token:.2f}s",
             self.start.strftime("%H:%M:%S"),
         )
         return table
@@ -68,32 +233,67 @@ class SessionInteractions:
         session (Interaction): Information about the session
         last (Interaction): Information about the last interaction
         current (Interaction): Information about the current interaction
+        store (Optional[ConversationStore]): Store where finished interactions
+            are recorded
+        calls (collections.deque[Call]): Latest requests of the session
+        listeners (list[Callable[[Interaction], None]]): Called with every
+            finished interaction, such as `Metrics.add_interaction`
+
+    The requests are added under a lock, so a session can be shared by
+    conversations running in several threads.
     """
 
     session: Interaction = field(default_factory=Interaction)
     last: Interaction = field(default_factory=Interaction)
     current: Interaction = field(default_factory=Interaction)
+    store: Optional["ConversationStore"] = field(
+        default=None, repr=False, compare=False
+    )
+    calls: collections.deque = field(
+        default_factory=lambda: collections.deque(maxlen=CALL_HISTORY),
+        repr=False,
+        compare=False,
+    )
+    listeners: list[Callable[[Interaction], None]] = field(
+        default_factory=list, repr=False, compare=False
+    )
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False, compare=False
+    )
+
+    def add_call(self, call: Call) -> None:
+        """Add a request to the session and the current interaction.
 
-    def add_usage(self, usage) -> None:
-        """Add the usage information to the current interaction.
+        This is the only place where usage is accumulated, so it can be
+        registered as a listener of the conversations. It takes constant
+        time, and only the latest requests are kept.
 
         Args:
-            usage (openai.Usage): Usage information from the API
+            call (Call): The request.
         """
-        self.current.prompt_tokens += usage.prompt_tokens
-        self.session.completion_tokens += usage.completion_tokens
+        with self._lock:
+            self.session.add_call(call)
+            self.current.add_call(call)
+            self.calls.append(call)
 
     def finish_interaction(self) -> None:
         """Finishes the current interaction and starts a new one.
 
         The current interaction is set as the last interaction and a new
-        interaction is started.
+        interaction is started. The finished one is recorded in the store
+        and passed to the listeners.
         """
-        self.last = self.current
-        self.current = Interaction()
+        with self._lock:
+            finished, self.current = self.current, Interaction()
+            self.last = finished
+        finished.end = datetime.datetime.now()
+        if self.store:
+            self.store.add_interaction(finished)
+        for listener in self.listeners:
+            listener(finished)
 
     @property
-    def table(self) -> list[Table]:
+    def table(self) -> list["Table"]:
         """Return a list of tables with the usage information.
 
         Returns:
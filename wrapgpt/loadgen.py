@@ -0,0 +1,396 @@
+"""Load generation by replaying recorded sessions.
+
+A trace records the turns of live sessions as JSON Lines, one turn per
+line, such as:
+
+    {"session": "a1", "at": 12.5, "content": "Hello", "stream": false}
+
+where "at" is the seconds from the start of the recording to the turn. The
+server writes one with `serve --trace`. `replay` sends the turns of a trace
+to the conversation engine at their recorded times, divided by a speedup,
+so the load keeps the shape of production traffic, bursts and idle
+sessions included, and reports throughput, latencies, memory and token
+accounting as a dictionary that can be written as JSON and compared
+between runs.
+
+The latency of a turn is measured from the time it was due, not from the
+time it was sent: a turn that waits for the previous reply of its session
+counts the wait, so a slow engine cannot hide its queueing by sending less.
+"""
+import asyncio
+import json
+import threading
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+from .backend import FakeBackend
+from .batch import percentile
+from .conversation import Conversation
+from .cost import Cost
+from .engine import Engine
+from .interactions import SessionInteractions
+from .message import Message
+from .metrics import LATENCY_BUCKETS, Histogram
+from .scheduler import Scheduler
+
+
+@dataclass
+class Turn:
+    """Turn of a recorded session.
+
+    Attributes:
+        session (str): Identifier of the session.
+        at (float): Seconds from the start of the recording to the turn.
+        content (str): Prompt sent.
+        stream (bool): Whether the reply was streamed.
+    """
+
+    session: str
+    at: float
+    content: str
+    stream: bool = False
+
+
+def read_trace(path: Union[str, Path]) -> list[Turn]:
+    """Read the turns of a trace, in the order they were sent.
+
+    Args:
+        path (Union[str, Path]): JSON Lines file with one turn per line.
+
+    Returns:
+        list[Turn]: Turns of every session, sorted by time.
+    """
+    turns = []
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                turns.append(
+                    Turn(
+                        str(record["session"]),
+                        float(record["at"]),
+                        record["content"],
+                        bool(record.get("stream", False)),
+                    )
+                )
+    turns.sort(key=lambda turn: turn.at)
+    return turns
+
+
+class TraceRecorder:
+    """Appends the turns of live sessions to a trace.
+
+    Attributes:
+        path (Path): Path of the trace.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.path = Path(path)
+        self._clock = clock
+        self._start = clock()
+        self._lock = threading.Lock()
+
+    def record(self, session: str, content: str, stream: bool = False):
+        """Append a turn, timed from the creation of the recorder."""
+        record = {
+            "session": session,
+            "at": round(self._clock() - self._start, 6),
+            "content": content,
+            "stream": stream,
+        }
+        with self._lock, open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(record) + "\n")
+
+
+@dataclass
+class LoadReport:
+    """Measurements of a replayed trace.
+
+    Attributes:
+        sessions (int): Number of sessions replayed.
+        turns (int): Number of turns sent.
+        failures (int): Number of turns that failed after their retries.
+        retries (int): Number of requests retried after an error.
+        elapsed (float): Seconds taken by the whole replay.
+        latencies (list[float]): Seconds from the time each successful turn
+            was due to its whole reply.
+        lags (list[float]): Seconds each turn was sent after it was due,
+            waiting for the previous reply of its session.
+        memory_per_session (int): Bytes still allocated per session once
+            the trace is replayed, 0 if the memory was not measured, in
+            which case it is None in `as_dict`.
+        backend_usage (Cost): Tokens reported by the backend.
+        accounted (Cost): Tokens accounted by the conversations.
+        recorded (Cost): Tokens recorded by the listeners of the requests.
+    """
+
+    sessions: int = 0
+    turns: int = 0
+    failures: int = 0
+    retries: int = 0
+    elapsed: float = 0.0
+    latencies: list[float] = field(default_factory=list)
+    lags: list[float] = field(default_factory=list)
+    memory_per_session: int = 0
+    backend_usage: Cost = field(default_factory=Cost)
+    accounted: Cost = field(default_factory=Cost)
+    recorded: Cost = field(default_factory=Cost)
+
+    @property
+    def throughput(self) -> float:
+        """Return the number of successful turns per second."""
+        return len(self.latencies) / self.elapsed if self.elapsed else 0.0
+
+    def latency(self, percent: float) -> float:
+        """Return a percentile of the turn latency, in seconds."""
+        return percentile(self.latencies, percent)
+
+    @property
+    def token_error(self) -> float:
+        """Return the largest relative error of the tokens accounted.
+
+        The tokens accounted by the conversations and recorded by the
+        listeners are compared to the ones reported by the backend, prompt
+        and completion tokens apart.
+        """
+        error = 0.0
+        for counted in (self.accounted, self.recorded):
+            for name in ("prompt_tokens", "completion_tokens"):
+                expected = getattr(self.backend_usage, name)
+                difference = abs(getattr(counted, name) - expected)
+                if difference:
+                    error = max(error, difference / max(expected, 1))
+        return error
+
+    def as_dict(self) -> dict:
+        """Return the report as a dictionary that can be written as JSON."""
+        histogram = Histogram(LATENCY_BUCKETS)
+        for latency in self.latencies:
+            histogram.observe(latency)
+        return {
+            "sessions": self.sessions,
+            "turns": self.turns,
+            "failures": self.failures,
+            "retries": self.retries,
+            "elapsed": self.elapsed,
+            "turns_per_second": self.throughput,
+            "latency": {
+                "p50": self.latency(50),
+                "p95": self.latency(95),
+                "p99": self.latency(99),
+                "max": max(self.latencies, default=0.0),
+                "buckets": [*LATENCY_BUCKETS, "+Inf"],
+                "counts": histogram.counts,
+            },
+            "lag": {
+                "p50": percentile(self.lags, 50),
+                "p99": percentile(self.lags, 99),
+            },
+            "memory_per_session": self.memory_per_session or None,
+            "tokens": {
+                "backend": _tokens(self.backend_usage),
+                "accounted": _tokens(self.accounted),
+                "recorded": _tokens(self.recorded),
+                "error": self.token_error,
+            },
+        }
+
+
+def _tokens(cost: Cost) -> dict:
+    return {
+        "prompt": cost.prompt_tokens,
+        "completion": cost.completion_tokens,
+    }
+
+
+def _sessions(trace: list[Turn]) -> dict[str, list[Turn]]:
+    """Group the turns of a trace by session, keeping their order."""
+    sessions: dict[str, list[Turn]] = {}
+    for turn in trace:
+        sessions.setdefault(turn.session, []).append(turn)
+    return sessions
+
+
+async def _run(
+    trace: list[Turn],
+    backend: FakeBackend,
+    scheduler: Scheduler,
+    speedup: Optional[float],
+    model: str,
+    concurrency: int,
+    report: LoadReport,
+) -> list[Conversation]:
+    """Send the turns of a trace to one conversation per session.
+
+    Args:
+        speedup (Optional[float]): Divides the times of the turns. The
+            turns are sent as fast as possible if None.
+
+    Returns:
+        list[Conversation]: Conversations of the sessions.
+    """
+    statistics = SessionInteractions()
+    conversations = []
+    loop = asyncio.get_running_loop()
+
+    async def converse(turns: list[Turn], engine: Engine) -> None:
+        conversation = Conversation(
+            backend=backend,
+            scheduler=scheduler,
+            listeners=[statistics.add_call],
+        )
+        conversations.append(conversation)
+        for turn in turns:
+            due = start + turn.at / speedup if speedup else loop.time()
+            if due > loop.time():
+                await asyncio.sleep(due - loop.time())
+            report.lags.append(max(0.0, loop.time() - due))
+            message = Message("user", turn.content)
+            try:
+                if turn.stream:
+                    deltas = conversation.astream(message, model=model)
+                    async for _ in engine.stream(deltas):
+                        pass
+                else:
+                    await engine.submit(
+                        conversation.asend(message, model=model)
+                    )
+            except Exception:
+                report.failures += 1
+                continue
+            report.latencies.append(loop.time() - due)
+
+    sessions = _sessions(trace)
+    async with Engine(concurrency) as engine:
+        start = loop.time()
+        await asyncio.gather(
+            *(converse(turns, engine) for turns in sessions.values())
+        )
+        report.elapsed = loop.time() - start
+    report.sessions = len(sessions)
+    report.turns = len(trace)
+    report.accounted = sum(
+        (conversation.cost for conversation in conversations), Cost()
+    )
+    usage = statistics.session
+    report.retries = usage.retries
+    report.recorded = Cost(usage.prompt_tokens, usage.completion_tokens)
+    return conversations
+
+
+async def replay(
+    trace: list[Turn],
+    backend: Optional[FakeBackend] = None,
+    speedup: float = 1.0,
+    scheduler: Optional[Scheduler] = None,
+    model: str = "gpt-3.5-turbo",
+    concurrency: int = 64,
+    memory: bool = False,
+) -> LoadReport:
+    """Replay a trace against the conversation engine.
+
+    The turns of each session are sent one after the other, each at its
+    recorded time divided by the speedup, or as soon as the previous reply
+    of the session if it is late.
+
+    The memory is measured in a second run, as fast as possible and with
+    the allocations traced, so the tracing does not slow down the timed one.
+
+    Args:
+        trace (list[Turn]): Turns to send, see `read_trace`.
+        backend (Optional[FakeBackend]): Backend that completes the
+            conversations. A `FakeBackend` with no latency if None.
+        speedup (float): Multiplier of the rate of the recorded traffic.
+        scheduler (Optional[Scheduler]): Scheduler that paces and retries
+            the requests. One with no limits if None.
+        model (str): Model used for the completions.
+        concurrency (int): Maximum number of requests in flight.
+        memory (bool): Whether the memory per session is measured.
+
+    Returns:
+        LoadReport: Measurements of the replay.
+
+    Raises:
+        ValueError: If the speedup is not positive.
+    """
+    if speedup <= 0:
+        raise ValueError("Speedup must be positive.")
+    backend = backend or FakeBackend()
+    scheduler = scheduler or Scheduler(base_delay=0.01)
+    report = LoadReport()
+    before = backend.usage
+    await _run(trace, backend, scheduler, speedup, model, concurrency, report)
+    report.backend_usage = Cost(
+        backend.usage.prompt_tokens - before.prompt_tokens,
+        backend.usage.completion_tokens - before.completion_tokens,
+    )
+    if memory:
+        tracemalloc.start()
+        try:
+            baseline = tracemalloc.get_traced_memory()[0]
+            conversations = await _run(
+                trace,
+                backend,
+                scheduler,
+                None,
+                model,
+                concurrency,
+                LoadReport(),
+            )
+            grown = tracemalloc.get_traced_memory()[0] - baseline
+        finally:
+            tracemalloc.stop()
+        report.memory_per_session = grown // max(len(conversations), 1)
+    return report
+
+
+def regressions(
+    report: dict, baseline: dict, tolerance: float = 0.1
+) -> list[str]:
+    """Compare a report to the one of a baseline run.
+
+    Throughput, latency and memory may be worse than the baseline by the
+    tolerance, since they vary between runs. The token accounting and the
+    failures may not be worse at all. The memory is only compared if both
+    runs measured it.
+
+    Args:
+        report (dict): Report of the run, see `LoadReport.as_dict`.
+        baseline (dict): Report of the baseline run.
+        tolerance (float): Fraction by which a measurement may be worse.
+
+    Returns:
+        list[str]: Description of every regression, empty if there are none.
+    """
+    found = []
+    throughput = report["turns_per_second"]
+    expected = baseline["turns_per_second"] * (1 - tolerance)
+    if throughput < expected:
+        found.append(f"turns_per_second {throughput:.1f} < {expected:.1f}")
+    for name, limit in (
+        ("latency.p50", tolerance),
+        ("latency.p99", tolerance),
+        ("memory_per_session", tolerance),
+        ("tokens.error", 0.0),
+        ("failures", 0.0),
+    ):
+        value, reference = _field(report, name), _field(baseline, name)
+        if value is None or reference is None:
+            continue
+        if value > reference * (1 + limit):
+            found.append(f"{name} {value:g} > {reference * (1 + limit):g}")
+    return found
+
+
+def _field(report: dict, name: str) -> Optional[float]:
+    """Return a measurement of a report by its dotted name."""
+    for key in name.split("."):
+        report = report[key]
+    return report
@@ -1,28 +1,68 @@
 """Represents a message in a conversation."""
 from dataclasses import dataclass, field
+from typing import Optional
 
 from .cost import Cost
+from .tokens import count_message_tokens
 
 # Build test for the following class
 
 
-@dataclass
+@dataclass(slots=True)
 class Message:
     """Represents a message in a conversation.
 
     Attributes:
         role (str): Role of the message.
         content (str): Content of the message.
+        cost (Cost): Cost of the request that produced the message.
+        cached (bool): Whether the message was served from a cache, so its
+            cost was not spent again.
+
+    Properties:
+        tokens (int): Number of prompt tokens the message takes.
     """
 
     role: str
     content: str
     cost: Cost = field(default_factory=Cost)
+    cached: bool = False
+    _tokens: Optional[tuple[str, str, int]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _dict: Optional[dict] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    @property
+    def tokens(self) -> int:
+        """Return the number of prompt tokens the message takes.
+
+        The tokens are counted locally and memoized until the role or the
+        content of the message change.
+        """
+        cached = self._tokens
+        if cached and cached[0] is self.role and cached[1] is self.content:
+            return cached[2]
+        tokens = count_message_tokens(self.role, self.content)
+        self._tokens = (self.role, self.content, tokens)
+        return tokens
 
     @property
     def dict(self) -> dict:
-        """Return a dictionary representation of the message."""
-        return {"role": self.role, "content": self.content}
+        """Return a dictionary representation of the message.
+
+        The dictionary is built once and reused until the role or the content
+        of the message change, so it must not be modified.
+        """
+        cached = self._dict
+        if (
+            cached is None
+            or cached["role"] is not self.role
+            or cached["content"] is not self.content
+        ):
+            cached = self._dict = {"role": self.role, "content": self.content}
+        return cached
 
     def __str__(self) -> str:
         """Return the content of the message."""
@@ -0,0 +1,474 @@
+"""Metrics and traces of the requests, exported through pluggable sinks.
+
+`Metrics` is a listener of the conversations: register `Metrics.add_call` in
+`Conversation.listeners` to instrument them. Nothing is measured or exported
+when it is not registered, so instrumentation costs nothing when disabled.
+"""
+import bisect
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+from .interactions import Call, Interaction
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384)
+
+# Description of each metric, rendered as the HELP line of its family.
+HELP = {
+    "wrapgpt_requests_total": "Requests for a completion.",
+    "wrapgpt_errors_total": "Requests that failed, by type of error.",
+    "wrapgpt_cache_hits_total": "Replies served from the cache.",
+    "wrapgpt_shared_total": "Replies shared by an identical request.",
+    "wrapgpt_raced_total": "Extra requests raced for a reply.",
+    "wrapgpt_lost_tokens_total": (
+        "Estimated tokens of the requests that lost a race."
+    ),
+    "wrapgpt_retries_total": "Retries of the requests.",
+    "wrapgpt_truncated_messages_total": (
+        "Messages left out of the requests by the context window."
+    ),
+    "wrapgpt_truncations_total": (
+        "Requests the context window left messages out of."
+    ),
+    "wrapgpt_prompt_tokens_total": "Prompt tokens of the requests.",
+    "wrapgpt_completion_tokens_total": "Completion tokens of the replies.",
+    "wrapgpt_request_seconds": "Seconds from a request to its whole reply.",
+    "wrapgpt_time_to_first_token_seconds": (
+        "Seconds from a request to the first token of its reply."
+    ),
+    "wrapgpt_request_tokens": "Tokens of a request and its reply.",
+}
+
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets.
+
+    Attributes:
+        buckets (tuple[float, ...]): Upper bounds of the buckets, ascending.
+        counts (list[int]): Observations in each bucket, the last one being
+            the observations above every bound.
+        sum (float): Sum of the observations.
+    """
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """Add an observation."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        """Return the number of observations."""
+        return sum(self.counts)
+
+
+class Sink:
+    """Destination of the calls and interactions recorded by `Metrics`."""
+
+    def export(self, call: Call) -> None:
+        """Export a call."""
+
+    def export_interaction(self, interaction: Interaction) -> None:
+        """Export a finished interaction."""
+
+    def close(self) -> None:
+        """Flush what is pending and release the resources of the sink."""
+
+
+class Metrics:
+    """Counters and histograms of the requests, by model and kind.
+
+    The kind of a request is "chat", "suggestion" or "compaction".
+
+    Attributes:
+        sinks (list[Sink]): Sinks every call is exported to.
+        counters (dict[tuple[str, tuple], float]): Counters, by name and
+            labels.
+        histograms (dict[tuple[str, tuple], Histogram]): Histograms, by name
+            and labels.
+    """
+
+    def __init__(self, sinks: Optional[list[Sink]] = None):
+        self.sinks = sinks or []
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.histograms: dict[tuple[str, tuple], Histogram] = {}
+        self._lock = threading.Lock()
+
+    def add_call(self, call: Call) -> None:
+        """Measure a call and export it to the sinks.
+
+        Args:
+            call (Call): The request.
+        """
+        labels = (("model", call.model), ("kind", call.kind))
+        with self._lock:
+            self._count("wrapgpt_requests_total", labels)
+            if call.error:
+                self._count(
+                    "wrapgpt_errors_total", labels + (("error", call.error),)
+                )
+            if call.cached:
+                self._count("wrapgpt_cache_hits_total", labels)
+            if call.shared:
+                self._count("wrapgpt_shared_total", labels)
+            if call.raced > 1:
+                self._count("wrapgpt_raced_total", labels, call.raced - 1)
+                self._count(
+                    "wrapgpt_lost_tokens_total", labels, call.lost_tokens
+                )
+            self._count("wrapgpt_retries_total", labels, call.retries)
+            self._count(
+                "wrapgpt_truncated_messages_total", labels, call.truncated
+            )
+            if call.truncated:
+                self._count("wrapgpt_truncations_total", labels)
+            self._count(
+                "wrapgpt_prompt_tokens_total", labels, call.prompt_tokens
+            )
+            self._count(
+                "wrapgpt_completion_tokens_total",
+                labels,
+                call.completion_tokens,
+            )
+            self._observe(
+                "wrapgpt_request_seconds",
+                labels,
+                LATENCY_BUCKETS,
+                call.latency,
+            )
+            self._observe(
+                "wrapgpt_time_to_first_token_seconds",
+                labels,
+                LATENCY_BUCKETS,
+                call.time_to_first_token,
+            )
+            self._observe(
+                "wrapgpt_request_tokens", labels, TOKEN_BUCKETS, call.tokens
+            )
+        for sink in self.sinks:
+            sink.export(call)
+
+    def add_interaction(self, interaction: Interaction) -> None:
+        """Export a finished interaction to the sinks.
+
+        Args:
+            interaction (Interaction): The interaction.
+        """
+        for sink in self.sinks:
+            sink.export_interaction(interaction)
+
+    def counter(self, name: str, **labels) -> float:
+        """Return the value of a counter, 0 if it was never incremented."""
+        return self.counters.get((name, tuple(labels.items())), 0)
+
+    def render(self) -> str:
+        """Render the metrics in the Prometheus text format.
+
+        The samples of a metric are grouped under its HELP and TYPE lines.
+        """
+        lines = []
+        family = None
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                if name != family:
+                    family = name
+                    lines.extend(_family(name, "counter"))
+                lines.append(f"{name}{_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(
+                self.histograms.items(), key=lambda item: item[0]
+            ):
+                if name != family:
+                    family = name
+                    lines.extend(_family(name, "histogram"))
+                cumulative = 0
+                bounds = [*map(str, histogram.buckets), "+Inf"]
+                for bound, count in zip(bounds, histogram.counts):
+                    cumulative += count
+                    bucket = labels + (("le", bound),)
+                    lines.append(
+                        f"{name}_bucket{_labels(bucket)} {cumulative}"
+                    )
+                lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def close(self) -> None:
+        """Close the sinks."""
+        for sink in self.sinks:
+            sink.close()
+
+    def _count(self, name: str, labels: tuple, amount: float = 1) -> None:
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def _observe(
+        self, name: str, labels: tuple, buckets: tuple, value: float
+    ) -> None:
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram(buckets)
+        histogram.observe(value)
+
+
+def _family(name: str, kind: str) -> list[str]:
+    """Render the HELP and TYPE lines of a metric."""
+    return [f"# HELP {name} {HELP.get(name, name)}", f"# TYPE {name} {kind}"]
+
+
+def _labels(labels: tuple) -> str:
+    """Render labels in the Prometheus text format."""
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class JSONLSink(Sink):
+    """Appends every call to a JSON Lines file.
+
+    Attributes:
+        path (Path): Path of the file.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def export(self, call: Call) -> None:
+        record = {
+            "time": time.time(),
+            "model": call.model,
+            "kind": call.kind,
+            "prompt_tokens": call.prompt_tokens,
+            "completion_tokens": call.completion_tokens,
+            "latency": call.latency,
+            "time_to_first_token": call.time_to_first_token,
+            "cached": call.cached,
+            "shared": call.shared,
+            "raced": call.raced,
+            "lost_tokens": call.lost_tokens,
+            "retries": call.retries,
+            "truncated": call.truncated,
+            "error": call.error,
+        }
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class OTLPSink(Sink):
+    """Sends every call as a span to an OTLP/HTTP collector, in JSON.
+
+    Spans are batched in memory and posted by a background thread every
+    `flush_interval` seconds, so the requests never wait on the collector.
+    Batches the collector rejects are dropped.
+
+    Attributes:
+        endpoint (str): URL of the traces endpoint of the collector.
+        flush_interval (float): Seconds between posts to the collector.
+        service (str): Name of the service reported in the spans.
+    """
+
+    def __init__(
+        self,
+        endpoint: str = "http://localhost:4318/v1/traces",
+        flush_interval: float = 5.0,
+        service: str = "wrapgpt",
+    ):
+        self.endpoint = endpoint
+        self.flush_interval = flush_interval
+        self.service = service
+        self._spans: list[dict] = []
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._flush_periodically, daemon=True
+        )
+        self._flusher.start()
+
+    def export(self, call: Call) -> None:
+        end = time.time_ns()
+        attributes = {
+            "gen_ai.request.model": call.model,
+            "gen_ai.usage.input_tokens": call.prompt_tokens,
+            "gen_ai.usage.output_tokens": call.completion_tokens,
+            "wrapgpt.time_to_first_token": call.time_to_first_token,
+            "wrapgpt.cached": call.cached,
+            "wrapgpt.shared": call.shared,
+            "wrapgpt.raced": call.raced,
+            "wrapgpt.lost_tokens": call.lost_tokens,
+            "wrapgpt.retries": call.retries,
+            "wrapgpt.truncated": call.truncated,
+        }
+        span = {
+            "traceId": os.urandom(16).hex(),
+            "spanId": os.urandom(8).hex(),
+            "name": call.kind,
+            "kind": 3,
+            "startTimeUnixNano": str(end - int(call.latency * 1e9)),
+            "endTimeUnixNano": str(end),
+            "attributes": [_attribute(*item) for item in attributes.items()],
+            "status": {"code": 2, "message": call.error}
+            if call.error
+            else {"code": 1},
+        }
+        with self._lock:
+            self._spans.append(span)
+
+    def flush(self) -> None:
+        """Post the pending spans to the collector."""
+        with self._lock:
+            spans, self._spans = self._spans, []
+        if not spans:
+            return
+        payload = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            _attribute("service.name", self.service)
+                        ]
+                    },
+                    "scopeSpans": [
+                        {"scope": {"name": "wrapgpt"}, "spans": spans}
+                    ],
+                }
+            ]
+        }
+        import urllib.request
+
+        request = urllib.request.Request(
+            self.endpoint,
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            urllib.request.urlopen(request, timeout=5).close()
+        except OSError:
+            pass
+
+    def close(self) -> None:
+        self._closed.set()
+        self._flusher.join()
+        self.flush()
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+
+def _attribute(key: str, value) -> dict:
+    """Build an OTLP attribute."""
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+class PrometheusSink(Sink):
+    """Serves the metrics in the Prometheus text format over HTTP.
+
+    The server runs in a background thread and answers on `/metrics`.
+
+    Attributes:
+        metrics (Metrics): Metrics served.
+        address (tuple[str, int]): Host and port the server listens on.
+    """
+
+    def __init__(
+        self, metrics: Metrics, host: str = "127.0.0.1", port: int = 9464
+    ):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.metrics = metrics
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = sink.metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+                )
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self.address = self._server.server_address[:2]
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, args=(0.1,), daemon=True
+        )
+        self._thread.start()
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+def open_metrics(
+    port: Optional[int] = None,
+    trace_endpoint: Optional[str] = None,
+    path: Optional[Union[str, Path]] = None,
+    usage_directory: Optional[Union[str, Path]] = None,
+) -> Optional[Metrics]:
+    """Build the metrics of the enabled sinks.
+
+    Args:
+        port (Optional[int]): Port where the Prometheus metrics are served.
+        trace_endpoint (Optional[str]): OTLP/HTTP endpoint spans are sent to.
+        path (Optional[Union[str, Path]]): JSON Lines file calls are
+            appended to.
+        usage_directory (Optional[Union[str, Path]]): Directory where the
+            calls and interactions are exported in a columnar format, see
+            `UsageExporter`.
+
+    Returns:
+        Optional[Metrics]: The metrics, None if no sink is enabled.
+    """
+    if (
+        port is None
+        and not trace_endpoint
+        and not path
+        and not usage_directory
+    ):
+        return None
+    metrics = Metrics()
+    if port is not None:
+        metrics.sinks.append(PrometheusSink(metrics, port=port))
+    if trace_endpoint:
+        metrics.sinks.append(OTLPSink(trace_endpoint))
+    if path:
+        metrics.sinks.append(JSONLSink(path))
+    if usage_directory:
+        from .usage import UsageExporter
+
+        metrics.sinks.append(UsageExporter(usage_directory))
+    return metrics
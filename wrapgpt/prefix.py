@@ -0,0 +1,79 @@
+"""Content-addressed prefixes of the payloads of the conversations.
+
+The messages of a payload are hashed into a chain, one message at a time,
+each link hashing the previous digest and the next message. The digest of a
+payload therefore extends the digest of any prefix of it, so the stable
+start of the payloads of a conversation, such as a long context, is only
+serialized and hashed once, and the requests are keyed by hashing the new
+messages only.
+"""
+import hashlib
+import json
+from dataclasses import dataclass
+from typing import Iterable
+
+from .cache import request_key
+from .message import Message
+
+
+def link(digest: str, message: dict) -> str:
+    """Extend the digest of a list of messages with the next message.
+
+    Args:
+        digest (str): Digest of the messages, empty if there are none.
+        message (dict): Next message.
+
+    Returns:
+        str: Digest of the messages followed by the next one.
+    """
+    payload = json.dumps(message, sort_keys=True, separators=(",", ":"))
+    chained = hashlib.sha256(digest.encode("ascii"))
+    chained.update(payload.encode("utf-8"))
+    return chained.hexdigest()
+
+
+@dataclass(frozen=True, slots=True)
+class Prefix:
+    """Start of the payloads of a conversation, hashed once.
+
+    Attributes:
+        hash (str): Chained digest of the messages, see `link`. Identical
+            messages have the same hash in any conversation, so it can key
+            caches of prompts.
+        size (int): Number of messages.
+        tokens (int): Prompt tokens of the messages.
+    """
+
+    hash: str = ""
+    size: int = 0
+    tokens: int = 0
+
+    def extend(self, messages: Iterable[Message]) -> "Prefix":
+        """Return the prefix followed by more messages."""
+        digest, size, tokens = self.hash, self.size, self.tokens
+        for message in messages:
+            digest = link(digest, message.dict)
+            size += 1
+            tokens += message.tokens
+        return Prefix(digest, size, tokens)
+
+    def digest(self, messages: list[dict]) -> str:
+        """Return the chained digest of a payload starting with the prefix.
+
+        Only the messages after the prefix are hashed, so the first `size`
+        messages must be the ones of the prefix.
+        """
+        digest = self.hash
+        for index in range(self.size, len(messages)):
+            digest = link(digest, messages[index])
+        return digest
+
+    def key(self, request: dict) -> str:
+        """Return the key of a request whose messages start with the prefix.
+
+        Identical requests have the same key, whatever the prefix they were
+        keyed with, since the messages are replaced by their chained digest.
+        """
+        return request_key(
+            **{**request, "messages": self.digest(request["messages"])}
+        )
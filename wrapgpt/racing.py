@@ -0,0 +1,462 @@
+"""Racing of requests over several backends or models, and hedging.
+
+A raced request is sent to several routes, each a backend and a model, and
+the first good answer wins: the first reply of a completion, or the first
+delta of a stream. The other requests are cancelled. A hedged request is
+sent to one route, and duplicated to the next one only if it has not
+produced its first token within a deadline, a high percentile of the times
+to first token observed so far, which cuts the tail latency for a few extra
+requests.
+
+The requests that lose are billed for what the API processed before they
+were cancelled, which it does not report, so their cost is estimated: the
+prompt tokens, counted locally, and the deltas received. A completion that
+lost but already has its reply is billed for the usage of the reply
+instead. Threads cannot be cancelled, so the losers of a synchronous race
+of completions run to the end: the race is settled with their estimate,
+and the rest of the usage of their reply is passed to `on_lost` once they
+finish.
+"""
+import asyncio
+import collections
+import itertools
+import math
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Iterator, Optional
+
+from .backend import Backend
+from .cost import Cost
+from .scheduler import Attempts, Scheduler
+
+
+class LatencyTracker:
+    """Rolling percentile of the times to first token of the requests.
+
+    Attributes:
+        quantile (float): Quantile of the times used as deadline.
+        window (int): Number of latest times kept.
+        min_samples (int): Number of times needed before the quantile is
+            used as deadline.
+        default (float): Deadline until then, in seconds.
+    """
+
+    def __init__(
+        self,
+        quantile: float = 0.95,
+        window: int = 200,
+        min_samples: int = 20,
+        default: float = 1.0,
+    ):
+        if not 0 < quantile <= 1:
+            raise ValueError("Quantile must be between 0 and 1.")
+        self.quantile = quantile
+        self.window = window
+        self.min_samples = min_samples
+        self.default = default
+        self._samples: collections.deque[float] = collections.deque(
+            maxlen=window
+        )
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        """Record the time to first token of a request."""
+        with self._lock:
+            self._samples.append(seconds)
+
+    def deadline(self) -> float:
+        """Return the seconds a request is given before it is hedged."""
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < self.min_samples:
+            return self.default
+        index = math.ceil(self.quantile * len(samples)) - 1
+        return samples[max(0, index)]
+
+
+@dataclass
+class Route:
+    """Backend and model a raced request can be sent to.
+
+    Attributes:
+        backend (Backend): Backend that completes the request.
+        model (Optional[str]): Model of the request. The model of the
+            conversation if None.
+    """
+
+    backend: Backend
+    model: Optional[str] = None
+
+
+class _Lost(Exception):
+    """Raised by a request that is about to be made after its race ended."""
+
+
+class _Contender:
+    """One of the requests of a race."""
+
+    def __init__(self, attempts: Attempts, kwargs: dict, primary: bool):
+        self.attempts = attempts
+        self.kwargs = kwargs
+        self.primary = primary
+        self.started = 0.0
+        self.deltas = 0
+        self.error: Optional[BaseException] = None
+        self.source: Any = None
+        self.reply: Any = None
+        self.estimated = False
+
+    @property
+    def billed(self) -> bool:
+        """Return whether the request reached the API."""
+        return (
+            self.error is None
+            and self.attempts.count > 0
+            and not self.attempts.shared
+        )
+
+
+class Racer:
+    """Races or hedges the requests of conversations over several routes.
+
+    The first route of a request is always the backend and the model of its
+    conversation, through the attempts the conversation made for it, and
+    the other ones follow. Once every route was tried, they are tried again
+    in the same order, so a hedge with no routes duplicates the request.
+    Every request goes through the scheduler of the conversation. The
+    duplicates are never coalesced with the request they duplicate.
+
+    Attributes:
+        routes (list[Route]): Routes tried after the one of the
+            conversation.
+        hedge (bool): Whether the requests are made one after the other,
+            each once the previous one missed the deadline or failed,
+            instead of all at once.
+        max_requests (int): Maximum number of requests made for a reply.
+        latencies (dict[bool, LatencyTracker]): Times to first token of
+            the completions and of the streams, whose percentile is the
+            deadline of a hedge.
+    """
+
+    def __init__(
+        self,
+        routes: Optional[list[Route]] = None,
+        hedge: bool = False,
+        max_requests: Optional[int] = None,
+        quantile: float = 0.95,
+        default_deadline: float = 1.0,
+    ):
+        self.routes = list(routes or [])
+        if not hedge and not self.routes:
+            raise ValueError("A race needs at least one route.")
+        self.hedge = hedge
+        self.max_requests = max_requests or max(2, len(self.routes) + 1)
+        if self.max_requests < 2:
+            raise ValueError("A race needs at least two requests.")
+        self.latencies = {
+            streamed: LatencyTracker(quantile, default=default_deadline)
+            for streamed in (False, True)
+        }
+
+    def _contenders(
+        self,
+        method: str,
+        attempts: Attempts,
+        request: dict,
+        decided: threading.Event,
+    ) -> list[_Contender]:
+        """Build the requests of a race, the first one being the primary."""
+        contenders = [_Contender(attempts, request, primary=True)]
+        routes = itertools.cycle([None, *self.routes])
+        next(routes)
+        for route in itertools.islice(routes, self.max_requests - 1):
+            if route is None:
+                function = attempts.request
+                kwargs = request
+            else:
+                function = getattr(route.backend, method)
+                kwargs = {**request, "model": route.model or request["model"]}
+            request_attempts = Attempts(_unless_decided(function, decided))
+            contenders.append(_Contender(request_attempts, kwargs, False))
+        return contenders
+
+    def call(
+        self,
+        scheduler: Scheduler,
+        method: str,
+        attempts: Attempts,
+        tokens: int,
+        request: dict,
+        on_lost: Optional[Callable[[Cost], None]] = None,
+    ) -> Any:
+        """Race a request, returning the result of the first good answer.
+
+        Args:
+            scheduler (Scheduler): Scheduler the requests go through.
+            method (str): Method of the backends that makes the request,
+                `complete` or `stream`.
+            attempts (Attempts): Attempts of the request to the backend of
+                the conversation. Updated with the outcome of the race.
+            tokens (int): Estimated number of tokens of the request.
+            request (dict): Parameters of the request.
+            on_lost (Optional[Callable[[Cost], None]]): Called with the
+                usage of a completion that lost, beyond its estimate in
+                `attempts.lost`, once it finishes after the race was
+                settled. Called from the thread of the request.
+
+        Returns:
+            Any: Reply, or deltas of the reply, that won the race.
+
+        Raises:
+            Exception: The error of the last request, if all of them failed.
+        """
+        streamed = method == "stream"
+        decided = threading.Event()
+        contenders = self._contenders(method, attempts, request, decided)
+        deadline = self.latencies[streamed].deadline()
+        condition = threading.Condition()
+        outcome = {"winner": None, "running": 0}
+
+        def run(contender: _Contender) -> None:
+            try:
+                result = scheduler.call(
+                    contender.attempts, tokens, **contender.kwargs
+                )
+                if streamed:
+                    contender.source = result
+                    result = _first_delta(contender, result)
+            except Exception as error:
+                with condition:
+                    contender.error = error
+                    outcome["running"] -= 1
+                    condition.notify_all()
+                return
+            with condition:
+                outcome["running"] -= 1
+                if outcome["winner"] is None:
+                    outcome["winner"] = contender, result
+                    decided.set()
+                    condition.notify_all()
+                    return
+                if not streamed:
+                    contender.reply = result
+                late = contender.estimated
+            _close(contender.source)
+            if late and on_lost is not None:
+                usage = _usage(contender.reply)
+                extra = Cost(
+                    max(0, usage.prompt_tokens - tokens),
+                    usage.completion_tokens,
+                )
+                if extra.total:
+                    on_lost(extra)
+
+        launched = 0
+        last_launch = 0.0
+        with condition:
+            while outcome["winner"] is None:
+                now = time.perf_counter()
+                if launched < len(contenders) and (
+                    not self.hedge
+                    or launched == 0
+                    or outcome["running"] == 0
+                    or now - last_launch >= deadline
+                ):
+                    contender = contenders[launched]
+                    contender.started = last_launch = now
+                    outcome["running"] += 1
+                    launched += 1
+                    threading.Thread(
+                        target=run, args=(contender,), daemon=True
+                    ).start()
+                    continue
+                if outcome["running"] == 0:
+                    raise contenders[launched - 1].error
+                timeout = None
+                if self.hedge and launched < len(contenders):
+                    timeout = last_launch + deadline - now
+                condition.wait(timeout)
+            winner, result = outcome["winner"]
+            self._settle(
+                attempts, contenders[:launched], winner, tokens, streamed
+            )
+        return result
+
+    async def acall(
+        self,
+        scheduler: Scheduler,
+        method: str,
+        attempts: Attempts,
+        tokens: int,
+        request: dict,
+    ) -> Any:
+        """Asynchronous version of `call`, for `acomplete` or `astream`."""
+        streamed = method == "astream"
+        decided = threading.Event()
+        contenders = self._contenders(method, attempts, request, decided)
+        deadline = self.latencies[streamed].deadline()
+
+        async def run(contender: _Contender) -> Any:
+            try:
+                result = await scheduler.acall(
+                    contender.attempts, tokens, **contender.kwargs
+                )
+                if streamed:
+                    contender.source = result
+                    result = await _afirst_delta(contender, result)
+                else:
+                    contender.reply = result
+            except Exception as error:
+                contender.error = error
+                raise
+            return result
+
+        tasks: dict[asyncio.Task, _Contender] = {}
+        pending: set[asyncio.Task] = set()
+        launched = 0
+        last_launch = 0.0
+        try:
+            while True:
+                now = time.perf_counter()
+                if launched < len(contenders) and (
+                    not self.hedge
+                    or launched == 0
+                    or not pending
+                    or now - last_launch >= deadline
+                ):
+                    contender = contenders[launched]
+                    contender.started = last_launch = now
+                    task = asyncio.ensure_future(run(contender))
+                    tasks[task] = contender
+                    pending.add(task)
+                    launched += 1
+                    continue
+                if not pending:
+                    raise contenders[launched - 1].error
+                timeout = None
+                if self.hedge and launched < len(contenders):
+                    timeout = max(0.0, last_launch + deadline - now)
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                winners = [
+                    task
+                    for task in done
+                    if not task.cancelled() and task.exception() is None
+                ]
+                if winners:
+                    break
+        finally:
+            decided.set()
+            for task in pending:
+                task.cancel()
+        winner, *losers = winners
+        for task in losers:
+            await _aclose(tasks[task].source)
+        self._settle(
+            attempts, contenders[:launched], tasks[winner], tokens, streamed
+        )
+        return winner.result()
+
+    def _settle(
+        self,
+        attempts: Attempts,
+        launched: list[_Contender],
+        winner: _Contender,
+        tokens: int,
+        streamed: bool,
+    ) -> None:
+        """Record the outcome of a race in the attempts of the primary.
+
+        The losers that have a reply are billed for its usage, the other
+        ones for an estimate, and are marked as such.
+        """
+        self.latencies[streamed].add(time.perf_counter() - winner.started)
+        attempts.raced = len(launched)
+        for contender in launched:
+            if contender is winner or not contender.billed:
+                continue
+            if contender.reply is not None:
+                cost = _usage(contender.reply)
+            else:
+                cost = Cost(tokens, contender.deltas)
+                contender.estimated = True
+            attempts.lost += cost
+            model = contender.kwargs["model"]
+            attempts.lost_usage[model] = (
+                attempts.lost_usage.get(model, Cost()) + cost
+            )
+        if not winner.primary:
+            attempts.count = winner.attempts.count
+            attempts.shared = winner.attempts.shared
+            attempts.model = winner.kwargs["model"]
+
+
+def _unless_decided(function: Callable, decided: threading.Event) -> Callable:
+    """Wrap a request so it is not made once its race has a winner.
+
+    The wrapper is a new function for every race, so duplicates of a
+    request are never coalesced with it by the scheduler.
+    """
+
+    def request(**kwargs):
+        if decided.is_set():
+            raise _Lost()
+        return function(**kwargs)
+
+    return request
+
+
+def _usage(reply: Any) -> Cost:
+    """Return the usage of a reply, nothing if it has none."""
+    cost = getattr(reply, "cost", None)
+    if cost is None:
+        return Cost()
+    return Cost(cost.prompt_tokens, cost.completion_tokens)
+
+
+def _first_delta(contender: _Contender, deltas: Iterator) -> Iterator:
+    """Wait for the first delta of a stream, returning the whole stream."""
+    iterator = iter(deltas)
+    for first in iterator:
+        contender.deltas = 1
+        return itertools.chain([first], iterator)
+    return iter(())
+
+
+async def _afirst_delta(
+    contender: _Contender, deltas: AsyncIterator
+) -> AsyncIterator:
+    """Asynchronous version of `_first_delta`."""
+    iterator = deltas.__aiter__()
+    try:
+        first = await iterator.__anext__()
+    except StopAsyncIteration:
+        first = None
+    else:
+        contender.deltas = 1
+
+    async def chained() -> AsyncIterator:
+        if contender.deltas:
+            yield first
+            async for delta in iterator:
+                yield delta
+
+    return chained()
+
+
+def _close(deltas: Any) -> None:
+    """Close the stream of a request that lost, if it can be closed."""
+    close = getattr(deltas, "close", None)
+    if close is not None:
+        close()
+
+
+async def _aclose(deltas: Any) -> None:
+    """Asynchronous version of `_close`."""
+    close = getattr(deltas, "aclose", None)
+    if close is not None:
+        await close()
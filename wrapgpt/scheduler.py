@@ -0,0 +1,321 @@
+"""Scheduler that paces and retries the requests to the API."""
+import asyncio
+import functools
+import random
+import threading
+import time
+from typing import TYPE_CHECKING, Awaitable, Callable, Optional, TypeVar
+
+from .backend import replay_key
+from .cost import Cost
+from .flight import SingleFlight
+
+if TYPE_CHECKING:
+    import openai
+
+T = TypeVar("T")
+
+
+@functools.lru_cache(maxsize=None)
+def retryable_errors() -> tuple[type, ...]:
+    """Return the errors of the API worth retrying.
+
+    The `openai` package is imported on the first failure instead of at
+    startup, since an `except` clause is only evaluated when an error is
+    raised.
+    """
+    import openai
+
+    return (
+        openai.error.RateLimitError,
+        openai.error.ServiceUnavailableError,
+        openai.error.APIConnectionError,
+        openai.error.Timeout,
+        openai.error.TryAgain,
+        openai.error.APIError,
+    )
+
+
+class Attempts:
+    """Counts the attempts of a request made through a scheduler.
+
+    Attributes:
+        request (Callable): Function that makes the request.
+        count (int): Number of times the request was made.
+        shared (bool): Whether the result was shared by an identical request
+            in flight instead of requested.
+        raced (int): Number of requests raced for the result, see `Racer`.
+        lost (Cost): Estimated cost of the requests that lost the race.
+        lost_usage (dict[str, Cost]): `lost`, by model of the requests.
+        model (Optional[str]): Model that won the race, if it is not the
+            model of the request.
+    """
+
+    def __init__(self, request: Callable):
+        self.request = request
+        self.count = 0
+        self.shared = False
+        self.raced = 1
+        self.lost = Cost()
+        self.lost_usage: dict[str, Cost] = {}
+        self.model: Optional[str] = None
+
+    def __call__(self, **kwargs):
+        self.count += 1
+        return self.request(**kwargs)
+
+    @property
+    def retries(self) -> int:
+        """Return the number of times the request was retried."""
+        return max(0, self.count - 1)
+
+
+class TokenBucket:
+    """Paces the use of a resource to a rate per minute.
+
+    The bucket starts full, so a burst of up to a minute's worth of the
+    resource goes through at once. Reservations beyond what is available are
+    granted in order, each one after the wait that keeps the average rate.
+
+    Attributes:
+        per_minute (float): Amount of the resource available per minute.
+    """
+
+    def __init__(
+        self, per_minute: float, clock: Callable[[], float] = time.monotonic
+    ):
+        if per_minute <= 0:
+            raise ValueError("Rate must be positive.")
+        self.per_minute = per_minute
+        self._clock = clock
+        self._level = float(per_minute)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1) -> float:
+        """Reserve an amount of the resource.
+
+        Args:
+            amount (float): Amount to reserve.
+
+        Returns:
+            float: Seconds to wait before using the reserved amount.
+        """
+        with self._lock:
+            now = self._clock()
+            rate = self.per_minute / 60
+            self._level = min(
+                self.per_minute, self._level + (now - self._updated) * rate
+            )
+            self._updated = now
+            self._level -= amount
+            return max(0.0, -self._level / rate)
+
+
+class Scheduler:
+    """Paces and retries the requests to the API.
+
+    Requests are paced to stay within the requests and tokens per minute of
+    the account, every attempt of a request taking from the limits, and
+    retried with exponential backoff and jitter when they
+    fail with a transient error. When the API asks to wait, with a
+    `Retry-After` header, every request going through the scheduler waits.
+
+    When requests are coalesced, identical requests made while one of them
+    is in flight share its result instead of being made again, see
+    `SingleFlight`. Shared requests take none of the limits.
+
+    Attributes:
+        requests_per_minute (Optional[float]): Requests allowed per minute.
+            No limit if None.
+        tokens_per_minute (Optional[float]): Tokens allowed per minute. No
+            limit if None.
+        max_retries (int): Maximum number of retries of a request.
+        base_delay (float): Seconds to wait before the first retry.
+        max_delay (float): Maximum seconds to wait between retries.
+        timeout (Optional[float]): Seconds before a request times out.
+        coalesce (bool): Whether identical requests in flight are coalesced.
+        retries (int): Number of retries done so far.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_retries: int = 5,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+        timeout: Optional[float] = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+        coalesce: bool = False,
+    ):
+        if max_retries < 0:
+            raise ValueError("Max retries must be positive.")
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.coalesce = coalesce
+        self.retries = 0
+        self._clock = clock
+        self._requests = (
+            TokenBucket(requests_per_minute, clock)
+            if requests_per_minute
+            else None
+        )
+        self._tokens = (
+            TokenBucket(tokens_per_minute, clock)
+            if tokens_per_minute
+            else None
+        )
+        self._paused_until = 0.0
+        self._flights = SingleFlight() if coalesce else None
+
+    def call(self, request: Callable[..., T], tokens: int = 0, **kwargs) -> T:
+        """Make a request once it fits in the limits, retrying on failure.
+
+        Args:
+            request (Callable[..., T]): Function that makes the request, such
+                as `openai.ChatCompletion.create`. It is called with the
+                keyword arguments and the `request_timeout`.
+            tokens (int): Estimated number of tokens of the request.
+            **kwargs: Arguments of the request.
+
+        Returns:
+            T: Result of the request.
+        """
+        kwargs = self._with_timeout(kwargs)
+        if self._flights is None:
+            return self._call(request, tokens, kwargs)
+        result, shared = self._flights.call(
+            _flight_key(request, kwargs),
+            lambda: self._call(request, tokens, kwargs),
+        )
+        _mark_shared(request, shared)
+        return result
+
+    @property
+    def shared(self) -> int:
+        """Return the number of requests that shared a request in flight."""
+        return self._flights.shared if self._flights else 0
+
+    def _call(self, request: Callable[..., T], tokens: int, kwargs: dict) -> T:
+        attempt = 0
+        while True:
+            time.sleep(self._reserve(tokens))
+            time.sleep(self._pause())
+            try:
+                return request(**kwargs)
+            except retryable_errors() as error:
+                time.sleep(self._backoff(error, attempt))
+                attempt += 1
+
+    async def acall(
+        self, request: Callable[..., Awaitable[T]], tokens: int = 0, **kwargs
+    ) -> T:
+        """Asynchronous version of `call`."""
+        kwargs = self._with_timeout(kwargs)
+        if self._flights is None:
+            return await self._acall(request, tokens, kwargs)
+        result, shared = await self._flights.acall(
+            _flight_key(request, kwargs),
+            lambda: self._acall(request, tokens, kwargs),
+        )
+        _mark_shared(request, shared)
+        return result
+
+    async def _acall(
+        self, request: Callable[..., Awaitable[T]], tokens: int, kwargs: dict
+    ) -> T:
+        attempt = 0
+        while True:
+            await asyncio.sleep(self._reserve(tokens))
+            await asyncio.sleep(self._pause())
+            try:
+                return await request(**kwargs)
+            except retryable_errors() as error:
+                await asyncio.sleep(self._backoff(error, attempt))
+                attempt += 1
+
+    def _with_timeout(self, kwargs: dict) -> dict:
+        if self.timeout is not None:
+            kwargs.setdefault("request_timeout", self.timeout)
+        return kwargs
+
+    def _reserve(self, tokens: int) -> float:
+        """Reserve a request and its tokens, returning the wait needed."""
+        wait = 0.0
+        if self._requests:
+            wait = self._requests.reserve(1)
+        if self._tokens and tokens:
+            wait = max(wait, self._tokens.reserve(tokens))
+        return wait
+
+    def _pause(self) -> float:
+        """Return the seconds left until the API accepts requests again."""
+        return max(0.0, self._paused_until - self._clock())
+
+    def _backoff(
+        self, error: "openai.error.OpenAIError", attempt: int
+    ) -> float:
+        """Decide how long to wait before retrying a failed request.
+
+        Args:
+            error (openai.error.OpenAIError): Error of the request.
+            attempt (int): Number of retries already done.
+
+        Returns:
+            float: Seconds to wait before the next attempt.
+
+        Raises:
+            openai.error.OpenAIError: If the request should not be retried.
+        """
+        import openai
+
+        status = getattr(error, "http_status", None)
+        if attempt >= self.max_retries or (
+            isinstance(error, openai.error.APIError)
+            and status is not None
+            and status < 500
+        ):
+            raise error
+        self.retries += 1
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            self._paused_until = max(
+                self._paused_until, self._clock() + retry_after
+            )
+            return retry_after
+        delay = min(self.max_delay, self.base_delay * 2**attempt)
+        return random.uniform(delay / 2, delay)
+
+
+def _flight_key(request: Callable, kwargs: dict) -> tuple:
+    """Return the key of a request, the same for identical requests."""
+    return getattr(request, "request", request), replay_key(kwargs)
+
+
+def _mark_shared(request: Callable, shared: bool) -> None:
+    """Flag the attempts of a request whose result was shared."""
+    if shared and isinstance(request, Attempts):
+        request.shared = True
+
+
+def _retry_after(error: "openai.error.OpenAIError") -> Optional[float]:
+    """Return the seconds the API asked to wait, if any."""
+    headers = getattr(error, "headers", None) or {}
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+DEFAULT_SCHEDULER = Scheduler()
+
+
+def default_scheduler() -> Scheduler:
+    """Return the scheduler shared by the conversations by default."""
+    return DEFAULT_SCHEDULER
@@ -0,0 +1,368 @@
+"""Cache of replies to paraphrased questions.
+
+Questions are embedded locally with a hashed n-gram vectorizer: the words of
+the question, minus the most common English function words, and their
+character trigrams are hashed into a sparse vector, so paraphrases share
+most of their features. Near neighbours are found through an inverted index
+from features to the questions that have them, which only scores the
+questions sharing at least one feature with the new one.
+"""
+import collections
+import math
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+from .cache import request_key
+from .cost import Cost
+from .message import Message
+
+DIMENSIONS = 1 << 16
+STOP_WORDS = frozenset(
+    "a about an and are as at be can could do does did for from how i in is"
+    " it me my of on or please s should that the this to was were what"
+    " whats which will with would you your".split()
+)
+
+_WORDS = re.compile(r"[^\W_]+")
+_NUMBERS = re.compile(r"\d+(?:[.,]\d+)*")
+
+
+def embed(text: str, dimensions: int = DIMENSIONS) -> dict[int, float]:
+    """Embed a text into a sparse unit vector of hashed n-grams.
+
+    Args:
+        text (str): Text to embed.
+        dimensions (int): Number of buckets the features are hashed into.
+
+    Returns:
+        dict[int, float]: Weight of each non-zero bucket.
+    """
+    features = collections.Counter()
+    for word in _WORDS.findall(text.lower()):
+        if word in STOP_WORDS:
+            continue
+        features[zlib.crc32(word.encode("utf-8")) % dimensions] += 1
+        padded = f"<{word}>"
+        for start in range(len(padded) - 2):
+            trigram = padded[start : start + 3].encode("utf-8")
+            features[zlib.crc32(trigram) % dimensions] += 1
+    norm = math.sqrt(sum(count * count for count in features.values()))
+    return {feature: count / norm for feature, count in features.items()}
+
+
+def similarity(first: dict[int, float], second: dict[int, float]) -> float:
+    """Return the cosine similarity of two embeddings."""
+    if len(second) < len(first):
+        first, second = second, first
+    return sum(weight * second.get(key, 0.0) for key, weight in first.items())
+
+
+def question_of(request: dict) -> Optional[tuple[str, str]]:
+    """Return the scope and the question of a request.
+
+    The question is the last message, when the user sent it. The scope is a
+    hash of the model, the context and the numbers in the question: replies
+    are only shared by questions with the same scope, since a changed
+    number rarely leaves the answer unchanged.
+
+    Args:
+        request (dict): Parameters of the request.
+
+    Returns:
+        Optional[tuple[str, str]]: Scope and question, or None if the
+            request does not end with a question.
+    """
+    messages = request.get("messages") or []
+    if not messages or messages[-1]["role"] != "user":
+        return None
+    question = messages[-1]["content"]
+    context = messages[0]["content"] if messages[0]["role"] == "system" else ""
+    scope = request_key(
+        model=request.get("model"),
+        context=context,
+        numbers=_NUMBERS.findall(question),
+    )
+    return scope, question
+
+
+@dataclass(slots=True)
+class _Entry:
+    scope: str
+    question: str
+    vector: dict[int, float]
+    reply: Message
+    created: float
+
+
+class SemanticCache:
+    """Cache of replies, looked up by the meaning of the question.
+
+    A reply is returned for a question when a cached question in the same
+    scope (see `question_of`) has an embedding at least `threshold` similar
+    to it. Entries are evicted in least recently used order and, optionally,
+    kept in a SQLite database so they survive restarts.
+
+    Attributes:
+        threshold (float): Minimum cosine similarity of a hit.
+        max_size (int): Maximum number of questions kept.
+        ttl (Optional[float]): Seconds a reply is valid. Forever if None.
+        path (Optional[Path]): Path of the on-disk copy, if any.
+        hits (int): Number of lookups that returned a reply.
+        misses (int): Number of lookups that did not.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.8,
+        max_size: int = 10_000,
+        ttl: Optional[float] = None,
+        path: Optional[Union[str, Path]] = None,
+    ):
+        if not 0 < threshold <= 1:
+            raise ValueError("Threshold must be between 0 and 1.")
+        if max_size < 1:
+            raise ValueError("Cache size must be at least 1.")
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = Path(path) if path else None
+        self.hits = 0
+        self.misses = 0
+        self._entries: collections.OrderedDict[
+            int, _Entry
+        ] = collections.OrderedDict()
+        self._index: dict[str, dict[int, set[int]]] = {}
+        self._ids: dict[tuple[str, str], int] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._connection = None
+        if self.path:
+            self._connection = sqlite3.connect(
+                self.path, check_same_thread=False
+            )
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS questions (
+                    scope TEXT NOT NULL,
+                    question TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    prompt_tokens INTEGER NOT NULL,
+                    completion_tokens INTEGER NOT NULL,
+                    PRIMARY KEY (scope, question)
+                );
+                """
+            )
+            self._load()
+
+    @property
+    def hit_rate(self) -> float:
+        """Return the share of lookups that returned a reply."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, request: dict) -> Optional[Message]:
+        """Return the cached reply to a paraphrase of a request.
+
+        Args:
+            request (dict): Parameters of the request.
+
+        Returns:
+            Optional[Message]: Reply to the most similar cached question,
+                flagged as cached, or None if none is similar enough.
+        """
+        question = question_of(request)
+        if question is None:
+            return None
+        entry = self._nearest(*question)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        reply = entry.reply
+        return Message(reply.role, reply.content, reply.cost, cached=True)
+
+    def _nearest(self, scope: str, question: str) -> Optional[_Entry]:
+        """Return the entry most similar to a question, if similar enough."""
+        vector = embed(question)
+        now = time.time()
+        with self._lock:
+            index = self._index.get(scope)
+            if not index:
+                return None
+            candidates = set()
+            for feature in vector:
+                candidates.update(index.get(feature, ()))
+            best, best_similarity = None, self.threshold
+            expired = []
+            for entry_id in candidates:
+                entry = self._entries[entry_id]
+                if self.ttl is not None and now - entry.created > self.ttl:
+                    expired.append(entry_id)
+                    continue
+                score = similarity(vector, entry.vector)
+                if score >= best_similarity:
+                    best, best_similarity = entry_id, score
+            for entry_id in expired:
+                self._forget(entry_id)
+            if best is None:
+                return None
+            self._entries.move_to_end(best)
+            return self._entries[best]
+
+    def put(self, request: dict, reply: Message) -> None:
+        """Cache the reply to a request, if it ends with a question."""
+        question = question_of(request)
+        if question is None:
+            return
+        scope, question = question
+        entry = _Entry(scope, question, embed(question), reply, time.time())
+        with self._lock:
+            self._remember(entry)
+            if self._connection:
+                with self._connection:
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO questions"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            scope,
+                            question,
+                            entry.created,
+                            reply.role,
+                            reply.content,
+                            reply.cost.prompt_tokens,
+                            reply.cost.completion_tokens,
+                        ),
+                    )
+
+    def __len__(self) -> int:
+        """Return the number of cached questions."""
+        return len(self._entries)
+
+    def close(self) -> None:
+        """Close the on-disk copy."""
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+
+    def _load(self) -> None:
+        rows = self._connection.execute(
+            "SELECT scope, question, created, role, content, prompt_tokens,"
+            " completion_tokens FROM questions ORDER BY created DESC LIMIT ?",
+            (self.max_size,),
+        ).fetchall()
+        with self._connection:
+            self._connection.execute(
+                "DELETE FROM questions WHERE rowid IN ("
+                " SELECT rowid FROM questions ORDER BY created DESC"
+                " LIMIT -1 OFFSET ?)",
+                (self.max_size,),
+            )
+        for scope, question, created, *reply in reversed(rows):
+            role, content, prompt_tokens, completion_tokens = reply
+            message = Message(
+                role, content, Cost(prompt_tokens, completion_tokens)
+            )
+            self._remember(
+                _Entry(scope, question, embed(question), message, created)
+            )
+
+    def _remember(self, entry: _Entry) -> None:
+        previous = self._ids.get((entry.scope, entry.question))
+        if previous is not None:
+            self._forget(previous)
+        entry_id = self._ids[entry.scope, entry.question] = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = entry
+        index = self._index.setdefault(entry.scope, {})
+        for feature in entry.vector:
+            index.setdefault(feature, set()).add(entry_id)
+        while len(self._entries) > self.max_size:
+            self._forget(next(iter(self._entries)))
+
+    def _forget(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        del self._ids[entry.scope, entry.question]
+        index = self._index[entry.scope]
+        for feature in entry.vector:
+            ids = index[feature]
+            ids.discard(entry_id)
+            if not ids:
+                del index[feature]
+        if not index:
+            del self._index[entry.scope]
+        if self._connection:
+            with self._connection:
+                self._connection.execute(
+                    "DELETE FROM questions WHERE scope = ? AND question = ?"
+                    " AND created = ?",
+                    (entry.scope, entry.question, entry.created),
+                )
+
+
+@dataclass
+class Evaluation:
+    """Outcome of replaying labelled question pairs against a cache.
+
+    Attributes:
+        pairs (int): Number of pairs replayed.
+        paraphrases (int): Number of pairs labelled as the same question.
+        hits (int): Paraphrases answered from the cache.
+        false_hits (int): Different questions answered from the cache.
+    """
+
+    pairs: int = 0
+    paraphrases: int = 0
+    hits: int = 0
+    false_hits: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """Return the share of paraphrases answered from the cache."""
+        return self.hits / self.paraphrases if self.paraphrases else 0.0
+
+    @property
+    def false_hit_rate(self) -> float:
+        """Return the share of different questions answered from the cache."""
+        different = self.pairs - self.paraphrases
+        return self.false_hits / different if different else 0.0
+
+
+def evaluate(
+    pairs: Iterable[tuple[str, str, bool]], threshold: float = 0.8
+) -> Evaluation:
+    """Measure the hit and false hit rates of a threshold offline.
+
+    Each pair is replayed against an empty cache: the first question is
+    cached, then the second one is looked up.
+
+    Args:
+        pairs (Iterable[tuple[str, str, bool]]): Questions and whether they
+            are the same question, in other words.
+        threshold (float): Minimum cosine similarity of a hit.
+
+    Returns:
+        Evaluation: Hits and false hits.
+    """
+    evaluation = Evaluation()
+    reply = Message("assistant", "")
+    for first, second, same in pairs:
+        cache = SemanticCache(threshold, max_size=1)
+        cache.put(dict(messages=[{"role": "user", "content": first}]), reply)
+        hit = cache.get(dict(messages=[{"role": "user", "content": second}]))
+        evaluation.pairs += 1
+        evaluation.paraphrases += same
+        if hit is not None:
+            if same:
+                evaluation.hits += 1
+            else:
+                evaluation.false_hits += 1
+    return evaluation
@@ -0,0 +1,622 @@
+"""Persistent stores for conversations and interactions.
+
+Stores are append-only logs: every change to a conversation is written as a
+single record, and a conversation is rebuilt by replaying its records. Records
+are buffered in memory and written, then fsync'd, by a background thread every
+`flush_interval` seconds, so disk I/O stays off the chat loop.
+"""
+import collections
+import datetime
+import json
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+from typing import Optional, Union
+
+from .cost import Cost
+from .interactions import Interaction
+from .message import Message
+
+# Counters of an interaction, stored along its id, start and end, with their
+# SQLite types.
+_INTERACTION_COUNTERS = {
+    item.name: "REAL" if isinstance(item.default, float) else "INTEGER"
+    for item in fields(Interaction)
+    if item.name not in ("id", "start", "end")
+}
+
+
+@dataclass
+class StoredConversation:
+    """State of a conversation loaded from a store.
+
+    Attributes:
+        context (Optional[Message]): Context of the conversation.
+        messages (list[Message]): Loaded messages of the conversation.
+        cost (Cost): Cost of the whole conversation.
+        suggestion_cost (Cost): Part of the cost spent on suggesting prompts.
+        summary (Optional[Message]): Summary of the compacted messages.
+        compaction_cost (Cost): Part of the cost spent on summarizing
+            messages.
+        lost_cost (Cost): Part of the cost spent on requests that lost a
+            race.
+    """
+
+    context: Optional[Message]
+    messages: list[Message]
+    cost: Cost
+    suggestion_cost: Cost
+    summary: Optional[Message] = None
+    compaction_cost: Cost = field(default_factory=Cost)
+    lost_cost: Cost = field(default_factory=Cost)
+
+
+class ConversationStore:
+    """Buffered, append-only store of conversations and interactions.
+
+    Subclasses write batches of records with `_write` and rebuild
+    conversations with `_load`.
+
+    Attributes:
+        flush_interval (float): Seconds between background flushes. Records
+            are written right away if 0.
+    """
+
+    def __init__(self, flush_interval: float = 1.0):
+        if flush_interval < 0:
+            raise ValueError("Flush interval must be positive.")
+        self.flush_interval = flush_interval
+        self._buffer: list[dict] = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = None
+        if flush_interval:
+            self._flusher = threading.Thread(
+                target=self._flush_periodically, daemon=True
+            )
+            self._flusher.start()
+
+    def add_message(self, conversation_id: str, message: Message) -> None:
+        """Record a message added to a conversation."""
+        self._append(
+            {
+                "type": "message",
+                "conversation": conversation_id,
+                "role": message.role,
+                "content": message.content,
+                "prompt_tokens": message.cost.prompt_tokens,
+                "completion_tokens": message.cost.completion_tokens,
+                "cached": message.cached,
+            }
+        )
+
+    def add_cost(
+        self,
+        conversation_id: str,
+        cost: Cost,
+        suggestion: bool = False,
+        lost: bool = False,
+    ) -> None:
+        """Record a cost not tied to a message of a conversation.
+
+        Args:
+            conversation_id (str): Id of the conversation.
+            cost (Cost): Cost to add.
+            suggestion (bool): Whether the cost was spent suggesting a
+                prompt.
+            lost (bool): Whether the cost was spent on requests that lost a
+                race.
+        """
+        self._append(
+            {
+                "type": "cost",
+                "conversation": conversation_id,
+                "prompt_tokens": cost.prompt_tokens,
+                "completion_tokens": cost.completion_tokens,
+                "suggestion": suggestion,
+                "lost": lost,
+            }
+        )
+
+    def set_context(
+        self, conversation_id: str, message: Optional[Message]
+    ) -> None:
+        """Record the context of a conversation, None if it is removed."""
+        self._append(
+            {
+                "type": "context",
+                "conversation": conversation_id,
+                "role": message.role if message else None,
+                "content": message.content if message else None,
+            }
+        )
+
+    def set_summary(
+        self, conversation_id: str, summary: Message, summarized: int
+    ) -> None:
+        """Record that the oldest messages of a conversation were compacted.
+
+        Args:
+            conversation_id (str): Id of the conversation.
+            summary (Message): Summary that replaces the messages.
+            summarized (int): Number of messages replaced, counting from the
+                oldest one not yet compacted.
+        """
+        self._append(
+            {
+                "type": "summary",
+                "conversation": conversation_id,
+                "role": summary.role,
+                "content": summary.content,
+                "prompt_tokens": summary.cost.prompt_tokens,
+                "completion_tokens": summary.cost.completion_tokens,
+                "cached": summary.cached,
+                "summarized": summarized,
+            }
+        )
+
+    def reset(self, conversation_id: str) -> None:
+        """Record that the messages of a conversation were reset."""
+        self._append({"type": "reset", "conversation": conversation_id})
+
+    def drop_message(self, conversation_id: str, cost: Cost) -> None:
+        """Record that the last message of a conversation was removed.
+
+        Args:
+            conversation_id (str): Id of the conversation.
+            cost (Cost): Cost of the message counted in the conversation,
+                taken off its cost.
+        """
+        self._append(
+            {
+                "type": "drop",
+                "conversation": conversation_id,
+                "prompt_tokens": cost.prompt_tokens,
+                "completion_tokens": cost.completion_tokens,
+            }
+        )
+
+    def add_interaction(self, interaction: Interaction) -> None:
+        """Record the latest state of an interaction."""
+        self._append(
+            {
+                "type": "interaction",
+                "id": interaction.id,
+                **{
+                    name: getattr(interaction, name)
+                    for name in _INTERACTION_COUNTERS
+                },
+                "start": interaction.start.isoformat(),
+                "end": interaction.end.isoformat()
+                if interaction.end
+                else None,
+            }
+        )
+
+    def load(
+        self, conversation_id: str, last: Optional[int] = None
+    ) -> StoredConversation:
+        """Load a conversation.
+
+        Args:
+            conversation_id (str): Id of the conversation.
+            last (Optional[int]): Number of messages to load, counting from
+                the newest. All of them if None.
+
+        Returns:
+            StoredConversation: State of the conversation. The cost covers
+                the whole conversation, even if not all messages are loaded.
+        """
+        self.flush()
+        return self._load(conversation_id, last)
+
+    def interactions(self) -> list[Interaction]:
+        """Load the latest state of all the stored interactions.
+
+        The counters missing from the records of older versions are 0.
+        """
+        self.flush()
+        return [
+            Interaction(
+                id=row["id"],
+                **{
+                    name: row[name]
+                    for name in _INTERACTION_COUNTERS
+                    if row.get(name) is not None
+                },
+                start=datetime.datetime.fromisoformat(row["start"]),
+                end=(
+                    datetime.datetime.fromisoformat(row["end"])
+                    if row["end"]
+                    else None
+                ),
+            )
+            for row in self._interactions()
+        ]
+
+    def flush(self) -> None:
+        """Write and fsync the buffered records."""
+        with self._write_lock:
+            with self._lock:
+                records, self._buffer = self._buffer, []
+            if records:
+                self._write(records)
+
+    def close(self) -> None:
+        """Flush the buffered records and stop the background flushes."""
+        self._closed.set()
+        if self._flusher:
+            self._flusher.join()
+        self.flush()
+
+    def __enter__(self) -> "ConversationStore":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _append(self, record: dict) -> None:
+        with self._lock:
+            self._buffer.append(record)
+        if not self.flush_interval:
+            self.flush()
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def _write(self, records: list[dict]) -> None:
+        raise NotImplementedError
+
+    def _load(
+        self, conversation_id: str, last: Optional[int]
+    ) -> StoredConversation:
+        raise NotImplementedError
+
+    def _interactions(self) -> list[dict]:
+        raise NotImplementedError
+
+
+class JSONLStore(ConversationStore):
+    """Store that appends records to a JSON Lines file.
+
+    Attributes:
+        path (Path): Path of the file.
+    """
+
+    def __init__(self, path: Union[str, Path], flush_interval: float = 1.0):
+        self.path = Path(path)
+        self._file = open(self.path, "a", encoding="utf-8")
+        super().__init__(flush_interval)
+
+    def close(self) -> None:
+        super().close()
+        self._file.close()
+
+    def _write(self, records: list[dict]) -> None:
+        self._file.write(
+            "".join(json.dumps(record) + "\n" for record in records)
+        )
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _load(
+        self, conversation_id: str, last: Optional[int]
+    ) -> StoredConversation:
+        context = None
+        summary = None
+        # One message more than asked is kept, so the last one can still be
+        # loaded after the newest was dropped.
+        messages = collections.deque(maxlen=None if last is None else last + 1)
+        position = 0
+        compacted = 0
+        cost = Cost()
+        suggestion_cost = Cost()
+        compaction_cost = Cost()
+        lost_cost = Cost()
+        with open(self.path, encoding="utf-8") as file:
+            for line in file:
+                record = json.loads(line)
+                if record.get("conversation") != conversation_id:
+                    continue
+                if record["type"] == "message":
+                    message = Message(
+                        record["role"],
+                        record["content"],
+                        Cost(
+                            record["prompt_tokens"],
+                            record["completion_tokens"],
+                        ),
+                        record["cached"],
+                    )
+                    messages.append((position, message))
+                    position += 1
+                    if not message.cached:
+                        cost += message.cost
+                elif record["type"] == "cost":
+                    record_cost = Cost(
+                        record["prompt_tokens"], record["completion_tokens"]
+                    )
+                    cost += record_cost
+                    if record["suggestion"]:
+                        suggestion_cost += record_cost
+                    if record.get("lost", False):
+                        lost_cost += record_cost
+                elif record["type"] == "context":
+                    context = None
+                    if record["content"] is not None:
+                        context = Message(record["role"], record["content"])
+                elif record["type"] == "summary":
+                    summary = Message(
+                        record["role"],
+                        record["content"],
+                        Cost(
+                            record["prompt_tokens"],
+                            record["completion_tokens"],
+                        ),
+                        record["cached"],
+                    )
+                    compacted += record["summarized"]
+                    if not summary.cached:
+                        cost += summary.cost
+                        compaction_cost += summary.cost
+                elif record["type"] == "reset":
+                    messages.clear()
+                    summary = None
+                    position = compacted = 0
+                elif record["type"] == "drop":
+                    if messages and messages[-1][0] == position - 1:
+                        messages.pop()
+                    position = max(0, position - 1)
+                    cost -= Cost(
+                        record["prompt_tokens"], record["completion_tokens"]
+                    )
+        loaded = [message for index, message in messages if index >= compacted]
+        return StoredConversation(
+            context,
+            loaded[len(loaded) - last :] if last is not None else loaded,
+            cost,
+            suggestion_cost,
+            summary,
+            compaction_cost,
+            lost_cost,
+        )
+
+    def _interactions(self) -> list[dict]:
+        interactions = {}
+        with open(self.path, encoding="utf-8") as file:
+            for line in file:
+                record = json.loads(line)
+                if record["type"] == "interaction":
+                    interactions[record["id"]] = record
+        return sorted(interactions.values(), key=lambda row: row["start"])
+
+
+class SQLiteStore(ConversationStore):
+    """Store that appends records to a SQLite database.
+
+    Only the requested messages are read when a conversation is loaded, and
+    the cost is aggregated by the database.
+
+    Attributes:
+        path (Path): Path of the database.
+    """
+
+    def __init__(self, path: Union[str, Path], flush_interval: float = 1.0):
+        self.path = Path(path)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = FULL;
+            CREATE TABLE IF NOT EXISTS events (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                conversation TEXT NOT NULL,
+                type TEXT NOT NULL,
+                role TEXT,
+                content TEXT,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                suggestion INTEGER NOT NULL DEFAULT 0,
+                cached INTEGER NOT NULL DEFAULT 0,
+                summarized INTEGER NOT NULL DEFAULT 0,
+                lost INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS events_conversation
+                ON events (conversation, type, seq);
+            CREATE TABLE IF NOT EXISTS interactions (
+                id TEXT PRIMARY KEY,
+                start TEXT NOT NULL,
+                end TEXT
+            );
+            """
+        )
+        columns = {
+            row[1]
+            for row in self._connection.execute("PRAGMA table_info(events)")
+        }
+        with self._connection:
+            for name in ("summarized", "lost"):
+                if name not in columns:
+                    self._connection.execute(
+                        f"ALTER TABLE events ADD COLUMN"
+                        f" {name} INTEGER NOT NULL DEFAULT 0"
+                    )
+        columns = {
+            row[1]
+            for row in self._connection.execute(
+                "PRAGMA table_info(interactions)"
+            )
+        }
+        with self._connection:
+            for name, kind in _INTERACTION_COUNTERS.items():
+                if name not in columns:
+                    self._connection.execute(
+                        f"ALTER TABLE interactions ADD COLUMN"
+                        f" {name} {kind} NOT NULL DEFAULT 0"
+                    )
+        super().__init__(flush_interval)
+
+    def close(self) -> None:
+        super().close()
+        self._connection.close()
+
+    def _write(self, records: list[dict]) -> None:
+        columns = ["id", *_INTERACTION_COUNTERS, "start", "end"]
+        interactions = [
+            tuple(record[column] for column in columns)
+            for record in records
+            if record["type"] == "interaction"
+        ]
+        with self._connection:
+            events = []
+            for record in records:
+                if record["type"] == "drop":
+                    self._insert_events(events)
+                    events = []
+                    self._connection.execute(
+                        "DELETE FROM events WHERE seq = (SELECT MAX(seq)"
+                        " FROM events WHERE conversation = ?"
+                        " AND type = 'message')",
+                        (record["conversation"],),
+                    )
+                elif record["type"] != "interaction":
+                    events.append(
+                        (
+                            record["conversation"],
+                            record["type"],
+                            record.get("role"),
+                            record.get("content"),
+                            record.get("prompt_tokens", 0),
+                            record.get("completion_tokens", 0),
+                            record.get("suggestion", False),
+                            record.get("cached", False),
+                            record.get("summarized", 0),
+                            record.get("lost", False),
+                        )
+                    )
+            self._insert_events(events)
+            self._connection.executemany(
+                f"INSERT OR REPLACE INTO interactions"
+                f" ({', '.join(columns)})"
+                f" VALUES ({', '.join('?' * len(columns))})",
+                interactions,
+            )
+
+    def _insert_events(self, events: list[tuple]) -> None:
+        self._connection.executemany(
+            "INSERT INTO events (conversation, type, role, content,"
+            " prompt_tokens, completion_tokens, suggestion, cached,"
+            " summarized, lost) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            events,
+        )
+
+    def _load(
+        self, conversation_id: str, last: Optional[int]
+    ) -> StoredConversation:
+        with self._write_lock:
+            return self._query(conversation_id, last)
+
+    def _query(
+        self, conversation_id: str, last: Optional[int]
+    ) -> StoredConversation:
+        execute = self._connection.execute
+        (reset,) = execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM events"
+            " WHERE conversation = ? AND type = 'reset'",
+            (conversation_id,),
+        ).fetchone()
+        context = execute(
+            "SELECT role, content FROM events"
+            " WHERE conversation = ? AND type = 'context'"
+            " ORDER BY seq DESC LIMIT 1",
+            (conversation_id,),
+        ).fetchone()
+        summary = execute(
+            "SELECT role, content, prompt_tokens, completion_tokens, cached"
+            " FROM events WHERE conversation = ? AND type = 'summary'"
+            " AND seq > ? ORDER BY seq DESC LIMIT 1",
+            (conversation_id, reset),
+        ).fetchone()
+        (compacted,) = execute(
+            "SELECT COALESCE(SUM(summarized), 0) FROM events"
+            " WHERE conversation = ? AND type = 'summary' AND seq > ?",
+            (conversation_id, reset),
+        ).fetchone()
+        rows = execute(
+            "SELECT role, content, prompt_tokens, completion_tokens, cached"
+            " FROM (SELECT * FROM events WHERE conversation = ?"
+            " AND type = 'message' AND seq > ? ORDER BY seq LIMIT -1 OFFSET ?)"
+            " ORDER BY seq DESC LIMIT ?",
+            (conversation_id, reset, compacted, -1 if last is None else last),
+        ).fetchall()
+        costs = execute(
+            "SELECT type, suggestion, lost, SUM(prompt_tokens),"
+            " SUM(completion_tokens) FROM events WHERE conversation = ?"
+            " AND type IN ('message', 'cost', 'summary') AND NOT cached"
+            " GROUP BY type, suggestion, lost",
+            (conversation_id,),
+        ).fetchall()
+        cost = Cost()
+        suggestion_cost = Cost()
+        compaction_cost = Cost()
+        lost_cost = Cost()
+        for kind, suggestion, lost, prompt_tokens, completion_tokens in costs:
+            row_cost = Cost(prompt_tokens, completion_tokens)
+            cost += row_cost
+            if suggestion:
+                suggestion_cost += row_cost
+            if lost:
+                lost_cost += row_cost
+            if kind == "summary":
+                compaction_cost += row_cost
+        return StoredConversation(
+            context=Message(*context) if context and context[1] else None,
+            messages=[
+                Message(role, content, Cost(prompt, completion), bool(cached))
+                for role, content, prompt, completion, cached in rows[::-1]
+            ],
+            cost=cost,
+            suggestion_cost=suggestion_cost,
+            summary=(
+                Message(
+                    summary[0],
+                    summary[1],
+                    Cost(summary[2], summary[3]),
+                    bool(summary[4]),
+                )
+                if summary
+                else None
+            ),
+            compaction_cost=compaction_cost,
+            lost_cost=lost_cost,
+        )
+
+    def _interactions(self) -> list[dict]:
+        with self._write_lock:
+            cursor = self._connection.execute(
+                "SELECT * FROM interactions ORDER BY start"
+            )
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def open_store(
+    path: Union[str, Path], flush_interval: float = 1.0
+) -> ConversationStore:
+    """Open a store, choosing the backend from the file extension.
+
+    Args:
+        path (Union[str, Path]): Path of the store. SQLite is used for
+            `.db`, `.sqlite` and `.sqlite3` files, JSON Lines otherwise.
+        flush_interval (float): Seconds between background flushes.
+
+    Returns:
+        ConversationStore: Opened store.
+    """
+    if Path(path).suffix in (".db", ".sqlite", ".sqlite3"):
+        return SQLiteStore(path, flush_interval)
+    return JSONLStore(path, flush_interval)
@@ -0,0 +1,111 @@
+"""Local counting of the number of tokens of a message.
+
+Tokens are counted with the BPE tokenizer of the chat models when `tiktoken`
+is installed, and estimated in pure Python otherwise.
+"""
+import functools
+import re
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - depends on the environment
+    tiktoken = None
+
+ENCODING = "cl100k_base"
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+_PIECES = re.compile(
+    r"'(?:[sdmt]|ll|ve|re)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+(?!\S)|\s+",
+    re.IGNORECASE,
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding():
+    """Load the BPE tokenizer, if available.
+
+    Returns:
+        Optional[tiktoken.Encoding]: Tokenizer of the chat models, or None if
+            `tiktoken` is not installed or the encoding cannot be loaded.
+    """
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(ENCODING)
+    except Exception:  # the encoding is downloaded on first use
+        return None
+
+
+def _piece_tokens(piece: str) -> int:
+    """Estimate the number of tokens of a single word or symbol run."""
+    piece = piece.strip() or piece
+    if piece[0].isalpha():
+        if piece.isascii():
+            return -(-len(piece) // 10)
+        return _word_tokens(piece)
+    if piece[0].isspace() or piece[0].isdigit():
+        return 1
+    return -(-len(piece) // 3)
+
+
+def _word_tokens(word: str) -> int:
+    """Estimate the number of tokens of a word with non-ASCII letters.
+
+    The vocabulary has few merges outside of ASCII: a letter encoded in
+    three bytes or more, as in Chinese, Japanese or Korean, is about a token,
+    and one encoded in two bytes, as in Cyrillic or Arabic, is about two
+    thirds of a token.
+    """
+    ascii_letters = wide = 0
+    for letter in word:
+        if letter.isascii():
+            ascii_letters += 1
+        elif letter >= "\u0800":
+            wide += 1
+    narrow = len(word) - ascii_letters - wide
+    return -(-ascii_letters // 10) + wide + -(-narrow * 2 // 3)
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens of a text without a tokenizer.
+
+    The text is split the same way the GPT tokenizers split it before merging
+    byte pairs. Short words, numbers and whitespace runs count as a single
+    token, and longer pieces as several.
+
+    Args:
+        text (str): Text to count.
+
+    Returns:
+        int: Estimated number of tokens.
+    """
+    return sum(_piece_tokens(piece) for piece in _PIECES.findall(text))
+
+
+def count_tokens(text: str) -> int:
+    """Count the number of tokens of a text.
+
+    Args:
+        text (str): Text to count.
+
+    Returns:
+        int: Number of tokens, estimated if the tokenizer is not available.
+    """
+    encoding = _encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(role: str, content: str) -> int:
+    """Count the number of prompt tokens a message takes.
+
+    Args:
+        role (str): Role of the message.
+        content (str): Content of the message.
+
+    Returns:
+        int: Number of tokens, chat format overhead included.
+    """
+    return TOKENS_PER_MESSAGE + count_tokens(role) + count_tokens(content)
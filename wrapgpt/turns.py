@@ -0,0 +1,95 @@
+"""Ordering of the turns of a conversation used from several threads."""
+import asyncio
+import contextlib
+import threading
+from typing import AsyncIterator, Iterator
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class TurnOrder:
+    """Lets the turns of a conversation run one at a time, in arrival order.
+
+    Every turn takes a ticket when it arrives and runs once the turns with
+    the previous tickets are done, so concurrent turns neither interleave
+    their messages nor overtake each other. Threads and tasks can wait for
+    their turn on the same order: threads block, and tasks await a future
+    of their loop. A task cancelled while it waits gives up its ticket.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._next = 0
+        self._serving = 0
+        self._abandoned: set[int] = set()
+        self._waiters: dict[
+            int, tuple[asyncio.AbstractEventLoop, asyncio.Future]
+        ] = {}
+
+    @contextlib.contextmanager
+    def turn(self) -> Iterator[None]:
+        """Wait for the turn of the calling thread, held until the exit."""
+        with self._condition:
+            ticket = self._take()
+            try:
+                while self._serving != ticket:
+                    self._condition.wait()
+            except BaseException:
+                self._give_up(ticket)
+                raise
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._advance()
+
+    @contextlib.asynccontextmanager
+    async def aturn(self) -> AsyncIterator[None]:
+        """Asynchronous version of `turn`, for a task."""
+        future = None
+        with self._condition:
+            ticket = self._take()
+            if self._serving != ticket:
+                loop = asyncio.get_running_loop()
+                future = loop.create_future()
+                self._waiters[ticket] = loop, future
+        if future is not None:
+            try:
+                await future
+            except BaseException:
+                with self._condition:
+                    self._give_up(ticket)
+                raise
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._advance()
+
+    def _take(self) -> int:
+        ticket = self._next
+        self._next += 1
+        return ticket
+
+    def _give_up(self, ticket: int) -> None:
+        """Give up a ticket, passing the turn on if it had already come."""
+        self._waiters.pop(ticket, None)
+        if self._serving == ticket:
+            self._advance()
+        else:
+            self._abandoned.add(ticket)
+
+    def _advance(self) -> None:
+        """End the turn being served and wake the next one up."""
+        self._serving += 1
+        while self._serving in self._abandoned:
+            self._abandoned.remove(self._serving)
+            self._serving += 1
+        self._condition.notify_all()
+        waiter = self._waiters.pop(self._serving, None)
+        if waiter is not None:
+            loop, future = waiter
+            loop.call_soon_threadsafe(_wake, future)
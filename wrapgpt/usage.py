@@ -0,0 +1,558 @@
+"""Columnar export of the usage records, and queries over them.
+
+`UsageExporter` is a sink of `Metrics` that records every request and
+every finished interaction. The records are buffered in memory and written
+by a background thread, in batches of at most `batch_size` rows, so the
+chat loop never waits for the disk. Every batch is written as a new part
+file in the `calls` or `interactions` directory of the export, under a
+temporary name first, so the readers only ever see whole files:
+
+    usage/calls/part-1690000000000000000-000001.parquet
+    usage/interactions/part-1690000000000000000-000001.parquet
+
+The parts are Parquet files, or Arrow IPC files, when `pyarrow` is
+installed, and CSV files otherwise. A request that won a race is followed
+by a row of kind "lost" for each model of the requests that lost it, with
+their estimated usage, so that it is billed to the model that spent it.
+
+`summarize` reads the parts one batch at a time and aggregates the tokens,
+latency percentiles and cost by model, so histories of millions of calls
+are queried in constant memory. The percentiles come from a sketch with a
+relative error of 1%.
+"""
+import csv
+import itertools
+import math
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from enum import Enum
+from pathlib import Path
+from typing import Iterator, Optional, Sequence, Union
+
+from .interactions import Call, Interaction
+from .metrics import Sink
+
+CALL_COLUMNS = (
+    ("time", float),
+    ("model", str),
+    ("kind", str),
+    ("prompt_tokens", int),
+    ("completion_tokens", int),
+    ("lost_tokens", int),
+    ("latency", float),
+    ("time_to_first_token", float),
+    ("cached", bool),
+    ("shared", bool),
+    ("retries", int),
+    ("error", str),
+)
+INTERACTION_COLUMNS = (
+    ("id", str),
+    ("start", float),
+    ("end", float),
+    ("prompt_tokens", int),
+    ("completion_tokens", int),
+    ("suggestion_tokens", int),
+    ("compaction_tokens", int),
+    ("lost_tokens", int),
+    ("calls", int),
+    ("errors", int),
+    ("retries", int),
+    ("latency", float),
+)
+TABLES = {"calls": CALL_COLUMNS, "interactions": INTERACTION_COLUMNS}
+
+# Dollars per thousand prompt and completion tokens. A model is priced by
+# the longest name it starts with, so dated snapshots share the price of
+# their model.
+PRICES = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+}
+
+
+class UsageFormat(str, Enum):
+    """Formats of the part files."""
+
+    PARQUET = "parquet"
+    ARROW = "arrow"
+    CSV = "csv"
+
+
+def _pyarrow():
+    """Import `pyarrow`, None if it is not installed.
+
+    It is imported on first use, since it is slow to import and only the
+    export and the queries need it.
+    """
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:  # pragma: no cover - depends on the environment
+        return None
+    return pyarrow
+
+
+def default_format() -> UsageFormat:
+    """Return Parquet if `pyarrow` is installed, CSV otherwise."""
+    return UsageFormat.PARQUET if _pyarrow() else UsageFormat.CSV
+
+
+_parts = itertools.count(1)
+
+
+def call_record(call: Call) -> dict:
+    """Return the row of a request, timed when it is recorded."""
+    return {
+        "time": time.time(),
+        "model": call.model,
+        "kind": call.kind,
+        "prompt_tokens": call.prompt_tokens,
+        "completion_tokens": call.completion_tokens,
+        "lost_tokens": call.lost_tokens,
+        "latency": call.latency,
+        "time_to_first_token": call.time_to_first_token,
+        "cached": call.cached,
+        "shared": call.shared,
+        "retries": call.retries,
+        "error": call.error,
+    }
+
+
+def lost_records(call: Call) -> list[dict]:
+    """Return the rows of the requests that lost the race of a request."""
+    return [
+        {
+            **call_record(call),
+            "model": model,
+            "kind": "lost",
+            "prompt_tokens": cost.prompt_tokens,
+            "completion_tokens": cost.completion_tokens,
+            "lost_tokens": 0,
+            "latency": 0.0,
+            "time_to_first_token": 0.0,
+            "cached": False,
+            "shared": False,
+            "retries": 0,
+            "error": None,
+        }
+        for model, cost in call.lost_usage.items()
+    ]
+
+
+def interaction_record(interaction: Interaction) -> dict:
+    """Return the row of a finished interaction."""
+    return {
+        "id": interaction.id,
+        "start": interaction.start.timestamp(),
+        "end": interaction.end.timestamp() if interaction.end else None,
+        "prompt_tokens": interaction.prompt_tokens,
+        "completion_tokens": interaction.completion_tokens,
+        "suggestion_tokens": interaction.suggestion_tokens,
+        "compaction_tokens": interaction.compaction_tokens,
+        "lost_tokens": interaction.lost_tokens,
+        "calls": interaction.calls,
+        "errors": interaction.errors,
+        "retries": interaction.retries,
+        "latency": interaction.latency,
+    }
+
+
+def write_part(
+    directory: Union[str, Path],
+    table: str,
+    rows: list[dict],
+    format: UsageFormat,
+) -> Path:
+    """Write rows as a new part file of a table.
+
+    Args:
+        directory (Union[str, Path]): Directory of the export.
+        table (str): Name of the table, a key of `TABLES`.
+        rows (list[dict]): Rows to write.
+        format (UsageFormat): Format of the part.
+
+    Returns:
+        Path: Path of the part.
+    """
+    columns = TABLES[table]
+    folder = Path(directory) / table
+    folder.mkdir(parents=True, exist_ok=True)
+    name = f"part-{time.time_ns()}-{next(_parts):06d}.{format.value}"
+    path = folder / name
+    temporary = folder / f".{name}.tmp"
+    if format is UsageFormat.CSV:
+        with open(temporary, "w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(column for column, _ in columns)
+            for row in rows:
+                writer.writerow(
+                    "" if row[column] is None else row[column]
+                    for column, _ in columns
+                )
+    else:
+        pyarrow = _pyarrow()
+        if pyarrow is None:
+            raise ValueError(f"The {format.value} format needs pyarrow.")
+        schema = _schema(pyarrow, columns)
+        data = pyarrow.Table.from_pylist(rows, schema=schema)
+        if format is UsageFormat.PARQUET:
+            pyarrow.parquet.write_table(data, temporary)
+        else:
+            with pyarrow.OSFile(str(temporary), "wb") as sink:
+                with pyarrow.ipc.new_file(sink, schema) as writer:
+                    writer.write_table(data)
+    os.replace(temporary, path)
+    return path
+
+
+def _schema(pyarrow, columns: tuple) -> "pyarrow.Schema":
+    """Build the Arrow schema of the columns of a table."""
+    types = {
+        float: pyarrow.float64(),
+        int: pyarrow.int64(),
+        bool: pyarrow.bool_(),
+        str: pyarrow.string(),
+    }
+    return pyarrow.schema([(name, types[kind]) for name, kind in columns])
+
+
+class UsageExporter(Sink):
+    """Writes the usage records as columnar part files, in the background.
+
+    Register it as a sink of `Metrics`, whose `add_interaction` is a
+    listener of `SessionInteractions`, to record the requests and the
+    interactions.
+
+    Attributes:
+        directory (Path): Directory of the export.
+        format (UsageFormat): Format of the part files.
+        batch_size (int): Rows buffered before a part is written.
+        flush_interval (float): Seconds between writes of the rows buffered.
+    """
+
+    def __init__(
+        self,
+        directory: Union[str, Path],
+        format: Optional[UsageFormat] = None,
+        batch_size: int = 10_000,
+        flush_interval: float = 5.0,
+    ):
+        if batch_size < 1:
+            raise ValueError("Batch size must be positive.")
+        self.directory = Path(directory)
+        self.format = format or default_format()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._rows: dict[str, list[dict]] = {name: [] for name in TABLES}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._flush_periodically, daemon=True
+        )
+        self._flusher.start()
+
+    def export(self, call: Call) -> None:
+        self._add("calls", call_record(call))
+        for record in lost_records(call):
+            self._add("calls", record)
+
+    def export_interaction(self, interaction: Interaction) -> None:
+        self._add("interactions", interaction_record(interaction))
+
+    def flush(self) -> None:
+        """Write the rows buffered, in parts of at most `batch_size` rows."""
+        with self._write_lock:
+            with self._lock:
+                pending = self._rows
+                self._rows = {name: [] for name in TABLES}
+            for table, rows in pending.items():
+                for start in range(0, len(rows), self.batch_size):
+                    batch = rows[start : start + self.batch_size]
+                    write_part(self.directory, table, batch, self.format)
+
+    def close(self) -> None:
+        self._closed.set()
+        self._wake.set()
+        self._flusher.join()
+        self.flush()
+
+    def _add(self, table: str, row: dict) -> None:
+        with self._lock:
+            rows = self._rows[table]
+            rows.append(row)
+            full = len(rows) >= self.batch_size
+        if full:
+            self._wake.set()
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if not self._closed.is_set():
+                self.flush()
+
+
+def read_parts(
+    directory: Union[str, Path],
+    table: str = "calls",
+    columns: Optional[Sequence[str]] = None,
+    batch_size: int = 16_384,
+) -> Iterator[dict[str, list]]:
+    """Read the parts of a table, one batch of columns at a time.
+
+    Args:
+        directory (Union[str, Path]): Directory of the export.
+        table (str): Name of the table, a key of `TABLES`.
+        columns (Optional[Sequence[str]]): Columns read. All of them if
+            None. The other columns of Parquet parts are not even read from
+            the disk.
+        batch_size (int): Maximum number of rows of a batch.
+
+    Yields:
+        dict[str, list]: Values of each column of the rows of a batch.
+    """
+    types = dict(TABLES[table])
+    selected = list(columns or types)
+    folder = Path(directory) / table
+    if not folder.is_dir():
+        return
+    for path in sorted(folder.glob("part-*")):
+        if path.suffix == ".csv":
+            yield from _read_csv(path, selected, types, batch_size)
+            continue
+        pyarrow = _pyarrow()
+        if pyarrow is None:
+            raise ValueError(f"Reading {path.name} needs pyarrow.")
+        if path.suffix == ".parquet":
+            batches = pyarrow.parquet.ParquetFile(path).iter_batches(
+                batch_size, columns=selected
+            )
+            for batch in batches:
+                yield batch.to_pydict()
+        else:
+            with pyarrow.memory_map(str(path)) as source:
+                reader = pyarrow.ipc.open_file(source)
+                for index in range(reader.num_record_batches):
+                    batch = reader.get_batch(index).select(selected)
+                    for offset in range(0, batch.num_rows, batch_size):
+                        yield batch.slice(offset, batch_size).to_pydict()
+
+
+# Parse the values of the CSV parts, where missing values are empty.
+_PARSERS = {
+    float: lambda value: float(value) if value else None,
+    int: lambda value: int(value) if value else None,
+    bool: "True".__eq__,
+    str: lambda value: value,
+}
+
+
+def _read_csv(
+    path: Path, columns: list[str], types: dict[str, type], batch_size: int
+) -> Iterator[dict[str, list]]:
+    """Read columns of a CSV part, converted to their types."""
+    with open(path, encoding="utf-8", newline="") as file:
+        reader = csv.reader(file)
+        header = next(reader, [])
+        indices = [header.index(name) for name in columns]
+        parsers = [_PARSERS[types[name]] for name in columns]
+        while True:
+            rows = list(itertools.islice(reader, batch_size))
+            if not rows:
+                return
+            yield {
+                name: [parse(row[index]) for row in rows]
+                for name, index, parse in zip(columns, indices, parsers)
+            }
+
+
+class QuantileSketch:
+    """Streaming quantiles of positive values, with a bounded relative error.
+
+    The values are counted in buckets whose bounds grow geometrically, so
+    any quantile is known within the relative accuracy, in memory that only
+    grows with the logarithm of the range of the values.
+
+    Attributes:
+        relative_accuracy (float): Maximum relative error of a quantile.
+        count (int): Number of values added.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("Relative accuracy must be between 0 and 1.")
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._buckets: dict[int, int] = {}
+        self._zeros = 0
+        self.count = 0
+
+    def add(self, value: float) -> None:
+        """Add a value, counted as zero if it is not positive."""
+        self.count += 1
+        if value <= 0:
+            self._zeros += 1
+            return
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self._buckets[index] = self._buckets.get(index, 0) + 1
+
+    def quantile(self, percent: float) -> float:
+        """Return a percentile of the values, 0 if there are none.
+
+        Args:
+            percent (float): Percentile to compute, between 0 and 100.
+        """
+        if not self.count:
+            return 0.0
+        rank = round(percent / 100 * (self.count - 1))
+        seen = self._zeros
+        if rank < seen:
+            return 0.0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if rank < seen:
+                return 2 * self._gamma**index / (self._gamma + 1)
+        return 0.0  # pragma: no cover - the ranks are below the count
+
+
+@dataclass
+class ModelUsage:
+    """Usage of a model over the exported calls.
+
+    Tokens only count the requests billed: the replies served from the
+    cache or shared by an identical request are counted as calls only. The
+    requests to the model that lost a race are not counted as calls, but
+    their tokens are billed.
+
+    Attributes:
+        model (str): Name of the model.
+        calls (int): Number of requests.
+        errors (int): Number of failed requests.
+        prompt_tokens (int): Prompt tokens billed.
+        completion_tokens (int): Completion tokens billed.
+        lost_prompt_tokens (int): Estimated prompt tokens of the requests
+            that lost a race.
+        lost_completion_tokens (int): Estimated completion tokens of the
+            requests that lost a race. An under-count for the synchronous
+            races of completions, see `Call.lost_tokens`.
+        latency (QuantileSketch): Latencies of the requests, in seconds.
+        cost (float): Dollars billed, 0 if the model has no price.
+    """
+
+    model: str
+    calls: int = 0
+    errors: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    lost_prompt_tokens: int = 0
+    lost_completion_tokens: int = 0
+    latency: QuantileSketch = field(default_factory=QuantileSketch)
+    cost: float = 0.0
+
+    @property
+    def lost_tokens(self) -> int:
+        """Return the estimated tokens of the requests that lost a race."""
+        return self.lost_prompt_tokens + self.lost_completion_tokens
+
+    @property
+    def tokens(self) -> int:
+        """Return the total number of tokens billed."""
+        return self.prompt_tokens + self.completion_tokens + self.lost_tokens
+
+
+def price(
+    model: str, prices: dict[str, tuple[float, float]] = PRICES
+) -> Optional[tuple[float, float]]:
+    """Return the dollars per thousand prompt and completion tokens.
+
+    Returns:
+        Optional[tuple[float, float]]: Prices of the longest model name the
+            model starts with, None if there is none.
+    """
+    names = [name for name in prices if model.startswith(name)]
+    return prices[max(names, key=len)] if names else None
+
+
+def summarize(
+    directory: Union[str, Path],
+    prices: dict[str, tuple[float, float]] = PRICES,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+) -> dict[str, ModelUsage]:
+    """Aggregate the exported calls by model, one batch at a time.
+
+    Args:
+        directory (Union[str, Path]): Directory of the export.
+        prices (dict[str, tuple[float, float]]): Dollars per thousand
+            prompt and completion tokens, by model.
+        since (Optional[float]): Only count the calls from this Unix time.
+        until (Optional[float]): Only count the calls before this Unix time.
+
+    Returns:
+        dict[str, ModelUsage]: Usage of each model, by name.
+    """
+    usage: dict[str, ModelUsage] = {}
+    columns = (
+        "time",
+        "model",
+        "kind",
+        "prompt_tokens",
+        "completion_tokens",
+        "latency",
+        "cached",
+        "shared",
+        "error",
+    )
+    for batch in read_parts(directory, "calls", columns):
+        rows = zip(*(batch[name] for name in columns))
+        for (
+            moment,
+            model,
+            kind,
+            prompt_tokens,
+            completion_tokens,
+            latency,
+            cached,
+            shared,
+            error,
+        ) in rows:
+            if since is not None and moment < since:
+                continue
+            if until is not None and moment >= until:
+                continue
+            summary = usage.get(model)
+            if summary is None:
+                summary = usage[model] = ModelUsage(model)
+            if kind == "lost":
+                summary.lost_prompt_tokens += prompt_tokens
+                summary.lost_completion_tokens += completion_tokens
+                continue
+            summary.calls += 1
+            summary.latency.add(latency)
+            if error:
+                summary.errors += 1
+            elif not (cached or shared):
+                summary.prompt_tokens += prompt_tokens
+                summary.completion_tokens += completion_tokens
+    for summary in usage.values():
+        rates = price(summary.model, prices)
+        if rates is not None:
+            prompt_rate, completion_rate = rates
+            prompt_tokens = summary.prompt_tokens + summary.lost_prompt_tokens
+            completion_tokens = (
+                summary.completion_tokens + summary.lost_completion_tokens
+            )
+            summary.cost = (
+                prompt_tokens * prompt_rate
+                + completion_tokens * completion_rate
+            ) / 1000
+    return usage
@@ -0,0 +1,146 @@
+"""Policies to choose which messages of a conversation are sent."""
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+from .message import Message
+
+
+def _turns(messages: list[Message]) -> Iterator[int]:
+    """Yield where each turn starts, from the newest turn to the oldest.
+
+    A turn starts with a user message and includes all the messages up to the
+    next user message.
+    """
+    for index in range(len(messages) - 1, -1, -1):
+        if messages[index].role == "user" or index == 0:
+            yield index
+
+
+@dataclass
+class ContextWindow:
+    """Chooses which messages of a conversation are sent to the API.
+
+    The context of the conversation is always sent, so it is not part of the
+    messages a window chooses from. The newest message is always kept, even
+    if it does not fit in the budget on its own.
+
+    Attributes:
+        max_tokens (Optional[int]): Token budget of a request, context
+            included. No limit if None.
+    """
+
+    max_tokens: Optional[int] = None
+
+    @property
+    def limited(self) -> bool:
+        """Return whether `select` may leave messages out.
+
+        Windows that drop messages without a token budget must override it,
+        since conversations that are not limited count and hash their whole
+        history incrementally instead of the messages selected.
+        """
+        return self.max_tokens is not None
+
+    def select(
+        self, messages: list[Message], budget: Optional[int]
+    ) -> list[Message]:
+        """Choose the messages to send.
+
+        Args:
+            messages (list[Message]): Messages of the conversation.
+            budget (Optional[int]): Tokens left for the messages once the
+                context is sent. No limit if None.
+
+        Returns:
+            list[Message]: Newest messages that should be sent, or the same
+                list if all of them should.
+        """
+        raise NotImplementedError
+
+
+@dataclass
+class SlidingWindow(ContextWindow):
+    """Sends the newest messages that fit in the budget."""
+
+    def select(
+        self, messages: list[Message], budget: Optional[int]
+    ) -> list[Message]:
+        if budget is None:
+            return messages
+        start = len(messages)
+        used = 0
+        for index in range(len(messages) - 1, -1, -1):
+            used += messages[index].tokens
+            if used > budget and start < len(messages):
+                break
+            start = index
+        return messages[start:] if start else messages
+
+
+@dataclass
+class DropOldestTurns(ContextWindow):
+    """Drops whole turns, oldest first, until the rest fits in the budget.
+
+    Unlike `SlidingWindow`, a question is never sent without the answers that
+    followed it.
+    """
+
+    def select(
+        self, messages: list[Message], budget: Optional[int]
+    ) -> list[Message]:
+        if budget is None:
+            return messages
+        return self._select_turns(messages, budget, None)
+
+    @staticmethod
+    def _select_turns(
+        messages: list[Message], budget: Optional[int], limit: Optional[int]
+    ) -> list[Message]:
+        """Choose the newest turns that fit in the budget.
+
+        Args:
+            messages (list[Message]): Messages of the conversation.
+            budget (Optional[int]): Tokens left for the messages.
+            limit (Optional[int]): Maximum number of turns to keep.
+
+        Returns:
+            list[Message]: Messages of the chosen turns.
+        """
+        start = end = len(messages)
+        used = 0
+        for count, turn_start in enumerate(_turns(messages)):
+            if count == limit:
+                break
+            if budget is not None:
+                used += sum(
+                    message.tokens for message in messages[turn_start:end]
+                )
+                if used > budget and start < len(messages):
+                    break
+            start = end = turn_start
+        return messages[start:] if start else messages
+
+
+@dataclass
+class LastTurns(DropOldestTurns):
+    """Sends the last turns of the conversation.
+
+    Attributes:
+        turns (int): Maximum number of turns to send.
+    """
+
+    turns: int = 1
+
+    def __post_init__(self):
+        """Ensure that at least one turn is sent."""
+        if self.turns < 1:
+            raise ValueError("Turns must be at least 1.")
+
+    @property
+    def limited(self) -> bool:
+        return True
+
+    def select(
+        self, messages: list[Message], budget: Optional[int]
+    ) -> list[Message]:
+        return self._select_turns(messages, budget, self.turns)